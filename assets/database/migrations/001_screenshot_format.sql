@@ -0,0 +1,6 @@
+-- Screenshots are stored as raw images in the format given by 'screenshot_format'
+-- (rows with a NULL format keep the legacy zlib compressed PNG screenshots).
+-- 'screenshot_hash' keeps the perceptual hash used to skip unchanged screenshots.
+ALTER TABLE `domain`
+    ADD COLUMN `screenshot_format` VARCHAR(8) NULL DEFAULT NULL AFTER `screenshot`,
+    ADD COLUMN `screenshot_hash` CHAR(16) NULL DEFAULT NULL AFTER `screenshot_format`;
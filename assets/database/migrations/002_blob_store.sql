@@ -0,0 +1,9 @@
+-- References to the blob store holding the resource files, certificates and screenshots.
+-- Rows with a NULL store keep the blob inside the database.
+ALTER TABLE `resource`
+    ADD COLUMN `file_store` VARCHAR(8) NULL DEFAULT NULL AFTER `file`;
+ALTER TABLE `certificate`
+    ADD COLUMN `file_store` VARCHAR(8) NULL DEFAULT NULL AFTER `file`;
+ALTER TABLE `domain`
+    ADD COLUMN `screenshot_ref` CHAR(64) NULL DEFAULT NULL AFTER `screenshot_hash`,
+    ADD COLUMN `screenshot_store` VARCHAR(8) NULL DEFAULT NULL AFTER `screenshot_ref`;
@@ -0,0 +1,4 @@
+-- Codec used to compress the resource files ('zstd' or 'zstd:<dictionary id>').
+-- Rows with a NULL codec are compressed with zlib.
+ALTER TABLE `resource`
+    ADD COLUMN `codec` VARCHAR(24) NULL DEFAULT NULL AFTER `file_store`;
@@ -0,0 +1,5 @@
+-- Cache validators of the last response of each URL, used to request the
+-- resources pending of update only if they changed (conditional requests).
+ALTER TABLE `url`
+    ADD COLUMN `etag` VARCHAR(255) NULL DEFAULT NULL AFTER `response_headers`,
+    ADD COLUMN `last_modified` VARCHAR(64) NULL DEFAULT NULL AFTER `etag`;
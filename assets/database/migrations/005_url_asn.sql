@@ -0,0 +1,4 @@
+-- Autonomous system of the server of each URL (GeoLite2-ASN).
+ALTER TABLE `url`
+    ADD COLUMN `asn` INT UNSIGNED NULL DEFAULT NULL AFTER `country_code`,
+    ADD COLUMN `as_organization` VARCHAR(255) NULL DEFAULT NULL AFTER `asn`;
@@ -24,15 +24,25 @@ import os
 import time
 import logging.config
 import queue
+import signal
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from multiprocessing import Pool, Queue, cpu_count, Lock
+from multiprocessing import Queue, cpu_count, Lock
 
 # Own modules
 from db_manager import Db, Connector
-from driver_manager import build_driver, visit_site
+from data_manager import IngestPipeline, seed_known_filter, ingest_options
+from driver_manager import build_driver, visit_site, visit_sites, browser_options, screenshot_options, record_options
+from dns_resolver import get_resolver
+from checkpoint import Checkpoint
+from utils import load_suffix_list, get_geo_locator, utc_now
+from worker_supervisor import Supervisor, watched
+import log_writer
+import metrics
+import tracing
 
 # Third-party modules
-from geoip2 import database as geolocation
 from pyvirtualdisplay import Display
 from setproctitle import setproctitle
 
@@ -44,12 +54,105 @@ verbose = {"0": logging.CRITICAL, "1": logging.ERROR, "2": logging.WARNING, "3":
 
 logger = logging.getLogger("ORM")
 
+# Set by the first SIGINT/SIGTERM received by the main process
+shutdown_requested = False
 
-def main(process):
+# Domain id written by the workers into the pipe of the finished domains
+DONE_ID = struct.Struct("!Q")
+
+
+def visit_parallel(db, process, driver_list, site, geo_db, ingest, visit):
+    """ Takes up to 'tabs' domains from the queue and visits them in parallel tabs of each browser.
+
+    Domains that fail inside the parallel visit are retried alone using the standard single tab crawl.
+    Returns the ids of the domains visited. """
+
+    sites = [site]
+    queue_lock.acquire()
+    try:
+        while len(sites) < tabs:
+            sites.append(work_queue.get(block=False))
+    except queue.Empty:
+        pass
+    finally:
+        queue_lock.release()
+    domains = []
+    for site in sites:
+        domain = Connector(db, "domain")
+        domain.load(int(site))
+        logger.info('[Worker %d] Domain %s', process, domain.values["name"])
+        domains.append(domain)
+    for driver in driver_list:
+        # Clean the domain urls before crawling new info
+        for domain in domains:
+            request = "DELETE FROM domain_url WHERE domain_id = %d AND plugin_id = %d" % (domain.values["id"],
+                                                                                          driver[1].values['id'])
+            db.custom(request)
+        with tracing.span("visit_tabs", domains=len(domains)), \
+                watched(visit, [domain.values["id"] for domain in domains]):
+            driver[0], failed = visit_sites(db, process, driver[0], domains, driver[1], temp_folder, cache,
+                                            update_ublock, geo_db, ingest)
+        metrics.inc("orm_domains_processed_total", len(domains) - len(failed), stage="visit")
+        for domain in failed:
+            extra_tries = 2
+            completed = False
+            repeat = True
+            with watched(visit, [domain.values["id"]]):
+                while extra_tries > 0 and not completed and repeat:
+                    extra_tries -= 1
+                    with tracing.span("visit", domain=domain.values["name"]):
+                        driver[0], completed, repeat = visit_site(db, process, driver[0], domain, driver[1],
+                                                                  temp_folder, cache, update_ublock, geo_db, ingest)
+            count_visit(completed)
+    return sites
+
+
+def count_visit(completed):
+    """ Counts the visit of a domain with a plugin once all its tries are done. """
+
+    if completed:
+        metrics.inc("orm_domains_processed_total", stage="visit")
+    else:
+        metrics.inc("orm_domains_failed_total")
+
+
+def report_done(domain_id):
+    """ Writes the finished domain into the pipe of the main process. A write of a few bytes is kept whole by the
+    pipe, so no lock is shared with the other workers (which the watchdog can kill at any time). """
+
+    os.write(done_write, DONE_ID.pack(int(domain_id)))
+
+
+def report_finished(ingest, domain_ids):
+    """ Tells the main process that the domains are finished, once their visits are stored. """
+
+    for domain_id in domain_ids:
+        if ingest:
+            ingest.when_stored(int(domain_id), report_done)
+        else:
+            report_done(domain_id)
+
+
+def log_stages(process, visits):
+    """ Writes the traced spans and logs the stage percentiles of the worker every 100 visits. """
+
+    tracing.flush()
+    if tracing.enabled() and visits % 100 == 0:
+        logger.info("[Worker %d] Stage latencies after %d visits:\n%s", process, visits,
+                    tracing.format_stats(tracing.stats()))
+
+
+def main(process, stop_event, visit):
     """ Main process in charge of taking work from the queue and extracting info if needed.
 
     While there is remaining work in the queue continuously passes new jobs until its empty.
-    If the 'no-update' argument is false it cleans the previously URL's linked for the current domain. """
+    If the 'no-update' argument is false it cleans the previously URL's linked for the current domain.
+    Once the supervisor sets the stop event it finishes the current domain and closes its browsers. The domains
+    being visited are written into 'visit' for the watchdog of the supervisor. """
+
+    # Signals are handled by the main process, which stops the workers once their current domain is finished
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: None)
 
     # Load the DB manager for this process
     db = Db()
@@ -58,8 +161,8 @@ def main(process):
     plugin_list = Connector(db, "plugin")
     plugin_list = plugin_list.get_all({"enabled": 1})
 
-    # Load geolocation database
-    geo_db = geolocation.Reader(config.GEOCITY_FILE_PATH)
+    # Geolocation databases opened by the main process (shared memory-mapped pages)
+    geo_db = get_geo_locator()
 
     # Load the selenium driver with proper plugins
     driver_list = []
@@ -73,7 +176,13 @@ def main(process):
     if not driver_list:
         return 1
 
-    while True:
+    # Store the visits data in background threads while the browser visits the next domains
+    ingest = None
+    if ingest_threads > 0:
+        ingest = IngestPipeline(process, temp_folder, geo_db, ingest_threads, ingest_queue_size)
+
+    visits = 0
+    while not stop_event.is_set():
         try:
             queue_lock.acquire()
             site = work_queue.get(block=False)
@@ -82,11 +191,16 @@ def main(process):
             queue_lock.release()
             time.sleep(1)
         except Exception as e:
-            logger.error("[Worker %d] %s" % (process, str(e)))
+            logger.error("[Worker %d] %s", process, e)
         else:
+            visits += 1
+            if tabs > 1:
+                report_finished(ingest, visit_parallel(db, process, driver_list, site, geo_db, ingest, visit))
+                log_stages(process, visits)
+                continue
             domain = Connector(db, "domain")
             domain.load(int(site))
-            logger.info('[Worker %d] Domain %s' % (process, domain.values["name"]))
+            logger.info('[Worker %d] Domain %s', process, domain.values["name"])
             for driver in driver_list:
                 # Clean the domain urls before crawling new info
                 request = "DELETE FROM domain_url WHERE domain_id = %d AND plugin_id = %d" % (domain.values["id"],
@@ -96,17 +210,127 @@ def main(process):
                 extra_tries = 3
                 completed = False
                 repeat = True
-                while extra_tries > 0 and not completed and repeat:
-                    extra_tries -= 1
-                    driver[0], completed, repeat = visit_site(db, process, driver[0], domain,
-                                                              driver[1], temp_folder, cache, update_ublock, geo_db)
+                with watched(visit, [domain.values["id"]]):
+                    while extra_tries > 0 and not completed and repeat:
+                        extra_tries -= 1
+                        with tracing.span("visit", domain=domain.values["name"]):
+                            driver[0], completed, repeat = visit_site(db, process, driver[0], domain, driver[1],
+                                                                      temp_folder, cache, update_ublock, geo_db,
+                                                                      ingest)
+                count_visit(completed)
                 # TODO: Try to remove websites when unable to get info??
                 #  -> if a connection problem happens all the websites will be removed...
+            report_finished(ingest, [site])
+            stats = geo_db.stats()
+            logger.debug("[Worker %d] Geolocation: %d lookups, %.1f%% cached, %d not found", process, stats["lookups"],
+                         stats["hit_rate"] * 100, stats["not_found"])
+            stats = get_resolver().stats()
+            logger.debug("[Worker %d] DNS cache: %d names, %d hits, %d negative hits, %d resolved, %d failed", process,
+                         stats["cached"], stats["hits"], stats["negative_hits"], stats["resolved"], stats["failed"])
+            log_stages(process, visits)
+    if ingest:
+        ingest.close()
+    for driver in driver_list:
+        driver[0].quit()
+    db.close()
+    logger.info("[Worker %d] Finished", process)
+
+
+def record_hang(domain_ids):
+    """ Marks the domains of a worker killed by the watchdog as visited, so they are not retried right away. """
+
+    database = Db()
+    for domain_id in domain_ids:
+        domain = Connector(database, "domain")
+        if domain.load(domain_id):
+            logger.warning("[Main process] Domain %s timed out", domain.values["name"])
+            domain.values["update_timestamp"] = utc_now()
+            domain.values["priority"] = 0
+            domain.save()
+            metrics.inc("orm_domains_failed_total")
+        given_up.append(domain_id)
+    database.close()
+
+
+def request_shutdown(signum, frame):
+    """ The first signal stops the intake and lets the workers finish their current domain, the second one stops
+    the crawl right away. """
+
+    global shutdown_requested
+    if shutdown_requested:
+        raise KeyboardInterrupt
+    shutdown_requested = True
+    logger.info("[Main process] %s received: finishing the domains being visited (send it again to stop now)",
+                signal.Signals(signum).name)
+
+
+def release_finished(checkpoint):
+    """ Takes the domains finished by the workers (or given up by the watchdog) out of the checkpoint. """
+
+    finished = list(given_up)
+    del given_up[:]
+    try:
+        while True:
+            # Whole domain ids: every write of the workers is read at once
+            data = os.read(done_read, DONE_ID.size * 1024)
+            if not data:
+                break
+            finished += [DONE_ID.unpack_from(data, offset)[0] for offset in range(0, len(data), DONE_ID.size)]
+    except BlockingIOError:
+        pass
+    if checkpoint:
+        for domain_id in finished:
+            checkpoint.release(domain_id)
+
+
+def stop_crawl(supervisor, checkpoint, timeout):
+    """ Stops the workers once they finish their current domain (killing them after 'timeout' seconds) and saves
+    the checkpoint with the domains still leased: the enqueued ones and the ones that could not be finished. """
+
+    logger.info("[Main process] Waiting for the workers to finish their current domain...")
+    remaining = True
+    while remaining:
+        try:
+            work_queue.get(block=False)
+        except queue.Empty:
+            remaining = False
+    try:
+        finished = supervisor.stop(timeout)
+    except KeyboardInterrupt:
+        finished = False
+    if not finished:
+        supervisor.kill()
+    release_finished(checkpoint)
+    if checkpoint:
+        checkpoint.save()
+        logger.info("[Main process] Checkpoint saved with %d domains to resume", len(checkpoint.leased))
+
+
+def pre_resolve(names):
+    """ Resolves the names of the domains enqueued, warming the DNS caches before the browsers visit them. """
+
+    resolver = get_resolver()
+    resolver.purge()
+    addresses = resolver.resolve_many(names)
+    unresolved = [name for name, address in addresses.items() if address is None]
+    logger.debug("[Main process] %d domains pre-resolved, %d unresolved: %s", len(addresses), len(unresolved),
+                 ", ".join(unresolved[:10]))
+    stats = resolver.stats()
+    logger.debug("[Main process] DNS cache: %d names, %d hits, %d negative hits, %d resolved, %d not found, "
+                 "%d failed, %d retries", stats["cached"], stats["hits"], stats["negative_hits"], stats["resolved"],
+                 stats["not_found"], stats["failed"], stats["retries"])
 
 
 parser = argparse.ArgumentParser(description='Online Resource Mapper (ORM)')
 parser.add_argument('-t', dest='threads', type=int, default=0,
                     help='Number of threads/processes to span (Default: Auto)')
+parser.add_argument('--autoscale', dest='autoscale', action="store_true",
+                    help='Adapts the number of processes to the memory and CPU usage, pausing the intake of new '
+                         'domains while the memory is scarce (Default: fixed number of processes)')
+parser.add_argument('--min-threads', dest='min_threads', type=int, default=1,
+                    help='Minimum number of processes with --autoscale (Default: 1)')
+parser.add_argument('--max-threads', dest='max_threads', type=int, default=0,
+                    help='Maximum number of processes with --autoscale (Default: number of CPUs)')
 parser.add_argument('-v', dest='verbose', type=int, default=3,
                     help='Verbose: 0=CRITICAL; 1=ERROR; 2=WARNING; 3=INFO; 4=DEBUG (Default: WARNING)')
 parser.add_argument('-d', dest='tmp', type=str, default='tmp',
@@ -119,6 +343,45 @@ parser.add_argument('-update-threshold', dest='update_threshold', type=int, defa
                     help='Period of days to skip rescanning a website (Default: 30 days).')
 parser.add_argument('--update-ublock', dest='update_ublock', action="store_true",
                     help='Updates uBlock pattern lists every time a new browser is launched (Default: no update)')
+parser.add_argument('--tabs', dest='tabs', type=int, default=1,
+                    help='Number of websites visited in parallel tabs by each browser (Default: 1)')
+parser.add_argument('--headless', dest='headless', action="store_true",
+                    help='Runs Firefox in native headless mode instead of inside a virtual X display (Default: Xvfb)')
+parser.add_argument('--no-screenshots', dest='screenshots', action="store_false",
+                    help='Disables the screenshot of the visited websites (Default: take screenshots)')
+parser.add_argument('--ingest-threads', dest='ingest_threads', type=int, default=0,
+                    help='Threads per worker storing the visits data while the browser visits the next domains '
+                         '(Default: 0, store the data before visiting the next domain)')
+parser.add_argument('--ingest-queue', dest='ingest_queue', type=int, default=4,
+                    help='Maximum visits per worker waiting to be stored before the browser waits (Default: 4)')
+parser.add_argument('--capture-bodies', dest='capture_bodies', action="store_true",
+                    help='Takes the downloadable resources from the browser instead of downloading them again '
+                         '(Default: download them)')
+parser.add_argument('--batch-ingest', dest='batch_ingest', action="store_true",
+                    help='Stores the URLs of each visit with a few requests per table instead of several requests '
+                         'per URL (Default: one URL at a time)')
+parser.add_argument('--known-filter', dest='known_filter', type=int, default=0,
+                    help='Capacity of the filter of stored resource hashes shared by the workers to skip their '
+                         'database checks (Default: 0, disabled)')
+parser.add_argument('--proxy', dest='proxy', type=str, default='',
+                    help='HTTP proxy (host:port) used by the browsers (Default: direct connection)')
+parser.add_argument('--trace', dest='trace', type=str, default='',
+                    help='Folder where the spans of the visit stages are written in Chrome trace format '
+                         '(Default: no tracing)')
+parser.add_argument('--record', dest='record', type=str, default='',
+                    help='Folder where the raw data of every visit is archived to replay it with visit_replayer.py '
+                         '(Default: no recording)')
+parser.add_argument('--pre-resolve', dest='pre_resolve', action="store_true",
+                    help='Resolves the names of the enqueued domains in background before they are visited '
+                         '(Default: no pre-resolution)')
+parser.add_argument('--visit-budget', dest='visit_budget', type=int, default=config.WATCHDOG_VISIT_BUDGET,
+                    help='Seconds a process may spend visiting a domain (all tries included) before being killed and '
+                         'replaced, 0 to never kill them (Default: WATCHDOG_VISIT_BUDGET of config.py)')
+parser.add_argument('--checkpoint', dest='checkpoint', type=str, default='',
+                    help='File keeping the domains enqueued and being visited, to resume the crawl from it if it exists '
+                         '(Default: no checkpoint)')
+parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=0,
+                    help='Local port serving the live metrics of the crawl at /metrics (Default: 0, disabled)')
 parser.add_argument('--priority-scan', dest='priority', action="store_true",
                     help='Activates priority scan. This ORM will only scan domains with the priority flag enabled')
 
@@ -126,20 +389,53 @@ parser.add_argument('--priority-scan', dest='priority', action="store_true",
 if __name__ == '__main__':
     """ Main process in charge of reading the arguments, filling the work queue and creating the workers."""
 
+    # Inhibit signals on work creation (the browsers and workers inherit it)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
     # Take arguments
     args = parser.parse_args()
     cache = args.cache
     update_ublock = args.update_ublock
     update_threshold = args.update_threshold
     threads = args.threads
+    tabs = max(1, args.tabs)
+    ingest_threads = args.ingest_threads
+    ingest_queue_size = max(1, args.ingest_queue)
     temp_folder = os.path.join(os.path.abspath("."), args.tmp)
     v = args.verbose
     os.makedirs(os.path.join(os.path.abspath("."), "log"), exist_ok=True)
     if verbose[str(v)]:
         logger.setLevel(verbose[str(v)])
+    # Every process logs through the writer process from now on
+    log_writer.start()
 
-    display = Display(visible=False, size=(1920, 1080))
-    display.start()
+    display = None
+    browser_options["headless"] = args.headless
+    browser_options["proxy"] = args.proxy or None
+    screenshot_options["enabled"] = args.screenshots
+    ingest_options["batch"] = args.batch_ingest
+    if args.record:
+        record_options["folder"] = os.path.abspath(args.record)
+    if args.trace:
+        tracing.trace_options["folder"] = os.path.abspath(args.trace)
+    if args.metrics_port:
+        metrics.setup()
+    # Parsed (and mapped) before forking so every worker shares the public suffixes and geolocation databases
+    load_suffix_list()
+    get_geo_locator()
+    if args.capture_bodies:
+        database = Db()
+        browser_options["capture_bodies"] = True
+        browser_options["capture_mime_types"] = Connector(database, "mime_type").get_property("name", {"download": 1})
+        database.close()
+    if args.known_filter > 0:
+        database = Db()
+        logger.info("Loading the known resources filter...")
+        logger.info("%d known resources loaded", seed_known_filter(database, args.known_filter))
+        database.close()
+    if not args.headless:
+        display = Display(visible=False, size=(browser_options["width"], browser_options["height"]))
+        display.start()
 
     # If thread parameter is auto get the (total-1) or the available CPU's, whichever is smaller
     logger.info("Calculating processes...")
@@ -155,42 +451,73 @@ if __name__ == '__main__':
             threads = cpu - 1
         else:
             threads = available_cpu
-    logger.info("Processes to run: %d " % threads)
+    logger.info("Processes to run: %d ", threads)
 
-    # Initialize job queue
+    # Initialize job queue and the pipe of the domains finished by the workers
     work_queue = Queue()
     queue_lock = Lock()
+    done_read, done_write = os.pipe()
+    os.set_blocking(done_read, False)
+    given_up = []
+
+    # Pre-resolution of the enqueued domains, one batch at a time
+    resolver_executor = ThreadPoolExecutor(max_workers=1) if args.pre_resolve else None
 
     # Create and call the workers
     logger.debug("[Main process] Spawning new workers...")
-    with Pool(processes=threads) as pool:
-        p = pool.map_async(main, [i for i in range(int(threads))])
+    supervisor = Supervisor(main, threads, args.min_threads, args.max_threads or cpu_count(), args.autoscale, tabs,
+                            args.visit_budget, record_hang, queue_lock)
+    supervisor.start()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, [metrics.queue_depth(domains=work_queue), metrics.worker_memory,
+                                          supervisor.collect])
 
-        pending = ["0"]
-        last_id = args.start
-        while True:
-            # Insert new work into queue if needed.
+    # Resume the domains leased by the previous run
+    pending = ["0"]
+    last_id = args.start
+    checkpoint = Checkpoint(os.path.abspath(args.checkpoint)) if args.checkpoint else None
+    if checkpoint and checkpoint.load():
+        last_id = checkpoint.last_id
+        logger.info("[Main process] Resuming %d domains from the checkpoint, then from domain id %d",
+                    len(checkpoint.leased), last_id)
+        for domain_id in sorted(checkpoint.leased):
+            work_queue.put(domain_id)
+            pending.append(str(domain_id))
+
+    # Stop gracefully on SIGINT/SIGTERM (the workers ignore them)
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGTERM, request_shutdown)
+    shutdown_timeout = config.SHUTDOWN_TIMEOUT
+    try:
+        while not shutdown_requested:
+            # Insert new work into queue if needed (unless the supervisor paused the intake)
             queue_lock.acquire()
             qsize = work_queue.qsize()
             queue_lock.release()
-            if qsize < (2 * threads):
+            supervisor.check(qsize)
+            threads = supervisor.size
+            if qsize < (2 * threads * tabs) and not supervisor.paused:
                 logger.debug("[Main process] Getting work")
                 now = datetime.now(timezone.utc)
                 td = timedelta(-1 * update_threshold)
                 period = now + td
-                rq = 'SELECT id FROM domain'
+                rq = 'SELECT id, name FROM domain'
                 if args.priority:
                     rq += ' WHERE priority = 1'
                 else:
                     rq += ' WHERE priority = 0 AND update_timestamp < "%s"' % (period.strftime('%Y-%m-%d %H:%M:%S'))
                 rq += ' AND id NOT IN (%s)' % ','.join(pending)
                 rq += ' AND id > %s' % last_id
-                rq += ' ORDER BY update_timestamp, id ASC LIMIT %d ' % (2 * threads)
+                rq += ' ORDER BY update_timestamp, id ASC LIMIT %d ' % (2 * threads * tabs)
                 pending = ["0"]
                 database = Db()
                 results = database.custom(rq)
                 # If no new work wait ten seconds and retry
                 if len(results) > 0:
+                    # Leased before losing their priority flag, so they are resumed if the crawl stops
+                    if checkpoint:
+                        checkpoint.lease([int(result["id"]) for result in results], int(results[-1]["id"]))
+                        checkpoint.save(supervisor.visiting())
                     # Initialize job queue
                     logger.debug("[Main process] Enqueuing work")
                     queue_lock.acquire()
@@ -205,6 +532,19 @@ if __name__ == '__main__':
                         pending.append(str(result["id"]))
                         last_id = int(result["id"])
                     queue_lock.release()
+                    if resolver_executor:
+                        resolver_executor.submit(pre_resolve, [result["name"] for result in results])
                 database.close()
+            release_finished(checkpoint)
+            if checkpoint and checkpoint.changed:
+                checkpoint.save(supervisor.visiting())
             time.sleep(1)
-    display.stop()
\ No newline at end of file
+    except KeyboardInterrupt:
+        logger.warning("[Main process] Stopping now: the domains being visited will be resumed")
+        shutdown_timeout = 0
+    finally:
+        stop_crawl(supervisor, checkpoint, shutdown_timeout)
+        if resolver_executor:
+            resolver_executor.shutdown(wait=False)
+    if display:
+        display.stop()
\ No newline at end of file
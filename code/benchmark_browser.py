@@ -0,0 +1,179 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+""" Benchmarks the memory and CPU used by each browser when running inside a virtual X display (Xvfb)
+and in Firefox native headless mode. """
+
+# Basic modules
+import argparse
+import os
+import time
+import logging.config
+
+# 3rd party modules
+import psutil
+from pyvirtualdisplay import Display
+
+# Own modules
+from db_manager import Db, Connector
+from driver_manager import build_driver, browser_options
+
+logging.config.fileConfig('logging.conf')
+
+logger = logging.getLogger("MODULE")
+
+
+class VanillaPlugin:
+    """ Stand-in for the plugin Connector used to launch browsers without any extension. """
+
+    def __init__(self):
+        self.values = {"name": "Vanilla"}
+
+
+def process_tree(pid):
+    """ Returns the process with the given pid and all its descendants. """
+
+    try:
+        process = psutil.Process(pid)
+        return [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+
+
+def sample(processes):
+    """ Returns the total RSS (bytes) and CPU time (seconds) of the given processes. """
+
+    rss = 0
+    cpu = 0.0
+    for process in processes:
+        try:
+            rss += process.memory_info().rss
+            times = process.cpu_times()
+            cpu += times.user + times.system
+        except psutil.NoSuchProcess:
+            continue
+    return rss, cpu
+
+
+def run_mode(headless, plugin, browsers, sites, dwell):
+    """ Launches the browsers in the given mode, visits the sites and returns the measured resources. """
+
+    display = None
+    browser_options["headless"] = headless
+    if not headless:
+        display = Display(visible=False, size=(browser_options["width"], browser_options["height"]))
+        display.start()
+    drivers = []
+    for i in range(browsers):
+        driver = build_driver(plugin, False, False, i)
+        while not driver:
+            driver = build_driver(plugin, False, False, i)
+        drivers.append(driver)
+
+    extra_pids = []
+    if display and getattr(display, "pid", None):
+        extra_pids.append(display.pid)
+
+    def tree():
+        processes = []
+        for d in drivers:
+            processes += process_tree(d.service.process.pid)
+        for pid in extra_pids:
+            processes += process_tree(pid)
+        return processes
+
+    start_rss, start_cpu = sample(tree())
+    peak_rss = start_rss
+    rss_samples = []
+    start = time.time()
+    for index, site in enumerate(sites):
+        driver = drivers[index % len(drivers)]
+        try:
+            driver.get('http://' + site)
+        except Exception as e:
+            logger.warning("Could not load %s: %s", site, e)
+        time.sleep(dwell)
+        rss, cpu = sample(tree())
+        rss_samples.append(rss)
+        peak_rss = max(peak_rss, rss)
+    elapsed = time.time() - start
+    end_rss, end_cpu = sample(tree())
+
+    for driver in drivers:
+        driver.quit()
+    if display:
+        display.stop()
+
+    mean_rss = sum(rss_samples) / len(rss_samples) if rss_samples else end_rss
+    return {"mode": "headless" if headless else "xvfb",
+            "idle_rss": start_rss / browsers,
+            "mean_rss": mean_rss / browsers,
+            "peak_rss": peak_rss / browsers,
+            "cpu": (end_cpu - start_cpu) / browsers,
+            "cpu_per_visit": (end_cpu - start_cpu) / max(1, len(sites)),
+            "elapsed": elapsed}
+
+
+parser = argparse.ArgumentParser(description='Browser memory and CPU benchmark (Xvfb vs native headless)')
+parser.add_argument('-b', dest='browsers', type=int, default=2, help='Browsers launched per mode (Default: 2)')
+parser.add_argument('-f', dest='filename', type=str, default='',
+                    help='File containing one domain per line to visit (Default: a few popular domains)')
+parser.add_argument('-n', dest='sites', type=int, default=10, help='Number of sites to visit per mode (Default: 10)')
+parser.add_argument('--dwell', dest='dwell', type=int, default=5,
+                    help='Seconds to wait inside each website (Default: 5)')
+parser.add_argument('-p', dest='plugin', type=int, default=0,
+                    help='Id of the plugin to load in the browsers (Default: none, vanilla browser)')
+parser.add_argument('--mode', dest='mode', type=str, default='both', choices=['both', 'xvfb', 'headless'],
+                    help='Browser mode to benchmark (Default: both)')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.makedirs(os.path.join(os.path.abspath("."), "log"), exist_ok=True)
+    if args.filename:
+        with open(args.filename, "r") as f:
+            site_list = [line.strip() for line in f.readlines() if line.strip()]
+    else:
+        site_list = ["wikipedia.org", "google.com", "youtube.com", "amazon.com", "reddit.com"]
+    site_list = (site_list * args.sites)[:args.sites]
+
+    modes = []
+    if args.mode in ("both", "xvfb"):
+        modes.append(False)
+    if args.mode in ("both", "headless"):
+        modes.append(True)
+    if args.plugin:
+        database = Db()
+        browser_plugin = Connector(database, "plugin")
+        browser_plugin.load(args.plugin)
+    else:
+        browser_plugin = VanillaPlugin()
+    results = []
+    for mode in modes:
+        logger.info("Benchmarking %s mode with %d browsers", "headless" if mode else "xvfb", args.browsers)
+        results.append(run_mode(mode, browser_plugin, args.browsers, site_list, args.dwell))
+
+    print("%-10s %14s %14s %14s %12s %14s %10s" % ("Mode", "Idle RSS (MB)", "Mean RSS (MB)", "Peak RSS (MB)",
+                                                  "CPU (s)", "CPU/visit (s)", "Time (s)"))
+    for result in results:
+        print("%-10s %14.1f %14.1f %14.1f %12.2f %14.3f %10.1f" % (result["mode"], result["idle_rss"] / 2 ** 20,
+                                                              result["mean_rss"] / 2 ** 20,
+                                                              result["peak_rss"] / 2 ** 20, result["cpu"],
+                                                              result["cpu_per_visit"], result["elapsed"]))
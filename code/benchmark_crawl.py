@@ -0,0 +1,355 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+""" End-to-end benchmark of the crawler. A local HTTP server acting as proxy serves synthetic websites (scripts,
+third-party hosts, cookies and canvas/WebGL fingerprinting snippets) for a seeded list of domains, and ORM.py is
+launched with its browsers and downloads going through it. Reports the domains crawled per hour, the latency of
+each stage of the visits and the peak RSS of every worker (with its browsers).
+
+The domains are inserted with the priority flag and crawled with "--priority-scan", so use a benchmark database
+(config.MYSQL_DB) instead of the production one. """
+
+# Basic modules
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import logging.config
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# 3rd party modules
+import psutil
+
+# Own modules
+from db_manager import Db
+from utils import utc_now, hash_string
+
+logging.config.fileConfig('logging.conf')
+
+logger = logging.getLogger("MODULE")
+
+# User agent of the resource downloads done by the ingestion (see utils.download_file)
+DOWNLOAD_AGENT = "rv:45.0"
+
+CANVAS_SNIPPET = """<canvas id="c" width="220" height="30"></canvas><script>
+var c = document.getElementById("c").getContext("2d"); c.textBaseline = "top"; c.font = "14px Arial";
+c.fillStyle = "#f60"; c.fillRect(125, 1, 62, 20); c.fillStyle = "#069"; c.fillText("ORM bench %d", 2, 15);
+document.getElementById("c").toDataURL();</script>"""
+
+WEBGL_SNIPPET = """<script>var gl = document.createElement("canvas").getContext("webgl");
+if (gl) { var ext = gl.getExtension("WEBGL_debug_renderer_info");
+if (ext) { gl.getParameter(ext.UNMASKED_VENDOR_WEBGL); gl.getParameter(ext.UNMASKED_RENDERER_WEBGL); } }</script>"""
+
+
+class SyntheticWeb(object):
+    """ Deterministic synthetic websites and third-party hosts generated from a seed. """
+
+    def __init__(self, sites, scripts, third_parties, cookies, fingerprinting, script_size, seed):
+        self.sites = sites
+        self.scripts = scripts
+        self.third_parties = max(1, third_parties)
+        self.cookies = cookies
+        self.fingerprinting = fingerprinting
+        self.script_size = script_size
+        self.seed = seed
+
+    @staticmethod
+    def site_name(index):
+        return "orm-bench-%04d.com" % index
+
+    @staticmethod
+    def third_party_name(index):
+        return "orm-bench-cdn%02d.net" % index
+
+    def site_index(self, host):
+        """ Returns the index of the website host (with or without www) or None. """
+
+        name = host[4:] if host.startswith("www.") else host
+        if name.startswith("orm-bench-") and name.endswith(".com") and name[10:-4].isdigit():
+            index = int(name[10:-4])
+            return index if index < self.sites else None
+        return None
+
+    def page(self, index):
+        """ Returns the HTML of the website, including its scripts (half of them third-party). """
+
+        rng = random.Random("%d-%d" % (self.seed, index))
+        tags = []
+        for number in range(self.scripts):
+            if number % 2:
+                host = self.third_party_name(rng.randrange(self.third_parties))
+                # Shared libraries (same content for every website) and website specific scripts
+                path = "/lib/%d.js" % rng.randrange(self.scripts) if number % 4 == 1 else "/s/%d/%d.js" % (index,
+                                                                                                         number)
+            else:
+                host = self.site_name(index)
+                path = "/s/%d/%d.js" % (index, number)
+            tags.append('<script src="http://%s%s"></script>' % (host, path))
+        cookies = "".join('document.cookie = "js%d=%d; path=/";' % (number, rng.randrange(10 ** 6))
+                          for number in range(self.cookies))
+        fingerprinting = (CANVAS_SNIPPET % index + WEBGL_SNIPPET) if self.fingerprinting else ""
+        return ("<!DOCTYPE html><html><head><title>%s</title>%s</head><body><h1>%s</h1><p>%s</p>"
+                "<script>%s</script>%s</body></html>" % (self.site_name(index), "".join(tags),
+                                                         self.site_name(index), "Lorem ipsum " * 200, cookies,
+                                                         fingerprinting)).encode()
+
+    def script(self, path):
+        """ Returns the (deterministic) content of the script. """
+
+        rng = random.Random("%d-%s" % (self.seed, path))
+        lines = ["/* %s */" % path]
+        size = len(lines[0])
+        while size < self.script_size:
+            line = "var v%d = function(a) { return a * %d + '%x'; };" % (rng.randrange(10 ** 6),
+                                                                       rng.randrange(10 ** 6), rng.getrandbits(64))
+            lines.append(line)
+            size += len(line) + 1
+        return "\n".join(lines).encode()
+
+
+class RequestLog(object):
+    """ Thread-safe log of the requests received by the stand-in: [time, site index, browser request]. """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, site, browser):
+        with self.lock:
+            self.events.append([time.time(), site, browser])
+
+
+def build_handler(web, requests_log):
+    """ Returns the HTTP handler serving the synthetic web (both as proxy and as server). """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send(self, status, content_type, body, headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or []):
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def do_GET(self):
+            # Proxy requests carry the absolute URL
+            parsed = urlsplit(self.path)
+            host = (parsed.hostname or self.headers.get("Host", "")).split(":")[0].lower()
+            path = parsed.path or "/"
+            browser = DOWNLOAD_AGENT not in self.headers.get("User-Agent", "")
+            site = web.site_index(host)
+            if path.startswith("/s/") and path.split("/")[2].isdigit():
+                site = int(path.split("/")[2])
+            requests_log.add(site, browser)
+            if web.site_index(host) is not None and path == "/":
+                cookies = [("Set-Cookie", "c%d=%d; Path=/; Max-Age=3600" % (number, number))
+                           for number in range(web.cookies)]
+                self.send(200, "text/html; charset=utf-8", web.page(web.site_index(host)), cookies)
+            elif path.endswith(".js") and (path.startswith("/s/") or path.startswith("/lib/")):
+                body = web.script(path)
+                self.send(200, "application/javascript", body,
+                          [("ETag", '"%s"' % hashlib.sha256(body).hexdigest()[:16]),
+                           ("Cache-Control", "max-age=3600")])
+            else:
+                self.send(404, "text/plain", b"Not found")
+
+        do_HEAD = do_GET
+
+    return Handler
+
+
+def seed_domains(database, web):
+    """ Inserts the synthetic websites in the database marked with priority. Returns their names. """
+
+    names = [web.site_name(index) for index in range(web.sites)]
+    database.initialize({name: {"tranco_rank": 0, "name": name} for name in names}, utc_now())
+    rq = "UPDATE domain SET priority = 1 WHERE hash IN (%s)" % ", ".join(["%s"] * len(names))
+    database.custom(rq, values=[hash_string(name) for name in names])
+    return names
+
+
+def worker_processes(orm):
+    """ Returns the worker processes of ORM.py (the python children of the main process). """
+
+    workers = []
+    for child in orm.children():
+        try:
+            if "python" in child.name().lower():
+                workers.append(child)
+        except psutil.NoSuchProcess:
+            continue
+    return workers
+
+
+def tree_rss(process):
+    """ Returns the RSS (bytes) of the process and all its descendants (geckodriver and Firefox). """
+
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    rss = 0
+    for item in processes:
+        try:
+            rss += item.memory_info().rss
+        except psutil.NoSuchProcess:
+            continue
+    return rss
+
+
+def stored_visits(folder, names):
+    """ Returns the time each domain was stored, taken from the visit archives recorded by ORM.py. """
+
+    stored = {}
+    if not os.path.isdir(folder):
+        return stored
+    for filename in os.listdir(folder):
+        name = filename.split("_")[0]
+        if filename.endswith(".zip") and name in names and name not in stored:
+            stored[name] = os.path.getmtime(os.path.join(folder, filename))
+    return stored
+
+
+def percentiles(values):
+    """ Returns the 50th, 90th and 99th percentiles and the maximum of the values. """
+
+    if not values:
+        return [0, 0, 0, 0]
+    values = sorted(values)
+    return [values[min(len(values) - 1, int(len(values) * p))] for p in (0.5, 0.9, 0.99)] + [values[-1]]
+
+
+def stage_latencies(requests_log, names, stored):
+    """ Returns the latencies of the stages of each visit: page (first to last browser request), downloads (first to
+    last download of the ingestion), store (last browser request until stored) and visit (first request until
+    stored). """
+
+    spans = {}
+    for timestamp, site, browser in requests_log.events:
+        if site is None:
+            continue
+        span = spans.setdefault(site, {True: [timestamp, timestamp], False: None})
+        if span[browser] is None:
+            span[browser] = [timestamp, timestamp]
+        span[browser][0] = min(span[browser][0], timestamp)
+        span[browser][1] = max(span[browser][1], timestamp)
+    stages = {"page": [], "downloads": [], "store": [], "visit": []}
+    for index, name in enumerate(names):
+        if index not in spans or name not in stored:
+            continue
+        page = spans[index][True]
+        stages["page"].append(page[1] - page[0])
+        if spans[index][False]:
+            stages["downloads"].append(spans[index][False][1] - spans[index][False][0])
+        stages["store"].append(max(0, stored[name] - page[1]))
+        stages["visit"].append(stored[name] - page[0])
+    return stages
+
+
+parser = argparse.ArgumentParser(description='End-to-end crawler benchmark with a local stand-in of the web')
+parser.add_argument('-n', dest='sites', type=int, default=50, help='Number of synthetic websites (Default: 50)')
+parser.add_argument('-t', dest='threads', type=int, default=2, help='ORM.py workers (Default: 2)')
+parser.add_argument('--scripts', dest='scripts', type=int, default=20,
+                    help='Scripts per website, half of them third-party (Default: 20)')
+parser.add_argument('--third-parties', dest='third_parties', type=int, default=5,
+                    help='Number of third-party hosts (Default: 5)')
+parser.add_argument('--cookies', dest='cookies', type=int, default=3,
+                    help='Cookies set by each website, by header and by script (Default: 3)')
+parser.add_argument('--no-fingerprinting', dest='fingerprinting', action="store_false",
+                    help='Removes the canvas/WebGL snippets from the websites (Default: included)')
+parser.add_argument('--script-size', dest='script_size', type=int, default=20000,
+                    help='Size of each script in bytes (Default: 20000)')
+parser.add_argument('--seed', dest='seed', type=int, default=1, help='Seed of the synthetic websites (Default: 1)')
+parser.add_argument('--port', dest='port', type=int, default=8765, help='Port of the local stand-in (Default: 8765)')
+parser.add_argument('--timeout', dest='timeout', type=int, default=3600,
+                    help='Maximum seconds to wait for the crawl (Default: 3600)')
+parser.add_argument('-d', dest='folder', type=str, default='benchmark',
+                    help='Folder for the recorded visits (Default: "./benchmark")')
+parser.add_argument('orm_args', nargs=argparse.REMAINDER,
+                    help='Extra arguments for ORM.py after "--" (e.g. -- --headless --batch-ingest)')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.makedirs(os.path.join(os.path.abspath("."), "log"), exist_ok=True)
+    synthetic_web = SyntheticWeb(args.sites, args.scripts, args.third_parties, args.cookies, args.fingerprinting,
+                                 args.script_size, args.seed)
+    request_log = RequestLog()
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), build_handler(synthetic_web, request_log))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Synthetic web of %d websites served at 127.0.0.1:%d", args.sites, args.port)
+
+    database = Db()
+    domain_names = seed_domains(database, synthetic_web)
+    database.close()
+    archive_folder = os.path.abspath(os.path.join(args.folder, "visits"))
+    shutil.rmtree(archive_folder, ignore_errors=True)
+
+    # The browsers use the stand-in as proxy, the resource downloads of the ingestion too
+    proxy = "127.0.0.1:%d" % args.port
+    environment = dict(os.environ, HTTP_PROXY="http://" + proxy, HTTPS_PROXY="http://" + proxy,
+                       NO_PROXY="localhost,127.0.0.1")
+    extra_args = [arg for arg in args.orm_args if arg != "--"]
+    command = [sys.executable, "ORM.py", "-t", str(args.threads), "--priority-scan", "--proxy", proxy,
+               "--record", archive_folder] + extra_args
+    logger.info("Launching %s", " ".join(command))
+    start = time.time()
+    orm_process = psutil.Popen(command, env=environment, stdout=subprocess.DEVNULL)
+
+    peak_rss = {}
+    visits = {}
+    while time.time() - start < args.timeout and orm_process.poll() is None:
+        for worker in worker_processes(orm_process):
+            peak_rss[worker.pid] = max(peak_rss.get(worker.pid, 0), tree_rss(worker))
+        visits = stored_visits(archive_folder, domain_names)
+        if len(visits) == len(domain_names):
+            break
+        time.sleep(1)
+    elapsed = time.time() - start
+    for child in orm_process.children(recursive=True):
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            continue
+    orm_process.kill()
+    server.shutdown()
+    visits = stored_visits(archive_folder, domain_names)
+
+    print("Websites crawled: %d / %d in %.1f s (%.1f domains/hour)" % (len(visits), len(domain_names), elapsed,
+                                                                       len(visits) / elapsed * 3600))
+    print("%-10s %10s %10s %10s %10s" % ("Stage", "p50 (s)", "p90 (s)", "p99 (s)", "max (s)"))
+    for stage, latencies in stage_latencies(request_log, domain_names, visits).items():
+        print("%-10s %10.2f %10.2f %10.2f %10.2f" % tuple([stage] + percentiles(latencies)))
+    print("%-10s %14s" % ("Worker", "Peak RSS (MB)"))
+    for pid, rss in sorted(peak_rss.items()):
+        print("%-10d %14.1f" % (pid, rss / 2 ** 20))
@@ -0,0 +1,149 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+""" Micro-benchmark of the parsing of the uBlock sessionStorage entries done before storing a visit: the former
+double json.loads of every entry against the request records with each available JSON backend. """
+
+# Basic modules
+import argparse
+import json
+import random
+import time
+import tracemalloc
+import logging.config
+
+# Own modules
+import request_record
+from request_record import parse_requests, json_dumps
+
+import config
+
+logging.config.fileConfig('logging.conf')
+
+logger = logging.getLogger("MODULE")
+
+
+def synthetic_dump(entries):
+    """ Returns a sessionStorage dump (key -> JSON string) with entries similar to the ones saved by the browser. """
+
+    dump = {}
+    for request_id in range(entries):
+        url = "https://cdn%d.example.com/static/js/file%d.js?v=%d" % (request_id % 7, request_id, random.random() * 1e6)
+        details = {"requestId": str(request_id), "tabId": 2, "frameId": 0, "parentFrameId": -1,
+                   "timeStamp": 1600000000000 + request_id, "url": url, "method": "GET", "type": "script",
+                   "originUrl": "https://www.example.com/", "documentUrl": "https://www.example.com/",
+                   "thirdParty": True, "blocked": request_id % 5 == 0, "from_cache": False,
+                   "server_ip": "93.184.216.%d" % (request_id % 255), "hash": "%064x" % random.getrandbits(256),
+                   "request_headers": {"User-Agent": "Mozilla/5.0", "Accept": "*/*", "Referer": "https://example.com/"},
+                   "response_headers": {"content-type": "application/javascript", "content-length": "12345",
+                                        "cache-control": "max-age=31536000", "etag": '"%x"' % request_id,
+                                        "date": "Mon, 01 Mar 2021 10:00:00 GMT"}}
+        if request_id % 3 == 0:
+            details["security_info"] = {"state": "secure", "protocolVersion": "TLSv1.3",
+                                        "cipherSuite": "TLS_AES_128_GCM_SHA256",
+                                        "certificates": [{"subject": "CN=*.example.com",
+                                                          "rawDER": [random.getrandbits(8) for _ in range(1400)]}]}
+        dump["2 " + url] = json.dumps(details)
+    return dump
+
+
+def legacy_parse(request_list):
+    """ Former parsing: validation pass and certificate pass loading every entry, then headers serialization. """
+
+    valid = {}
+    for key in request_list.keys():
+        elem = json.loads(request_list[key])
+        if isinstance(elem, dict) and "requestId" in elem.keys():
+            valid[key] = request_list[key]
+    url_dict = []
+    for key in valid.keys():
+        url_info = json.loads(valid[key])
+        if "security_info" in url_info.keys():
+            security_info = url_info["security_info"]
+            if "certificates" in security_info.keys() and len(security_info["certificates"]) > 0:
+                ''.join(format(x, '02x') for x in security_info["certificates"][0]["rawDER"])
+                security_info.pop("certificates")
+        url_dict.append(url_info)
+    for elem in url_dict:
+        for field in ["request_headers", "response_headers", "security_info"]:
+            if field in elem.keys():
+                json.dumps(elem[field])
+    return url_dict
+
+
+def record_parse(request_list):
+    """ Current parsing: every entry loaded once into a request record, then headers serialization. """
+
+    records = parse_requests("benchmark", request_list)
+    for elem in records:
+        if elem.security_info is not None and elem.security_info.get("certificates"):
+            bytes(elem.security_info["certificates"][0]["rawDER"]).hex()
+            elem.security_info.pop("certificates")
+        for value in [elem.request_headers, elem.response_headers, elem.security_info]:
+            if value is not None:
+                json_dumps(value)
+    return records
+
+
+def measure(function, dumps, rounds):
+    """ Returns the entries parsed per second and the memory (bytes) retained by the parsed entries. """
+
+    entries = sum(len(dump) for dump in dumps)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for dump in dumps:
+            function(dump)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    parsed = [function(dump) for dump in dumps]
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del parsed
+    return entries * rounds / elapsed, retained
+
+
+parser = argparse.ArgumentParser(description='sessionStorage parsing micro-benchmark')
+parser.add_argument('-f', dest='files', type=str, nargs='*', default=[],
+                    help='JSON files with recorded sessionStorage dumps (Default: synthetic dumps)')
+parser.add_argument('-n', dest='entries', type=int, default=300,
+                    help='Entries of each synthetic dump (Default: 300)')
+parser.add_argument('-s', dest='sites', type=int, default=20, help='Number of synthetic dumps (Default: 20)')
+parser.add_argument('-r', dest='rounds', type=int, default=5, help='Rounds over all the dumps (Default: 5)')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.files:
+        session_dumps = []
+        for filename in args.files:
+            with open(filename, "r") as f:
+                session_dumps.append(json.load(f))
+    else:
+        session_dumps = [synthetic_dump(args.entries) for _ in range(args.sites)]
+    logger.info("Benchmarking %d dumps with %d entries", len(session_dumps), sum(len(dump) for dump in session_dumps))
+
+    methods = [("legacy (json x2)", legacy_parse, "json"), ("records (json)", record_parse, "json")]
+    if request_record.orjson:
+        methods.append(("records (orjson)", record_parse, "orjson"))
+    print("%-20s %16s %16s" % ("Method", "Entries/s", "Retained (MB)"))
+    for name, method, backend in methods:
+        config.JSON_BACKEND = backend
+        speed, memory = measure(method, session_dumps, args.rounds)
+        print("%-20s %16.0f %16.1f" % (name, speed, memory / 2 ** 20))
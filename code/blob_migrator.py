@@ -0,0 +1,84 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+""" Moves the resource files, certificates and screenshots stored inside the database to the configured
+blob store, leaving only the reference in the rows. """
+
+# Basic modules
+import argparse
+import logging.config
+
+# Own modules
+from db_manager import Db
+from blob_storage import BLOB_COLUMNS, get_store, store_blob
+
+import config
+
+logging.config.fileConfig('logging.conf')
+
+logger = logging.getLogger("MODULE")
+
+
+def migrate_table(database, table, batch, start, end):
+    """ Moves the blobs of the given table to the blob store in batches of rows. Returns the rows migrated. """
+
+    column, key_column, store_column = BLOB_COLUMNS[table]
+    last_id = start - 1
+    migrated = 0
+    while True:
+        rq = "SELECT id, %s, %s FROM %s WHERE %s IS NOT NULL AND %s IS NULL AND id > %d" % \
+             (key_column, column, table, column, store_column, last_id)
+        if end > 0:
+            rq += " AND id <= %d" % end
+        rq += " ORDER BY id LIMIT %d" % batch
+        results = database.custom(rq)
+        if not results:
+            break
+        for row in results:
+            last_id = row["id"]
+            if not store_blob(table, row):
+                continue
+            database.custom("UPDATE %s SET %s = NULL, %s = %%s, %s = %%s WHERE id = %%s" %
+                            (table, column, store_column, key_column),
+                            values=[row[store_column], row[key_column], row["id"]])
+            migrated += 1
+        logger.info("[%s] %d rows migrated (last id %d)", table, migrated, last_id)
+    return migrated
+
+
+parser = argparse.ArgumentParser(description='Moves the database blobs to the configured blob store')
+parser.add_argument('-tables', dest='tables', type=str, nargs='+', default=list(BLOB_COLUMNS.keys()),
+                    choices=list(BLOB_COLUMNS.keys()), help='Tables to migrate (Default: all)')
+parser.add_argument('-b', dest='batch', type=int, default=500, help='Rows loaded per request (Default: 500)')
+parser.add_argument('-start', dest='start', type=int, default=0, help='Start id (Default: First)')
+parser.add_argument('-end', dest='end', type=int, default=-1, help='End id (Default: Last)')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if not get_store():
+        logger.error("No blob store configured. Set BLOB_STORE inside config.py")
+        exit(1)
+    logger.info("Migrating blobs to the '%s' store", config.BLOB_STORE)
+    db = Db()
+    for table_name in args.tables:
+        total = migrate_table(db, table_name, args.batch, args.start, args.end)
+        logger.info("[%s] Finished: %d rows migrated", table_name, total)
+    db.close()
@@ -0,0 +1,220 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+
+""" Content-addressed storage for the big binary columns of the database.
+
+Resource files, certificates and screenshots can be kept outside MySQL in a
+blob store. The blobs are keyed by the sha256 hash already used to identify
+the rows, so the rows only keep a reference to the store holding them:
+
+- resource: 'file' column, keyed by 'hash', store saved in 'file_store'.
+- certificate: 'file' column, keyed by 'hash', store saved in 'file_store'.
+- domain: 'screenshot' column, keyed by 'screenshot_ref' (sha256 of the
+screenshot), store saved in 'screenshot_store'.
+
+Rows with an empty store column keep the blob inside the database as before.
+Use 'store_blob' before saving a row and 'load_blob'/'has_blob' to access it.
+"""
+
+# Basic modules
+import os
+import tempfile
+import logging.config
+
+import config
+from utils import hash_bytes
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    RuntimeWarning('You will have to install boto3 to use an S3 compatible blob store')
+    boto3 = None
+
+logging.config.fileConfig('logging.conf')
+logger = logging.getLogger("DB_MANAGER")
+
+# Blob column, key column and store column of each table
+BLOB_COLUMNS = {"resource": ("file", "hash", "file_store"),
+                "certificate": ("file", "hash", "file_store"),
+                "domain": ("screenshot", "screenshot_ref", "screenshot_store")}
+
+# Stores opened by the current process
+stores = {}
+
+
+def shard_path(key):
+    """ Returns the sharded relative path of a key (e.g. resource/ab/cd/abcd...). """
+
+    namespace, name = key.split("/", 1)
+    return "/".join([namespace, name[0:2], name[2:4], name])
+
+
+class LocalBlobStore(object):
+    """
+    Stores the blobs as files inside a local folder using a sharded
+    directory layout to avoid huge directories.
+    """
+
+    name = "local"
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        """ Returns the file path of the blob. """
+
+        return os.path.join(self.root, *shard_path(key).split("/"))
+
+    def put(self, key, data):
+        """ Saves the blob. Existing blobs are not rewritten as their key depends on their content. """
+
+        path = self.path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see partial blobs
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def get(self, key):
+        """ Returns the blob or None if it does not exist. """
+
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key):
+        """ Checks if the blob exists. """
+
+        return os.path.exists(self.path(key))
+
+    def delete(self, key):
+        """ Removes the blob. """
+
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3BlobStore(object):
+    """
+    Stores the blobs inside an S3 compatible bucket (e.g. a local MinIO
+    server) using the same sharded layout as the local store.
+    """
+
+    name = "s3"
+
+    def __init__(self, endpoint, bucket, access_key, secret_key):
+        if not boto3:
+            raise RuntimeError("boto3 is needed to use the S3 blob store")
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint, aws_access_key_id=access_key,
+                                   aws_secret_access_key=secret_key)
+
+    def put(self, key, data):
+        """ Saves the blob. """
+
+        self.client.put_object(Bucket=self.bucket, Key=shard_path(key), Body=data)
+
+    def get(self, key):
+        """ Returns the blob or None if it does not exist. """
+
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=shard_path(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return response["Body"].read()
+
+    def exists(self, key):
+        """ Checks if the blob exists. """
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=shard_path(key))
+        except ClientError:
+            return False
+        return True
+
+    def delete(self, key):
+        """ Removes the blob. """
+
+        self.client.delete_object(Bucket=self.bucket, Key=shard_path(key))
+
+
+def get_store(name=None):
+    """ Returns the blob store with the given name (the configured one by default) or None if not enabled. """
+
+    if name is None:
+        name = config.BLOB_STORE
+    if not name:
+        return None
+    if name not in stores.keys():
+        if name == LocalBlobStore.name:
+            stores[name] = LocalBlobStore(config.BLOB_STORE_PATH)
+        elif name == S3BlobStore.name:
+            stores[name] = S3BlobStore(config.S3_ENDPOINT, config.S3_BUCKET, config.S3_ACCESS_KEY,
+                                       config.S3_SECRET_KEY)
+        else:
+            raise ValueError("Unknown blob store '%s'" % name)
+    return stores[name]
+
+
+def store_blob(table, values):
+    """ Moves the blob of the row values to the configured blob store leaving only the reference.
+
+    Returns True if the blob was moved. """
+
+    store = get_store()
+    column, key_column, store_column = BLOB_COLUMNS[table]
+    if not store or values.get(column) is None:
+        return False
+    if table == "domain":
+        values[key_column] = hash_bytes(values[column])
+    store.put(table + "/" + values[key_column], values[column])
+    values[column] = None
+    values[store_column] = store.name
+    return True
+
+
+def has_blob(table, values):
+    """ Checks if the row has a blob (inside the database or in a blob store). """
+
+    column, key_column, store_column = BLOB_COLUMNS[table]
+    return bool(values.get(column) or values.get(store_column))
+
+
+def load_blob(table, values):
+    """ Returns the blob of the row values wherever it is stored. """
+
+    column, key_column, store_column = BLOB_COLUMNS[table]
+    if not values.get(store_column):
+        return values.get(column)
+    data = get_store(values[store_column]).get(table + "/" + values[key_column])
+    if data is None:
+        logger.error("Blob %s/%s not found in store '%s'", table, values[key_column], values[store_column])
+    return data
@@ -0,0 +1,83 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+
+""" Checkpoint of the crawl, to resume it where a previous run stopped.
+
+The checkpoint keeps the domains leased to the workers (enqueued and not
+finished yet, including the ones being visited) and the last domain id
+enqueued. It is written as JSON into a temporary file that replaces the
+previous checkpoint (os.replace), so a crash while saving never leaves a
+partial checkpoint behind:
+
+    {"date": "...", "last_id": 1234, "leased": [1201, 1230], "in_progress": [1201]}
+"""
+
+# Basic modules
+import json
+import os
+
+from utils import utc_now
+
+
+class Checkpoint(object):
+    """ Domains leased to the workers and last domain id enqueued, saved into the given file. """
+
+    def __init__(self, path):
+        self.path = path
+        self.leased = set()
+        self.last_id = 0
+        self.changed = False
+
+    def load(self):
+        """ Loads the checkpoint of the previous run. Returns False if there is none. """
+
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path, "r") as f:
+            state = json.load(f)
+        self.leased = set(state["leased"])
+        self.last_id = state["last_id"]
+        return True
+
+    def lease(self, domain_ids, last_id):
+        """ Marks the domains as enqueued, 'last_id' being the id the next domains are searched from. """
+
+        self.leased.update(domain_ids)
+        self.last_id = last_id
+        self.changed = True
+
+    def release(self, domain_id):
+        """ Marks the domain as finished (visited and stored, or given up). """
+
+        self.leased.discard(domain_id)
+        self.changed = True
+
+    def save(self, in_progress=()):
+        """ Writes the checkpoint (with the domains being visited, for information) replacing the previous one. """
+
+        state = {"date": utc_now(), "last_id": self.last_id, "leased": sorted(self.leased),
+                 "in_progress": sorted(in_progress)}
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+        self.changed = False
@@ -0,0 +1,120 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+
+""" Compression codecs used to store the resource files.
+
+Every resource row saves the codec used to compress its file inside the
+'codec' column:
+
+- NULL: zlib (every row stored before the codec column existed).
+- 'zstd': Zstandard without dictionary.
+- 'zstd:<id>': Zstandard with the trained dictionary <id>, loaded from
+'<id>.dict' inside config.ZSTD_DICTIONARY_PATH.
+
+Use 'compress' to get the compressed data and its codec tag, and
+'decompress' (or 'read_resource' for resource rows) to get it back.
+"""
+
+# Basic modules
+import os
+import zlib
+import threading
+
+import config
+from blob_storage import load_blob
+
+try:
+    import zstandard
+except ImportError:
+    RuntimeWarning('You will have to install zstandard to use the zstd codecs')
+    zstandard = None
+
+# Dictionaries and (not thread-safe) zstd contexts of the current thread
+local = threading.local()
+dictionaries = {}
+
+
+def load_dictionary(dict_id):
+    """ Loads the trained dictionary with the given id. """
+
+    if dict_id not in dictionaries.keys():
+        with open(os.path.join(config.ZSTD_DICTIONARY_PATH, "%s.dict" % dict_id), "rb") as f:
+            dictionaries[dict_id] = zstandard.ZstdCompressionDict(f.read())
+    return dictionaries[dict_id]
+
+
+def default_codec():
+    """ Returns the codec tag configured for the new resources. """
+
+    if config.RESOURCE_CODEC == "zstd" and zstandard:
+        if config.ZSTD_DICTIONARY:
+            return "zstd:%s" % config.ZSTD_DICTIONARY
+        return "zstd"
+    return None
+
+
+def get_context(kind, tag):
+    """ Returns the zstd compressor/decompressor of the current thread for the given codec tag. """
+
+    contexts = getattr(local, kind, None)
+    if contexts is None:
+        contexts = {}
+        setattr(local, kind, contexts)
+    if tag not in contexts.keys():
+        dictionary = load_dictionary(tag.split(":", 1)[1]) if ":" in tag else None
+        if kind == "compressors":
+            contexts[tag] = zstandard.ZstdCompressor(level=config.ZSTD_LEVEL, dict_data=dictionary)
+        else:
+            contexts[tag] = zstandard.ZstdDecompressor(dict_data=dictionary)
+    return contexts[tag]
+
+
+def compress(data, tag=""):
+    """ Compresses the data with the given codec (the configured one by default). Returns the data and its tag. """
+
+    if tag == "":
+        tag = default_codec()
+    if not tag:
+        return zlib.compress(data), None
+    return get_context("compressors", tag).compress(data), tag
+
+
+def compressor(tag=None):
+    """ Returns a streaming compressor (compress/flush methods) for the given codec tag. """
+
+    if not tag:
+        return zlib.compressobj()
+    return get_context("compressors", tag).compressobj()
+
+
+def decompress(data, tag=None):
+    """ Decompresses the data compressed with the given codec. """
+
+    if not tag:
+        return zlib.decompress(data)
+    # Stream decompression also supports frames written without the content size
+    return get_context("decompressors", tag).decompressobj().decompress(data)
+
+
+def read_resource(values):
+    """ Returns the uncompressed file of the resource row values. """
+
+    return decompress(load_blob("resource", values), values.get("codec"))
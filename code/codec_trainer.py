@@ -0,0 +1,123 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+""" Trains Zstandard dictionaries on a sample of the stored resources and benchmarks the compression ratio and
+speed of the available codecs. """
+
+# Basic modules
+import argparse
+import os
+import time
+import logging.config
+
+# 3rd party modules
+import zstandard
+
+# Own modules
+from db_manager import Db
+from codec import compress, decompress, read_resource
+
+import config
+
+logging.config.fileConfig('logging.conf')
+
+logger = logging.getLogger("MODULE")
+
+
+def load_samples(database, resource_type, size, offset=0):
+    """ Loads a random sample of stored resources of the given type. Returns their uncompressed files. """
+
+    rq = 'SELECT id, hash, file, file_store, codec FROM resource WHERE size > 0 AND type = %s'
+    rq += ' AND (file IS NOT NULL OR file_store IS NOT NULL) ORDER BY RAND(1) LIMIT %d, %d' % (offset, size)
+    samples = []
+    for row in database.custom(rq, values=[resource_type]):
+        try:
+            data = read_resource(row)
+        except Exception as e:
+            logger.warning("Could not read resource %d: %s", row["id"], e)
+            continue
+        if data:
+            samples.append(data)
+    return samples
+
+
+def train(samples, dict_size):
+    """ Trains a dictionary with the given samples and saves it inside the dictionary folder. Returns its id. """
+
+    dictionary = zstandard.train_dictionary(dict_size, samples)
+    os.makedirs(config.ZSTD_DICTIONARY_PATH, exist_ok=True)
+    dict_id = str(dictionary.dict_id())
+    with open(os.path.join(config.ZSTD_DICTIONARY_PATH, "%s.dict" % dict_id), "wb") as f:
+        f.write(dictionary.as_bytes())
+    return dict_id
+
+
+def benchmark(samples, tags):
+    """ Compresses and decompresses the samples with every codec and returns the ratio and speeds. """
+
+    original = sum(len(sample) for sample in samples)
+    results = []
+    for tag in tags:
+        start = time.perf_counter()
+        compressed = [compress(sample, tag)[0] for sample in samples]
+        compress_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for data in compressed:
+            decompress(data, tag)
+        decompress_time = time.perf_counter() - start
+        size = sum(len(data) for data in compressed)
+        results.append({"codec": tag or "zlib",
+                        "ratio": original / max(1, size),
+                        "compress": original / 2 ** 20 / max(compress_time, 1e-9),
+                        "decompress": original / 2 ** 20 / max(decompress_time, 1e-9)})
+    return results
+
+
+parser = argparse.ArgumentParser(description='Zstandard dictionary trainer and codec benchmark')
+parser.add_argument('-type', dest='type', type=str, default='script',
+                    help='Resource type used to train and benchmark (Default: script)')
+parser.add_argument('-n', dest='samples', type=int, default=5000,
+                    help='Number of resources used to train the dictionary (Default: 5000)')
+parser.add_argument('-size', dest='dict_size', type=int, default=112640,
+                    help='Dictionary size in bytes (Default: 110KB)')
+parser.add_argument('-b', dest='benchmark', type=int, default=1000,
+                    help='Number of (other) resources used to benchmark the codecs, 0 to skip it (Default: 1000)')
+parser.add_argument('-d', dest='dictionary', type=str, default='',
+                    help='Benchmark an existing dictionary id instead of training a new one')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    db = Db()
+    dictionary_id = args.dictionary
+    if not dictionary_id:
+        logger.info("Loading %d %s resources to train the dictionary", args.samples, args.type)
+        dictionary_id = train(load_samples(db, args.type, args.samples), args.dict_size)
+        logger.info("Dictionary %s saved. Set ZSTD_DICTIONARY = '%s' inside config.py to use it", dictionary_id,
+                    dictionary_id)
+    if args.benchmark > 0:
+        # Skip the training samples to benchmark with resources not seen by the dictionary
+        logger.info("Loading %d %s resources to benchmark the codecs", args.benchmark, args.type)
+        benchmark_samples = load_samples(db, args.type, args.benchmark, offset=args.samples)
+        print("%-24s %8s %18s %20s" % ("Codec", "Ratio", "Compress (MB/s)", "Decompress (MB/s)"))
+        for result in benchmark(benchmark_samples, [None, "zstd", "zstd:%s" % dictionary_id]):
+            print("%-24s %8.2f %18.1f %20.1f" % (result["codec"], result["ratio"], result["compress"],
+                                                 result["decompress"]))
+    db.close()
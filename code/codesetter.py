@@ -3,7 +3,6 @@ import argparse
 import os
 import logging.config
 import queue
-import zlib
 import time
 import signal
 from multiprocessing import Pool, Queue, cpu_count, Lock, Process, Pipe
@@ -14,7 +13,10 @@ from setproctitle import setproctitle
 
 # Own modules
 from db_manager import Db, Connector
+from codec import read_resource
 from utils import hash_string, utc_now
+import log_writer
+import metrics
 
 logging.config.fileConfig('logging.conf')
 
@@ -28,7 +30,7 @@ def print_remaining(last_ts, sec, msg):
     dif = now - last_ts
     if dif > 1:
         work_queue_lock.acquire()
-        work_size = result_queue.qsize()
+        work_size = work_queue.qsize()
         work_queue_lock.release()
         result_queue_lock.acquire()
         result_size = result_queue.qsize()
@@ -233,7 +235,7 @@ def extract_scripts(code, ast_data, worker_number):
         for script_code in soup.find_all('script', {"src": False}):
             return extract_ast(script_code.text, ast_data, worker_number)
     except:
-        logger.warning("[Worker %d] AST parsing failed" % worker_number)
+        logger.warning("[Worker %d] AST parsing failed", worker_number)
         return False
 
 
@@ -241,29 +243,29 @@ def extract_ast(code, ast_data, worker_number):
     """ Computes the codesets for the given code. """
 
     try:
-        logger.debug('[Worker %d] Trying leaf 1' % worker_number)
+        logger.debug('[Worker %d] Trying leaf 1', worker_number)
         ast = esprima.toDict(esprima.parseScript(code, tolerant=True, jsx=True, range=True))
     except Exception as e:
         try:
             code2 = code.decode("utf-8")
-            logger.debug('[Worker %d] Trying leaf 2' % worker_number)
+            logger.debug('[Worker %d] Trying leaf 2', worker_number)
             ast = esprima.toDict(esprima.parseScript(code2, tolerant=True, jsx=True, range=True))
         except Exception as e:
             try:
-                logger.debug('[Worker %d] Trying leaf 3' % worker_number)
+                logger.debug('[Worker %d] Trying leaf 3', worker_number)
                 ast = esprima.toDict(esprima.parseScript(code, tolerant=True, jsx=True, range=True))
             except Exception as e:
                 try:
                     code2 = code.decode("utf-8")
-                    logger.debug('[Worker %d] Trying leaf 4' % worker_number)
+                    logger.debug('[Worker %d] Trying leaf 4', worker_number)
                     ast = esprima.toDict(esprima.parseModule(code2, tolerant=True, jsx=True, range=True))
                 except Exception as e:
-                    logger.warning('[Worker %d] Could not create AST' % worker_number)
+                    logger.warning('[Worker %d] Could not create AST', worker_number)
                     return False
     try:
         traverse(ast, ast_data)
     except:
-        logger.warning('[Worker %d] Could not parse AST' % worker_number)
+        logger.warning('[Worker %d] Could not parse AST', worker_number)
         return False
     return True
 
@@ -285,16 +287,16 @@ def enqueue_result(obj):
 def compute_codesets(resource, ast_data, worker_number):
     """ Inserts the  resource codesets inside the database. """
 
-    logger.debug("[Worker %d] AST subtrees: %d" % (worker_number, len(ast_data["subtrees"])))
+    logger.debug("[Worker %d] AST subtrees: %d", worker_number, len(ast_data["subtrees"]))
     for j in range(len(ast_data["subtrees"])):
-        logger.debug("[Worker %d] Creating subtree %d" % (worker_number, j))
+        logger.debug("[Worker %d] Creating subtree %d", worker_number, j)
         hash_value = hash_string(ast_data["subtrees"][j])
-        logger.debug("[Worker %d] Hash %s" % (worker_number, hash_value))
+        logger.debug("[Worker %d] Hash %s", worker_number, hash_value)
         codeset = {"hash": hash_value,
                    "tree_nodes": int(len(ast_data["subtrees"][j]) / 3)}
         enqueue_result({"codeset": codeset, "resource_id": resource["id"],
                         "offset": ast_data["offset"][j], "length": ast_data["length"][j]})
-        logger.debug("[Worker %d] Subtree %d created" % (worker_number, j))
+        logger.debug("[Worker %d] Subtree %d created", worker_number, j)
 
 
 parser = argparse.ArgumentParser(description='JavaScript parser')
@@ -306,6 +308,8 @@ parser.add_argument('-f', dest='input_file', type=str, default="",
                     help='File containing a list of resource ids to codeset (Default: NULL)')
 parser.add_argument('-v', dest='verbose', type=int, default=3,
                     help='Verbose: 0=CRITICAL; 1=ERROR; 2=WARNING; 3=INFO; 4=DEBUG (Default: WARNING)')
+parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=0,
+                    help='Local port serving the live metrics of the parser at /metrics (Default: 0, disabled)')
 
 
 def db_work(process_number):
@@ -355,7 +359,7 @@ def db_work(process_number):
                         resource.load(item["resource_id"])
                 setproctitle("ORM - Data parser process %d - Resource %d" % (process_number, resource.values["id"]))
             except Exception as error:
-                logger.critical("[DB Worker %d] Crashed #1. Codeset: %s | Error: %s" % (process_number, str(item), str(error)))
+                logger.critical("[DB Worker %d] Crashed #1. Codeset: %s | Error: %s", process_number, item, error)
             try:
                 if item["codeset"] is not None:
                     # Load the codeset and save it if non-existent
@@ -374,7 +378,7 @@ def db_work(process_number):
                             codeset.values["tracking_resources"] = int(codeset.values["tracking_resources"]) + 1
                     resource.add(codeset, {"offset": item["offset"], "length": item["length"]})
             except Exception as error:
-                logger.critical("[DB Worker %d] Crashed #2. Codeset: %s | Error: %s" % (process_number, str(item), str(error)))
+                logger.critical("[DB Worker %d] Crashed #2. Codeset: %s | Error: %s", process_number, item, error)
     db.close()
     child_pipe.send("Finished")
     return
@@ -397,25 +401,28 @@ def work(process_number):
             work_queue_lock.release()
             time.sleep(1)
         except Exception as e:
-            logger.error("[Worker %d] %s" % (process_number, str(e)))
+            logger.error("[Worker %d] %s", process_number, e)
         else:
             setproctitle("ORM - Worker process #%d - Resource %d" % (process_number, resource_data["id"]))
-            logger.debug('[Worker %d] Resource %s' % (process_number, resource_data["id"]))
+            logger.debug('[Worker %d] Resource %s', process_number, resource_data["id"])
             ast_data = {"subtrees": [], "ongoing": [], "offset": [], "length": []}
-            code = zlib.decompress(resource_data["file"])
+            code = read_resource(resource_data)
             if resource_data["type"] == "frame":
                 if not extract_scripts(code, ast_data, process_number):
                     if not extract_ast(code, ast_data, process_number):
-                        logger.warning('[Worker %d] Could not compute AST for %d' % (process_number, resource_data["id"]))
+                        logger.warning('[Worker %d] Could not compute AST for %d', process_number, resource_data["id"])
+                        metrics.inc("orm_failures_total", type="parse")
                         enqueue_result({"codeset": None, "resource_id": resource_data["id"]})
                         continue
             elif resource_data["type"] == "script":
                 if not extract_ast(code, ast_data, process_number):
                     if not extract_scripts(code, ast_data, process_number):
-                        logger.warning('[Worker %d] Could not compute AST for %d' % (process_number, resource_data["id"]))
+                        logger.warning('[Worker %d] Could not compute AST for %d', process_number, resource_data["id"])
+                        metrics.inc("orm_failures_total", type="parse")
                         enqueue_result({"codeset": None, "resource_id": resource_data["id"]})
                         continue
             compute_codesets(resource_data, ast_data, process_number)
+            metrics.inc("orm_resources_processed_total", stage="codesets")
 
 
 if __name__ == '__main__':
@@ -436,6 +443,7 @@ if __name__ == '__main__':
     v = args.verbose
     if verbose[str(v)]:
         logger.setLevel(verbose[str(v)])
+    log_writer.start()
 
     # If thread parameter is auto get the (total-1) or the available CPU's, whichever is smaller
     logger.info("[Main process] Calculating workers...")
@@ -450,7 +458,7 @@ if __name__ == '__main__':
             threads = cpu - 1
         else:
             threads = available_cpu
-    logger.info("[Main process] Workers to run: %d " % threads)
+    logger.info("[Main process] Workers to run: %d ", threads)
 
     work_queue = Queue()
     result_queue = Queue(maxsize=99999)
@@ -458,12 +466,18 @@ if __name__ == '__main__':
     result_queue_lock = Lock()
     parent_pipe, child_pipe = Pipe()
     last_resource_id = start - 1
+    if args.metrics_port:
+        metrics.setup(int(threads/3) * 3)
 
     # Create and call the workers
     logger.debug("[Main process] Spawning new workers...")
-    with Pool(processes=int(threads/3) * 2) as pool, Pool(processes=int(threads/3)) as data_pool:
+    with Pool(processes=int(threads/3) * 2, initializer=metrics.claim_slot) as pool, \
+            Pool(processes=int(threads/3), initializer=metrics.claim_slot) as data_pool:
         dp = data_pool.map_async(db_work, [i for i in range(int(threads/3))])
         p = pool.map_async(work, [i for i in range(int(threads/3) * 2)])
+        if args.metrics_port:
+            metrics.serve(args.metrics_port, [metrics.queue_depth(resources=work_queue, codesets=result_queue),
+                                              metrics.worker_memory])
 
         # Restore signal on main thread
         signal.signal(signal.SIGINT, original_sigint_handler)
@@ -473,13 +487,15 @@ if __name__ == '__main__':
                     database = Db()
                     for rid in resource_list.readlines():
                         rid = int(rid.replace("\n", "").replace("\r", ""))
-                        results = database.custom("SELECT type, file FROM resource WHERE id = %d" % rid)
+                        results = database.custom("SELECT hash, type, file, file_store, codec FROM resource WHERE id = %d" % rid)
                         if len(results) > 0:
                             ts, sc = print_remaining(ts, sc, "Enqueuing %s with id %d" % (result["type"], rid))
                             # Initialize job queue
                             result = results[0]
                             work_queue_lock.acquire()
-                            work_queue.put({"id": rid, "type": result["type"], "file": result["file"]})
+                            work_queue.put({"id": rid, "hash": result["hash"], "type": result["type"],
+                                            "file": result["file"], "file_store": result["file_store"],
+                                            "codec": result["codec"]})
                             work_queue_lock.release()
                     print("\n")
                 while True:
@@ -495,7 +511,7 @@ if __name__ == '__main__':
                     if qsize < (2 * threads):
                         logger.debug("[Main process] Getting work")
                         database = Db()
-                        rq = 'SELECT id, type, file FROM resource WHERE split = 0 AND size > 0 '
+                        rq = 'SELECT id, hash, type, file, file_store, codec FROM resource WHERE split = 0 AND size > 0 '
                         rq += ' AND type IN ("frame", "script")'
                         rq += ' AND id > %d' % last_resource_id
                         if end > 0:
@@ -510,7 +526,7 @@ if __name__ == '__main__':
                             logger.debug("[Main process] Enqueuing work")
                             work_queue_lock.acquire()
                             for result in results:
-                                work_queue.put({"id": result["id"], "type": result["type"], "file": result["file"]})
+                                work_queue.put(result)
                             work_queue_lock.release()
                         elif work_queue.empty():
                             end = 0
@@ -9,6 +9,85 @@ PROJECT_DIR = abspath(dirname(__file__))
 ALEXA_FILE_PATH = join(PROJECT_DIR, '../assets/alexa/top-1m.csv.zip')
 FONT_FILE_PATH = join(PROJECT_DIR, '../assets/fonts/fonts.txt')
 GEOCITY_FILE_PATH = join(PROJECT_DIR, '../assets/geolocation/GeoLite2-City.mmdb')
+# Extracted from the newest GeoLite2-ASN_*.tar.gz of the folder if it does not exist
+GEOASN_FILE_PATH = join(PROJECT_DIR, '../assets/geolocation/GeoLite2-ASN.mmdb')
+# Located IP addresses remembered by each process
+GEOLOCATION_CACHE_SIZE = 50000
+# Public suffix list snapshot used to get the base domains (never downloaded while crawling)
+PUBLIC_SUFFIX_FILE_PATH = join(PROJECT_DIR, '../assets/publicsuffix/public_suffix_list_tldextract-4.0.0.dat')
+# Host names whose base domain is remembered by each process
+DOMAIN_CACHE_SIZE = 2 ** 16
+
+
+# Screenshot options. Formats: "png", "webp" or "jpeg" (Pillow is needed to re-encode, scale and hash them)
+SCREENSHOT_FORMAT = 'webp'
+SCREENSHOT_QUALITY = 80
+SCREENSHOT_SCALE = 0.5
+# Maximum perceptual hash distance to consider a screenshot unchanged since the last crawl
+SCREENSHOT_HASH_THRESHOLD = 4
+
+# Resource downloads: parallel downloads per process and maximum connections kept per host
+DOWNLOAD_THREADS = 8
+DOWNLOAD_HOST_CONNECTIONS = 4
+# Compressed bytes of each download kept in memory before spilling them to the temporary folder
+DOWNLOAD_SPOOL_SIZE = 2 * 2 ** 20
+
+# DNS cache: seconds to keep the addresses (maximum if dnspython gives the record TTL) and the unresolved names
+DNS_TTL = 300
+DNS_NEGATIVE_TTL = 60
+# Maximum names kept in the DNS cache of each process (the least recently stored are dropped first)
+DNS_CACHE_SIZE = 100000
+# DNS lookups: timeout (seconds), retries of the temporary failures (backoff doubled each time) and concurrency
+DNS_TIMEOUT = 5
+DNS_RETRIES = 3
+DNS_BACKOFF = 0.5
+DNS_CONCURRENCY = 50
+
+# JSON library used to parse the browser requests: "json" or "orjson" (faster, requires orjson)
+JSON_BACKEND = 'json'
+
+# Worker autoscaling (ORM.py --autoscale): seconds between the checks of the system load and between two changes
+AUTOSCALE_INTERVAL = 10
+AUTOSCALE_COOLDOWN = 60
+# Used memory (%) pausing the intake of domains and retiring workers, CPU usage (%) retiring and adding workers
+AUTOSCALE_MEMORY_HIGH = 85
+AUTOSCALE_MEMORY_CRITICAL = 92
+AUTOSCALE_CPU_HIGH = 90
+AUTOSCALE_CPU_LOW = 60
+# Memory of a worker with its browsers (bytes) that makes it be replaced by a fresh one
+AUTOSCALE_WORKER_RSS_LIMIT = 3 * 2 ** 30
+
+# Seconds a worker may spend visiting a domain with a plugin (all tries included) before being killed by the watchdog
+WATCHDOG_VISIT_BUDGET = 900
+
+# Seconds the watchdog waits for the lock of the work queue before killing a worker (retried on the next check)
+WATCHDOG_LOCK_TIMEOUT = 10
+
+# Seconds ORM.py waits on SIGINT/SIGTERM for the workers to finish their current domain before killing them
+SHUTDOWN_TIMEOUT = 300
+
+# Logging: warnings and errors with the same message let through by each process every period (seconds, 0 for all)
+LOG_RATE_PERIOD = 60
+LOG_RATE_BURST = 10
+
+# Certificates remembered by each process to skip their database checks
+CERTIFICATE_CACHE_SIZE = 10000
+
+# Blob store for resource files, certificates and screenshots: None (inside the database), "local" or "s3"
+BLOB_STORE = None
+BLOB_STORE_PATH = join(PROJECT_DIR, '../blobs')
+# S3 compatible store (e.g. a local MinIO server)
+S3_ENDPOINT = 'http://localhost:9000'
+S3_BUCKET = 'orm'
+S3_ACCESS_KEY = 'XXXaccess_keyXXX'
+S3_SECRET_KEY = 'XXXsecret_keyXXX'
+
+# Codec used to compress the new resource files: "zlib" or "zstd" (requires zstandard)
+RESOURCE_CODEC = 'zlib'
+ZSTD_LEVEL = 10
+# Id of the trained zstd dictionary (see codec_trainer.py) or None to compress without dictionary
+ZSTD_DICTIONARY = None
+ZSTD_DICTIONARY_PATH = join(PROJECT_DIR, '../assets/zstd')
 
 
 #MYSQL_HOST = 'XXXdatabaseXXX'
@@ -20,185 +20,141 @@
 
 # Basic modules
 import os
-import json
+import base64
 import logging
 import logging.config
 import zlib
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 3rd party modules
 import requests
+import requests.adapters
 from asn1crypto import pem
 
 # Own modules
 from db_manager import Db, Connector
+from blob_storage import store_blob, has_blob, load_blob
+from codec import compress, compressor, default_codec
+from request_record import RequestRecord, json_dumps
 from tracking_manager import check_tracking
-from utils import download_file, hash_file, lsh_file, hash_string, utc_now
-from utils import certificate_to_json, extract_location, clean_subdomain
+from tracing import span, record, now
+import metrics
+from utils import download_file, lsh_bytes, hash_string, hash_bytes, utc_now, BloomFilter, StreamDigest, LRUCache
+from utils import der_certificate_to_json, extract_location, clean_subdomain, response_validators
+
+import config
 
 logging.config.fileConfig('logging.conf')
 
 logger = logging.getLogger("DATA_MANAGER")
 
+# HTTP session and download threads of the process (created on first use)
+http_session = None
+http_session_pid = None
+download_executor = None
+download_executor_pid = None
+# Ingestion options (set before creating the workers)
+ingest_options = {"batch": False}
+# Ids of the certificates already stored (by hash) found by the process
+known_certificates = LRUCache(config.CERTIFICATE_CACHE_SIZE)
+# Filter of the resource hashes with stored content shared by all the workers (created before forking them)
+known_filter = None
+
+
+def manage_requests(db, process, domain, request_list, plugin, temp_folder, geo_db, archive=None):
+    """ Inserts the URL data if non-existent and downloads resources if needed.
+
+    The request list contains the request records of the visit (see request_record.parse_requests). The downloads
+    are recorded into (or replayed from) the visit archive if given. """
 
-def manage_requests(db, process, domain, request_list, plugin, temp_folder, geo_db):
-    """ Inserts the URL data if non-existent and downloads resources if needed """
+    if ingest_options["batch"]:
+        return manage_requests_batch(db, process, domain, request_list, plugin, temp_folder, geo_db, archive)
 
     t = utc_now()
 
-    # Clean malformed URL info groups
-    # TODO: Check the reason for the malformed ones
-    keys_to_delete = []
-    for key in request_list.keys():
-        elem = json.loads(request_list[key])
-        if not isinstance(elem, dict) or "requestId" not in elem.keys():
-            keys_to_delete.append(key)
-            logger.info("(proc. %s) : URL details not present - %s" % (process, key))
-    for key in keys_to_delete:
-        request_list.pop(key)
-
-    url_dict = []
-    # Insert certificates info
-    for url_string in request_list.keys():
-        url_info = json.loads(request_list[url_string])
-        if "security_info" not in url_info.keys():
-            url_dict.append(url_info)
-            continue
-        security_info = url_info["security_info"]
-        if "certificates" in security_info.keys() and len(security_info["certificates"]) > 0:
-            der_certificate = ''.join(format(x, '02x') for x in security_info["certificates"][0]["rawDER"])
-            certificate_hash = hash_string(der_certificate)
-            certificate = Connector(db, "certificate")
-            if not certificate.load(certificate_hash):
-                pem_bytes = pem.armor('CERTIFICATE', bytes.fromhex(der_certificate))
-                certificate.values["file"] = zlib.compress(pem_bytes)
-                os.makedirs(temp_folder, exist_ok=True)
-                with open(os.path.join(temp_folder, domain.values["name"] + ".pem"), "bw") as f:
-                    f.write(pem_bytes)
-                certificate_json = certificate_to_json(os.path.join(temp_folder, domain.values["name"] + ".pem"))
-                os.remove(os.path.join(temp_folder, domain.values["name"] + ".pem"))
-                certificate.values["json"] = json.dumps(certificate_json)
-                if not certificate.save():
-                    certificate.load(certificate_hash)
-            security_info.pop("certificates")
-            url_info["certificate"] = certificate.values["id"]
-        url_info["security_info"] = security_info
-        url_dict.append(url_info)
+    downloads = {}
+    with span("certificates"):
+        store_certificates(db, request_list)
+    urls_start = now()
+
+    # Check at once which resources of the visit already have their content stored
+    stored = stored_resources(db, [elem.hash for elem in request_list if elem.hash is not None])
+    archive_stored(db, archive, stored)
+    touched = {}
 
     # Insert URL info
     # We sort them by request id and timestamp to link parent urls with child ones
-    for elem in sorted(url_dict, key=lambda i: (int(i["requestId"]), int(i["timeStamp"]))):
+    for elem in sorted(request_list, key=RequestRecord.sort_key):
         url = Connector(db, "url")
         # If not previously seen URL insert it
-        if not url.load(hash_string(elem["url"])):
-            url.values["url"] = elem["url"]
-            url.values["method"] = elem["method"]
-            url.values["type"] = elem["type"]
-            lvl2_domain = clean_subdomain(elem["url"])
+        if not url.load(hash_string(elem.url)):
+            lvl2_domain = clean_subdomain(elem.url)
             host = Connector(db, "host")
             if not host.load(hash_string(lvl2_domain)):
                 host.values["name"] = lvl2_domain
                 host.values["update_timestamp"] = t
                 if not host.save():
                     host.load(hash_string(lvl2_domain))
-            url.values["host_id"] = host.values["id"]
-            if elem["blocked"]:
-                url.values["blocked"] = 1
-            if "from_cache" in elem.keys():
-                url.values["from_cache"] = elem["from_cache"]
-            if not url.values["from_cache"] and "server_ip" in elem.keys():
-                url.values["server_ip"] = elem["server_ip"]
-                location = extract_location(url.values["server_ip"], geo_db)
-                if location["is_EU"]:
-                    url.values["is_EU"] = 1
-                url.values["country_code"] = location["country_code"]
-            if "request_headers" in elem.keys():
-                url.values["request_headers"] = json.dumps(elem["request_headers"])
             content_type = Connector(db, "mime_type")
-            if "response_headers" in elem.keys():
-                url.values["response_headers"] = json.dumps(elem["response_headers"])
-                if "content-type" in elem["response_headers"]:
-                    if not content_type.load(hash_string(elem["response_headers"]["content-type"].split(";")[0])):
-                        content_type.values["name"] = elem["response_headers"]["content-type"].split(";")[0]
-                        if not content_type.save():
-                            content_type.load(hash_string(elem["response_headers"]["content-type"].split(";")[0]))
-                else:
-                    content_type.load(hash_string("unknown"))
+            if content_type_name(elem) != "unknown":
+                if not content_type.load(hash_string(content_type_name(elem))):
+                    content_type.values["name"] = content_type_name(elem)
+                    if not content_type.save():
+                        content_type.load(hash_string(content_type_name(elem)))
             else:
                 content_type.load(hash_string("unknown"))
-            url.values["mime_type_id"] = content_type.values["id"]
-            # Link the certificate
-            if "security_info" in elem.keys():
-                url.values["security_info"] = json.dumps(elem["security_info"])
-            if "certificate" in elem.keys():
-                url.values["certificate_id"] = elem["certificate"]
+            url.values.update(url_values(elem, host.values["id"], content_type.values["id"], geo_db, t))
             # Create the resource element if needed and link it
-            if "hash" in elem.keys():
+            if elem.hash is not None and elem.hash in stored.keys():
+                url.values["resource_id"] = stored[elem.hash]
+            elif elem.hash is not None:
                 resource = Connector(db, "resource")
-                if not resource.load(elem["hash"]):
-                    if elem["blocked"]:
+                if not resource.load(elem.hash):
+                    if elem.blocked:
                         resource.values["is_tracking"] = 1
                     resource.values["insert_date"] = t
                     resource.values["update_timestamp"] = t
                     if not resource.save():
-                        resource.load(elem["hash"])
+                        resource.load(elem.hash)
                 url.values["resource_id"] = resource.values["id"]
-            url.values["insert_date"] = t
-            url.values["update_timestamp"] = t
             if not url.save():
                 # Wait until the other thread saves the URL inside the database (or 10s max)
                 seconds = 30
-                while not url.load(elem["hash"]) and seconds > 0:
+                while not url.load(elem.hash) and seconds > 0:
                     seconds -= 1
                     time.sleep(1)
         else:
-            # I URL has already been found update the timestamp
+            # I URL has already been found update the timestamp and the cache validators
             url.values["update_timestamp"] = t
+            if elem.response_headers is not None:
+                url.values.update(response_validators(elem.response_headers))
             url.save()
         # Depending on the resource type download it if needed
         content_type = Connector(db, "mime_type")
         content_type.load(url.values["mime_type_id"])
-        if content_type.values["download"]:
+        stored_id = stored.get(elem.hash)
+        if content_type.values["download"] and stored_id and url.values["resource_id"] in (None, stored_id):
+            # Known content: refresh the resource later without loading (or downloading) its file
+            touched[stored_id] = touched.get(stored_id, False) or bool(elem.blocked)
+        elif content_type.values["download"]:
             resource = Connector(db, "resource")
-            if url.values["resource_id"] or "hash" in elem.keys():
+            if url.values["resource_id"] or elem.hash is not None:
                 if url.values["resource_id"]:
                     resource.load(url.values["resource_id"])
-                elif "hash" in elem.keys():
-                    if not resource.load(elem["hash"]):
-                        if elem["blocked"]:
+                elif elem.hash is not None:
+                    if not resource.load(elem.hash):
+                        if elem.blocked:
                             resource.values["is_tracking"] = 1
                         resource.values["insert_date"] = t
                         resource.values["update_timestamp"] = t
                         if not resource.save():
-                            resource.load(elem["hash"])
+                            resource.load(elem.hash)
                         url.values["resource_id"] = resource.values["id"]
                         url.save()
-                resource.values["update_timestamp"] = t
-                resource.values["pending_update"] = 1
-                if elem["blocked"]:
-                    resource.values["is_tracking"] = 1
-                if resource.values["hash"] and not resource.values["file"]:
-                    os.makedirs(os.path.join(os.path.abspath("."), temp_folder), exist_ok=True)
-                    filename = os.path.join(temp_folder, domain.values["name"] + '.tmp')
-                    if download_url(process, url.values["url"], filename):
-                        size = os.stat(filename).st_size
-                        # Compress the code
-                        with open(filename, 'rb') as f:
-                            code = f.read()
-                        compressed_code = zlib.compress(code)
-                        resource.values["file"] = compressed_code
-                        resource.values["size"] = size
-                        # Compute the fuzzy hash
-                        resource.values["fuzzy_hash"] = lsh_file(filename)
-                        os.remove(filename)
-                    else:
-                        logger.error("(proc. %s) Error #1: Resource not correctly saved - %s" % (process, elem["url"]))
-                if not resource.save():
-                    # Wait until the other thread saves the file inside the database (or 30s max)
-                    seconds = 30
-                    while not resource.load(elem["hash"]) and seconds > 0:
-                        seconds -= 1
-                        time.sleep(1)
+                update_resource(process, resource, elem, url.values["url"], downloads, t)
                 # Update the most probable type of the resource:
                 # --- Different URLs pointing to the same resource can mark it as different types.
                 # --- We set the most prevalent one
@@ -210,11 +166,11 @@ def manage_requests(db, process, domain, request_list, plugin, temp_folder, geo_
 
         # Insert the relation between the domain and the URL (including the HTML frame that called it)
         initiator_id = None
-        if "originUrl" in elem.keys():
+        if elem.origin_url is not None:
             initiator_frame = Connector(db, "url")
-            initiator_frame.load(hash_string(elem["originUrl"]))
+            initiator_frame.load(hash_string(elem.origin_url))
             initiator_id = initiator_frame.values["id"]
-        domain.add_double(url, plugin, {"third_party": elem["thirdParty"],
+        domain.add_double(url, plugin, {"third_party": elem.third_party,
                                         "initiator_frame": initiator_id,
                                         "insert_date": t,
                                         "update_timestamp": t})
@@ -223,28 +179,584 @@ def manage_requests(db, process, domain, request_list, plugin, temp_folder, geo_
         ## Temporarily disabled as it is used onyl for eprivo.eu but not for research purposes
         ## Uncomment next line to enable it
         #check_tracking(url, domain)
+
+    record("urls", urls_start, requests=len(request_list))
+    with span("resources", resources=len(downloads)):
+        store_resources(db, process, downloads, touched, temp_folder, t, archive)
     domain.save()
 
 
-def download_url(process, url, filename):
-    """ Downloads the given url into the given filename. """
+def manage_requests_batch(db, process, domain, request_list, plugin, temp_folder, geo_db, archive=None):
+    """ Same as manage_requests but resolving all the URLs of the visit at once: the existing rows of each table
+    are loaded with a few 'IN' requests and the missing ones inserted with multi-row requests. """
 
-    with open(filename, 'wb') as f:
-        try:
-            f, headers = download_file(url=url, destination=f)
-        except requests.exceptions.SSLError:
+    t = utc_now()
+
+    downloads = {}
+    touched = {}
+    with span("certificates"):
+        store_certificates(db, request_list)
+    urls_start = now()
+
+    # A record per URL, parent urls first
+    records = {}
+    for elem in sorted(request_list, key=RequestRecord.sort_key):
+        records.setdefault(hash_string(elem.url), elem)
+    url_fields = ["id", "hash", "url", "resource_id", "mime_type_id", "etag", "last_modified"]
+    urls = {row["hash"]: row for row in db.select_in("url", url_fields, "hash", records.keys())}
+    new_urls = {url_hash: elem for url_hash, elem in records.items() if url_hash not in urls.keys()}
+
+    # Hosts and mime types of the new URLs
+    host_names = {url_hash: clean_subdomain(elem.url) for url_hash, elem in new_urls.items()}
+    hosts = resolve_rows(db, "host", {hash_string(name): {"name": name, "update_timestamp": t}
+                                      for name in host_names.values()})
+    mime_names = {url_hash: content_type_name(elem) for url_hash, elem in new_urls.items()}
+    mime_types = resolve_rows(db, "mime_type", {hash_string(name): {"name": name} for name in mime_names.values()})
+
+    # Resources of the new URLs
+    resource_rows = {}
+    for elem in new_urls.values():
+        if elem.hash is not None:
+            resource_rows.setdefault(elem.hash, {"insert_date": t, "update_timestamp": t})
+            if elem.blocked:
+                resource_rows[elem.hash]["is_tracking"] = 1
+    resources = resolve_rows(db, "resource", resource_rows)
+
+    # Insert the new URLs
+    url_rows = {}
+    for url_hash, elem in new_urls.items():
+        url_rows[url_hash] = url_values(elem, hosts[hash_string(host_names[url_hash])]["id"],
+                                        mime_types[hash_string(mime_names[url_hash])]["id"], geo_db, t)
+        url_rows[url_hash]["resource_id"] = resources.get(elem.hash, {}).get("id")
+    urls.update(resolve_rows(db, "url", url_rows, fields=url_fields[2:]))
+    for url_hash in [url_hash for url_hash in records.keys() if url_hash not in urls.keys()]:
+        logger.error("(proc. %s) URL not correctly saved - %s", process, records.pop(url_hash).url)
+
+    # Update the timestamp of the known URLs (and the validators that changed)
+    known_urls = [url_hash for url_hash in records.keys() if url_hash not in new_urls.keys()]
+    if known_urls:
+        rq = "UPDATE url SET update_timestamp = %%s WHERE id IN (%s)" % ", ".join(["%s"] * len(known_urls))
+        db.custom(rq, values=[t] + [urls[url_hash]["id"] for url_hash in known_urls])
+    for url_hash in known_urls:
+        if records[url_hash].response_headers is None:
+            continue
+        validators = response_validators(records[url_hash].response_headers)
+        if validators["etag"] != urls[url_hash]["etag"] or \
+                validators["last_modified"] != urls[url_hash]["last_modified"]:
+            db.custom("UPDATE url SET etag = %s, last_modified = %s WHERE id = %s",
+                      values=[validators["etag"], validators["last_modified"], urls[url_hash]["id"]])
+
+    # Resources of the downloadable types: only the ones without stored content are loaded
+    mime_ids = set(row["mime_type_id"] for row in urls.values() if row["hash"] in records.keys())
+    download_types = set(row["id"] for row in db.select_in("mime_type", ["id", "download"], "id", mime_ids)
+                         if row["download"])
+    stored = stored_resources(db, [elem.hash for url_hash, elem in records.items()
+                                   if elem.hash is not None and urls[url_hash]["mime_type_id"] in download_types])
+    stored_ids = set(stored.values())
+    archive_stored(db, archive, stored)
+    for url_hash, elem in records.items():
+        url_row = urls[url_hash]
+        if url_row["mime_type_id"] not in download_types or (not url_row["resource_id"] and elem.hash is None):
+            continue
+        if url_row["resource_id"] in stored_ids or (not url_row["resource_id"] and elem.hash in stored.keys()):
+            resource_id = url_row["resource_id"] or stored[elem.hash]
+            touched[resource_id] = touched.get(resource_id, False) or bool(elem.blocked)
+            continue
+        resource = Connector(db, "resource")
+        if url_row["resource_id"]:
+            resource.load(url_row["resource_id"])
+        elif not resource.load(elem.hash):
+            if elem.blocked:
+                resource.values["is_tracking"] = 1
+            resource.values["insert_date"] = t
+            resource.values["update_timestamp"] = t
+            save_resource(resource)
+            db.custom("UPDATE url SET resource_id = %s WHERE id = %s", values=[resource.values["id"], url_row["id"]])
+        update_resource(process, resource, elem, url_row["url"], downloads, t)
+
+    # Insert the relations between the domain and the URLs (including the HTML frames that called them)
+    origin_hashes = set(hash_string(elem.origin_url) for elem in records.values() if elem.origin_url is not None)
+    frames = {row["hash"]: row["id"] for row in db.select_in("url", ["id", "hash"], "hash",
+                                                             origin_hashes - set(urls.keys()))}
+    frames.update({url_hash: row["id"] for url_hash, row in urls.items()})
+    relation_fields = ["id", "url_id", "third_party", "initiator_frame"]
+    relations = {row["url_id"]: row for row in db.select_in("domain_url", relation_fields, "url_id",
+                                                           [urls[url_hash]["id"] for url_hash in records.keys()],
+                                                           conditions={"domain_id": domain.values["id"],
+                                                                       "plugin_id": plugin.values["id"]})}
+    new_relations = []
+    for url_hash, elem in records.items():
+        initiator_id = frames.get(hash_string(elem.origin_url)) if elem.origin_url is not None else None
+        relation = relations.get(urls[url_hash]["id"])
+        if relation is None:
+            row = db.defaults("domain_url")
+            row.pop("id", None)
+            row.update({"domain_id": domain.values["id"], "url_id": urls[url_hash]["id"],
+                        "plugin_id": plugin.values["id"], "third_party": elem.third_party,
+                        "initiator_frame": initiator_id, "insert_date": t, "update_timestamp": t})
+            new_relations.append(row)
+        elif relation["third_party"] != int(bool(elem.third_party)) or relation["initiator_frame"] != initiator_id:
+            db.custom("UPDATE domain_url SET third_party = %s, initiator_frame = %s WHERE id = %s",
+                      values=[elem.third_party, initiator_id, relation["id"]])
+    db.insert_many("domain_url", new_relations)
+    if relations:
+        rq = "UPDATE domain_url SET update_timestamp = %%s WHERE id IN (%s)" % ", ".join(["%s"] * len(relations))
+        db.custom(rq, values=[t] + [relation["id"] for relation in relations.values()])
+
+    record("urls", urls_start, requests=len(request_list))
+    with span("resources", resources=len(downloads)):
+        store_resources(db, process, downloads, touched, temp_folder, t, archive)
+    domain.save()
+
+
+def resolve_rows(db, table, rows, fields=None):
+    """ Returns the rows of the table (hash -> id and the given fields) with the given hashes, inserting the missing
+    ones with the given values (hash -> column values) in a single request. """
+
+    if fields is None:
+        fields = []
+    found = {row["hash"]: row for row in db.select_in(table, ["id", "hash"] + fields, "hash", rows.keys())}
+    missing = []
+    for row_hash, values in rows.items():
+        if row_hash not in found.keys():
+            row = db.defaults(table)
+            row.pop("id", None)
+            row.update(values)
+            row["hash"] = row_hash
+            missing.append(row)
+    if missing:
+        # Rows inserted meanwhile by other processes are left as they are
+        db.insert_many(table, missing)
+        found.update({row["hash"]: row for row in db.select_in(table, ["id", "hash"] + fields, "hash",
+                                                               [row["hash"] for row in missing])})
+    return found
+
+
+def content_type_name(elem):
+    """ Returns the mime type of the request response ('unknown' if not present). """
+
+    if elem.response_headers is not None and "content-type" in elem.response_headers:
+        return elem.response_headers["content-type"].split(";")[0]
+    return "unknown"
+
+
+def url_values(elem, host_id, mime_type_id, geo_db, t):
+    """ Returns the column values of a new URL. """
+
+    values = {"url": elem.url, "method": elem.method, "type": elem.type, "host_id": host_id,
+              "mime_type_id": mime_type_id, "insert_date": t, "update_timestamp": t}
+    if elem.blocked:
+        values["blocked"] = 1
+    if elem.from_cache is not None:
+        values["from_cache"] = elem.from_cache
+    if not values.get("from_cache") and elem.server_ip is not None:
+        values["server_ip"] = elem.server_ip
+        location = extract_location(values["server_ip"], geo_db)
+        if location["is_EU"]:
+            values["is_EU"] = 1
+        values["country_code"] = location["country_code"]
+        values["asn"] = location["asn"]
+        values["as_organization"] = location["as_organization"]
+    if elem.request_headers is not None:
+        values["request_headers"] = json_dumps(elem.request_headers)
+    if elem.response_headers is not None:
+        values["response_headers"] = json_dumps(elem.response_headers)
+        values.update(response_validators(elem.response_headers))
+    # Link the certificate
+    if elem.security_info is not None:
+        values["security_info"] = json_dumps(elem.security_info)
+    if elem.certificate is not None:
+        values["certificate_id"] = elem.certificate
+    return values
+
+
+def store_certificates(db, request_list):
+    """ Inserts the certificates of the requests if non-existent, linking them to the requests. """
+
+    for elem in request_list:
+        if elem.security_info is None:
+            continue
+        security_info = elem.security_info
+        if "certificates" in security_info.keys() and len(security_info["certificates"]) > 0:
+            der_certificate = bytes(security_info["certificates"][0]["rawDER"])
+            certificate_hash = hash_string(der_certificate.hex())
+            # The same certificates (e.g. CDNs) are found in many URLs, so remember the ones already stored
+            certificate_id = known_certificates.get(certificate_hash)
+            if certificate_id is None:
+                certificate = Connector(db, "certificate")
+                if not certificate.load(certificate_hash):
+                    pem_bytes = pem.armor('CERTIFICATE', der_certificate)
+                    certificate.values["file"] = zlib.compress(pem_bytes)
+                    store_blob("certificate", certificate.values)
+                    certificate.values["json"] = json_dumps(der_certificate_to_json(der_certificate))
+                    if not certificate.save():
+                        certificate.load(certificate_hash)
+                certificate_id = certificate.values["id"]
+                if certificate_id:
+                    known_certificates.put(certificate_hash, certificate_id)
+            security_info.pop("certificates")
+            elem.certificate = certificate_id
+
+
+def update_resource(process, resource, elem, url_string, downloads, t):
+    """ Refreshes a resource found in the visit storing its content if missing: the body captured by the browser
+    when possible or otherwise adding it to the downloads (hash -> [resource, url list]) of the visit. """
+
+    resource.values["update_timestamp"] = t
+    resource.values["pending_update"] = 1
+    if elem.blocked:
+        resource.values["is_tracking"] = 1
+    body = None
+    if resource.values["hash"] and not has_blob("resource", resource.values):
+        # Use the response body captured by the browser instead of downloading it again when possible
+        body = captured_body(process, elem, resource.values["hash"])
+    if body is not None:
+        store_file(resource, body)
+        save_resource(resource)
+    elif resource.values["hash"] and not has_blob("resource", resource.values):
+        # Download it later in parallel with the rest of new resources of the visit
+        if resource.values["hash"] not in downloads.keys():
+            downloads[resource.values["hash"]] = [resource, []]
+        downloads[resource.values["hash"]][1].append(url_string)
+    else:
+        save_resource(resource)
+
+
+def store_resources(db, process, downloads, touched, temp_folder, t, archive=None):
+    """ Downloads the new resources of the visit in parallel and refreshes the known ones. """
+
+    for resource, digest in download_resources(process, list(downloads.values()), temp_folder, archive):
+        if digest:
+            if digest.hexdigest() != resource.values["hash"]:
+                logger.debug("(proc. %s) Downloaded content differs from the browser one - %s", process,
+                             downloads[resource.values["hash"]][1][0])
+            store_digest(resource, digest, archive)
+        else:
+            url_string = downloads[resource.values["hash"]][1][0]
+            logger.error("(proc. %s) Error #1: Resource not correctly saved - %s", process, url_string)
+        save_resource(resource)
+    touch_resources(db, touched, t)
+
+
+def seed_known_filter(db, capacity, batch=100000):
+    """ Creates the shared filter of known resources with the hashes of the resources already stored. """
+
+    global known_filter
+    known_filter = BloomFilter(capacity)
+    last_id = 0
+    total = 0
+    while True:
+        rq = "SELECT id, hash FROM resource WHERE id > %s AND (file IS NOT NULL OR file_store IS NOT NULL)"
+        rq += " ORDER BY id LIMIT %s"
+        results = db.custom(rq, values=[last_id, batch])
+        if not results:
+            break
+        for row in results:
+            known_filter.add(row["hash"])
+        last_id = results[-1]["id"]
+        total += len(results)
+    if total > capacity:
+        logger.warning("%d known resources exceed the filter capacity (%d)", total, capacity)
+    return total
+
+
+def stored_resources(db, hashes, chunk=500):
+    """ Returns the id of the given resource hashes whose content is already stored (hash -> id).
+
+    With the known resources filter the hashes not found inside it are new content and are not checked in the
+    database. Otherwise all of them are checked in batches. """
+
+    hashes = list(set(hashes))
+    if known_filter is not None:
+        hashes = [resource_hash for resource_hash in hashes if resource_hash in known_filter]
+    stored = {}
+    for index in range(0, len(hashes), chunk):
+        values = hashes[index:index + chunk]
+        rq = "SELECT id, hash FROM resource WHERE hash IN (%s)" % ", ".join(["%s"] * len(values))
+        rq += " AND (file IS NOT NULL OR file_store IS NOT NULL)"
+        for row in db.custom(rq, values=values):
+            stored[row["hash"]] = row["id"]
+    return stored
+
+
+def archive_stored(db, archive, stored):
+    """ Records the stored files of the known resources of the visit (hash -> id) into the visit archive being
+    recorded, so the visit can also be replayed into a database without them. """
+
+    if archive is None or archive.replaying or not stored:
+        return
+    for row in db.select_in("resource", ["hash", "file", "file_store", "codec"], "id", set(stored.values())):
+        data = load_blob("resource", row)
+        if data is not None:
+            archive.add_body(row["hash"], data, row["codec"])
+
+
+def touch_resources(db, resources, timestamp):
+    """ Refreshes the known resources of a visit (id -> found as tracking) with a request per tracking state. """
+
+    for tracking in [False, True]:
+        ids = [str(resource_id) for resource_id, blocked in resources.items() if blocked == tracking]
+        if not ids:
+            continue
+        rq = "UPDATE resource SET update_timestamp = %s, pending_update = 1"
+        if tracking:
+            rq += ", is_tracking = 1"
+        rq += " WHERE id IN (%s)" % ", ".join(ids)
+        db.custom(rq, values=[timestamp])
+
+
+def captured_body(process, elem, resource_hash):
+    """ Returns the response body captured by the browser for the request if it matches the resource hash. """
+
+    if elem.body is None:
+        return None
+    try:
+        body = base64.b64decode(elem.body)
+    except (ValueError, TypeError):
+        logger.warning("(proc. %s) Malformed captured body - %s", process, elem.url)
+        return None
+    if hash_bytes(body) != resource_hash:
+        logger.warning("(proc. %s) Captured body does not match the resource hash - %s", process, elem.url)
+        return None
+    return body
+
+
+def store_file(resource, code):
+    """ Stores the compressed code, its size and its fuzzy hash inside the resource. """
+
+    resource.values["file"], resource.values["codec"] = compress(code)
+    resource.values["size"] = len(code)
+    resource.values["fuzzy_hash"] = lsh_bytes(code)
+    store_blob("resource", resource.values)
+    if known_filter is not None:
+        known_filter.add(resource.values["hash"])
+    metrics.inc("orm_resources_processed_total", stage="store")
+
+
+def new_digest(temp_folder):
+    """ Returns an empty stream digest compressing with the configured codec. """
+
+    tag = default_codec()
+    return StreamDigest(lambda: compressor(tag), codec=tag, spool_size=config.DOWNLOAD_SPOOL_SIZE, folder=temp_folder)
+
+
+def store_digest(resource, digest, archive=None):
+    """ Stores the compressed code, its size and its fuzzy hash from the stream digest inside the resource (and
+    inside the visit archive being recorded if given). """
+
+    resource.values["file"] = digest.compressed()
+    resource.values["codec"] = digest.codec
+    if archive is not None and not archive.replaying:
+        archive.add_body(resource.values["hash"], resource.values["file"], digest.codec)
+    resource.values["size"] = digest.size
+    resource.values["fuzzy_hash"] = digest.lsh()
+    store_blob("resource", resource.values)
+    if known_filter is not None:
+        known_filter.add(resource.values["hash"])
+    metrics.inc("orm_resources_processed_total", stage="store")
+
+
+def save_resource(resource):
+    """ Saves the resource or waits until other process saves it inside the database (or 30s max). """
+
+    if not resource.save():
+        seconds = 30
+        while not resource.load(resource.values["hash"]) and seconds > 0:
+            seconds -= 1
+            time.sleep(1)
+
+
+def get_session():
+    """ Returns the HTTP session shared by all the downloads of the process.
+
+    The session keeps the connections alive between downloads and limits the connections opened per host. """
+
+    global http_session, http_session_pid
+    if http_session is None or http_session_pid != os.getpid():
+        http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=config.DOWNLOAD_HOST_CONNECTIONS,
+                                                pool_block=True)
+        http_session.mount("http://", adapter)
+        http_session.mount("https://", adapter)
+        http_session_pid = os.getpid()
+    return http_session
+
+
+def get_executor():
+    """ Returns the thread pool used to download resources in parallel (one per process). """
+
+    global download_executor, download_executor_pid
+    if download_executor is None or download_executor_pid != os.getpid():
+        download_executor = ThreadPoolExecutor(max_workers=config.DOWNLOAD_THREADS)
+        download_executor_pid = os.getpid()
+    return download_executor
+
+
+def download_resources(process, downloads, temp_folder, archive=None):
+    """ Downloads in parallel the given [resource, url list] pairs (or takes them from the replayed visit archive).
+
+    Yields (resource, digest) pairs as soon as each download finishes, where the digest is None if the resource
+    could not be downloaded (with status 200) from any of its urls. """
+
+    os.makedirs(os.path.join(os.path.abspath("."), temp_folder), exist_ok=True)
+
+    def download(resource, urls):
+        digest = new_digest(temp_folder)
+        if archive is not None and archive.replaying:
+            if archive.replay_body(resource.values["hash"], digest):
+                return resource, digest
+            urls = []
+        for url in urls:
+            result = download_url(process, url, digest)
+            if result and result[0] == 200:
+                return resource, digest
+            if result:
+                # Error pages are not the content of the resource
+                logger.warning("(proc. %s) Error #4: Status %d downloading %s", process, result[0], url)
+                metrics.inc("orm_failures_total", type="download")
+            digest.truncate()
+        digest.close()
+        return resource, None
+
+    executor = get_executor()
+    futures = [executor.submit(download, resource, urls) for resource, urls in downloads]
+    for future in as_completed(futures):
+        yield future.result()
+
+
+def ingest_visit(db, process, domain, request_list, plugin, temp_folder, geo_db, values, archive=None):
+    """ Stores the information of a visit and marks the domain as updated with the given values.
+
+    The visit is also saved into its archive once stored if an archive being recorded is given. """
+
+    start = now()
+    manage_requests(db, process, domain, request_list, plugin, temp_folder, geo_db, archive)
+    domain.values["update_timestamp"] = utc_now()
+    domain.values.update(values)
+    store_blob("domain", domain.values)
+    domain.save()
+    if archive is not None and not archive.replaying:
+        archive.save()
+    record("ingest", start, domain=domain.values["name"])
+
+
+class IngestPipeline(object):
+    """
+    Local pool of threads storing the information of the visited websites
+    while the browser is already visiting the next ones. The queue between
+    the browser and the threads is bounded, so the browser waits when the
+    ingestion falls behind (backpressure).
+    """
+
+    def __init__(self, process, temp_folder, geo_db, threads=2, size=4):
+        self.process = process
+        self.temp_folder = temp_folder
+        self.geo_db = geo_db
+        self.queue = queue.Queue(maxsize=size)
+        # Visits of each domain not stored yet and callbacks waiting for them to be stored
+        self.pending = {}
+        self.callbacks = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        for number in range(threads):
+            thread = threading.Thread(target=self.__work, args=(number,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, domain, plugin, request_list, values, archive=None):
+        """ Enqueues the visit information. Blocks while the queue is full. """
+
+        with self.lock:
+            self.pending[domain.values["id"]] = self.pending.get(domain.values["id"], 0) + 1
+        self.queue.put({"domain_id": domain.values["id"], "plugin_id": plugin.values["id"],
+                        "request_list": request_list, "values": values, "archive": archive})
+
+    def when_stored(self, domain_id, callback):
+        """ Calls 'callback(domain_id)' once the enqueued visits of the domain are stored (now if there are none). """
+
+        with self.lock:
+            if self.pending.get(domain_id):
+                self.callbacks[domain_id] = callback
+                return
+        callback(domain_id)
+
+    def __stored(self, domain_id):
+        with self.lock:
+            self.pending[domain_id] -= 1
+            if self.pending[domain_id] > 0:
+                return
+            del self.pending[domain_id]
+            callback = self.callbacks.pop(domain_id, None)
+        if callback:
+            callback(domain_id)
+
+    def join(self):
+        """ Waits until all the enqueued visits are stored. """
+
+        self.queue.join()
+
+    def close(self):
+        """ Stores the pending visits and stops the threads. """
+
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def __work(self, number):
+        """ Takes visits from the queue and stores them using its own database connection. """
+
+        db = Db()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
             try:
-                requests.packages.urllib3.disable_warnings()
-                f, headers = download_file(url=url, destination=f, verify=False)
+                domain = Connector(db, "domain")
+                domain.load(item["domain_id"])
+                plugin = Connector(db, "plugin")
+                plugin.load(item["plugin_id"])
+                ingest_visit(db, self.process, domain, item["request_list"], plugin, self.temp_folder, self.geo_db,
+                             item["values"], item["archive"])
             except Exception as e:
-                logger.error("(proc. %s) Error #1: %s" % (process, str(e)))
-                return False
-        except UnicodeError as e:
-            logger.error("(proc. %s) Error #2: Couldn't download url %s with error %s" % (process, url, str(e)))
-            return False
+                logger.error("(proc. %s) Ingest thread %d error: %s", self.process, number, e)
+            finally:
+                self.__stored(item["domain_id"])
+                self.queue.task_done()
+        db.close()
+
+
+def download_url(process, url, destination, headers=None):
+    """ Downloads the given url into the given destination, a file or a stream digest (sending the given request
+    headers if any).
+
+    Returns the status code and the response headers or False if the url could not be downloaded. """
+
+    session = get_session()
+    f = destination
+    try:
+        with span("download", category="resource", url=url):
+            f, response_headers, status = download_file(url=url, destination=f, headers=headers, session=session)
+    except requests.exceptions.SSLError:
+        try:
+            requests.packages.urllib3.disable_warnings()
+            f.seek(0)
+            f.truncate()
+            f, response_headers, status = download_file(url=url, destination=f, headers=headers, verify=False,
+                                                        session=session)
         except Exception as e:
-            logger.error("(proc. %s) Error #3: %s" % (process, str(e)))
+            logger.error("(proc. %s) Error #1: %s", process, e)
+            metrics.inc("orm_failures_total", type="download")
             return False
-    logger.debug("(proc. %s) Found external resource %s" % (process, url))
-    return True
+    except UnicodeError as e:
+        logger.error("(proc. %s) Error #2: Couldn't download url %s with error %s", process, url, e)
+        metrics.inc("orm_failures_total", type="download")
+        return False
+    except Exception as e:
+        logger.error("(proc. %s) Error #3: %s", process, e)
+        metrics.inc("orm_failures_total", type="download")
+        return False
+    logger.debug("(proc. %s) Found external resource %s", process, url)
+    return status, response_headers
 
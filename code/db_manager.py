@@ -78,6 +78,7 @@ import logging.config
 
 import config
 from utils import hash_string
+import metrics
 
 logging.config.fileConfig('logging.conf')
 logger = logging.getLogger("DB_MANAGER")
@@ -105,6 +106,7 @@ class Db(object):
         self.db = db
         self.conn = MySQLdb.connect(host=self.host, port=self.port, user=self.user, passwd=self.password, db=self.db,
                                     use_unicode=True, charset='utf8mb4')
+        self.table_defaults = {}
 
     def close(self):
         """ Closes the connection to the database. """
@@ -158,7 +160,7 @@ class Db(object):
         try:
             if values:
                 if log:
-                    logger.debug(request % tuple(values))
+                    logger.debug(request, *values)
                 cursor.execute(request, tuple(values))
             else:
                 if log:
@@ -166,10 +168,11 @@ class Db(object):
                 cursor.execute(request)
         except MySQLdb.Error as error:
             if values:
-                logger.error(request % tuple(values))
+                logger.error(request, *values)
             else:
                 logger.error(request)
-            logger.error("SQL ERROR: " + str(error) + "\n-----------------")
+            logger.error("SQL ERROR: %s\n-----------------", error)
+            metrics.inc("orm_failures_total", type="sql")
         else:
             for row in cursor.fetchall():
                 result = {}
@@ -179,7 +182,7 @@ class Db(object):
                         result[key] = None
                 results.append(result)
             if log:
-                logger.debug("REQUEST OK. Results: " + str(results) + "\n-----------------")
+                logger.debug("REQUEST OK. Results: %s\n-----------------", results)
         cursor.close()
         return results
 
@@ -214,16 +217,17 @@ class Db(object):
         cursor = self.conn.cursor(MySQLdb.cursors.DictCursor)
         try:
             if log:
-                logger.debug(request % tuple(values))
+                logger.debug(request, *values)
             cursor.execute(request, tuple(values))
         except MySQLdb.Error as error:
-            logger.error(request % tuple(values))
-            logger.error("SQL ERROR: " + str(error) + "\n-----------------")
+            logger.error(request, *values)
+            logger.error("SQL ERROR: %s\n-----------------", error)
+            metrics.inc("orm_failures_total", type="sql")
             return 0
         else:
             self.conn.commit()
             if log:
-                logger.debug("REQUEST OK. Id: " + str(cursor.lastrowid) + "\n-----------------")
+                logger.debug("REQUEST OK. Id: %s\n-----------------", cursor.lastrowid)
             last_row_id = cursor.lastrowid
             cursor.close()
             return last_row_id
@@ -247,7 +251,7 @@ class Db(object):
         cursor = self.conn.cursor(MySQLdb.cursors.DictCursor)
         try:
             if log:
-                logger.debug(request % tuple(values))
+                logger.debug(request, *values)
             cursor.execute(request, tuple(values))
         except MySQLdb.Error as error:
             deadlock = 0
@@ -266,8 +270,9 @@ class Db(object):
                         logger.debug("REQUEST OK.\n-----------------")
                     cursor.close()
                     return -1
-            logger.error(request % tuple(values))
-            logger.error("SQL ERROR: " + str(error) + "\n-----------------")
+            logger.error(request, *values)
+            logger.error("SQL ERROR: %s\n-----------------", error)
+            metrics.inc("orm_failures_total", type="sql")
             cursor.close()
             return 0
         else:
@@ -289,11 +294,12 @@ class Db(object):
         cursor = self.conn.cursor(MySQLdb.cursors.DictCursor)
         try:
             if log:
-                logger.debug(request % tuple(values))
+                logger.debug(request, *values)
             cursor.execute(request, tuple(values))
         except MySQLdb.Error as error:
-            logger.error(request % tuple(values))
-            logger.error("SQL ERROR: " + str(error) + "\n-----------------")
+            logger.error(request, *values)
+            logger.error("SQL ERROR: %s\n-----------------", error)
+            metrics.inc("orm_failures_total", type="sql")
             cursor.close()
             return 0
         else:
@@ -315,14 +321,15 @@ class Db(object):
         try:
             if values:
                 if log:
-                    logger.debug(request % tuple(values))
+                    logger.debug(request, *values)
                 cursor.execute(request, tuple(values))
             else:
                 if log:
                     logger.debug(request)
                 cursor.execute(request)
         except MySQLdb.Error as error:
-            logger.error("SQL ERROR: " + str(error) + "\n-----------------")
+            logger.error("SQL ERROR: %s\n-----------------", error)
+            metrics.inc("orm_failures_total", type="sql")
         else:
             if re.match("DELETE", request) is not None:
                 self.conn.commit()
@@ -336,7 +343,7 @@ class Db(object):
                     result[key] = row[key]
                 results.append(result)
             if log:
-                logger.debug("REQUEST OK. Results: " + str(results) + "\n-----------------")
+                logger.debug("REQUEST OK. Results: %s\n-----------------", results)
         cursor.close()
         return results
 
@@ -351,14 +358,15 @@ class Db(object):
         try:
             if values:
                 if log:
-                    logger.debug("PROCEDURE CALL: " + name + "| PARAMETERS: " + str(tuple(values)))
+                    logger.debug("PROCEDURE CALL: %s| PARAMETERS: %s", name, tuple(values))
                 cursor.callproc(name, tuple(values))
             else:
                 if log:
                     logger.debug("PROCEDURE CALL: " + name)
                 cursor.callproc(name)
         except MySQLdb.Error as error:
-            logger.error("SQL ERROR: " + str(error) + "\n-----------------")
+            logger.error("SQL ERROR: %s\n-----------------", error)
+            metrics.inc("orm_failures_total", type="sql")
         else:
             #self.conn.commit()
             for row in cursor.fetchall():
@@ -367,10 +375,60 @@ class Db(object):
                     result[key] = row[key]
                 results.append(result)
             if log:
-                logger.debug("REQUEST OK. Results: " + str(results) + "\n-----------------")
+                logger.debug("REQUEST OK. Results: %s\n-----------------", results)
         cursor.close()
         return results
 
+    def defaults(self, table):
+        """ Returns the default values of the table columns (as new Connectors are initialized). """
+
+        if table not in self.table_defaults.keys():
+            defaults = {}
+            for column in self.custom("desc %s" % table):
+                defaults[column["Field"]] = column["Default"] if column["Default"] else None
+            self.table_defaults[table] = defaults
+        return self.table_defaults[table].copy()
+
+    def select_in(self, table, fields, column, values, conditions=None, chunk=500, log=None):
+        """ Selects the given fields of the rows whose column is one of the given values.
+
+        The values are requested in chunks and the extra conditions (column -> value) are added to all of them. """
+
+        if conditions is None:
+            conditions = {}
+        values = list(values)
+        results = []
+        for index in range(0, len(values), chunk):
+            chunk_values = values[index:index + chunk]
+            request = "SELECT " + ", ".join(fields) + " FROM " + table
+            request += " WHERE " + column + " IN (" + ", ".join(["%s"] * len(chunk_values)) + ")"
+            for key in conditions.keys():
+                request += " AND " + key + " = %s"
+            results += self.custom(request, values=chunk_values + list(conditions.values()), log=log)
+        return results
+
+    def insert_many(self, table, rows, update=None, chunk=500, log=None):
+        """ Inserts the rows (dicts with the same keys) with multi-row INSERT requests.
+
+        Rows with duplicated keys update the given fields, or are left as they are if no fields are given. """
+
+        if not rows:
+            return
+        fields = list(rows[0].keys())
+        if update:
+            on_duplicate = ", ".join([field + " = VALUES(" + field + ")" for field in update])
+        else:
+            on_duplicate = "id = id"
+        for index in range(0, len(rows), chunk):
+            chunk_rows = rows[index:index + chunk]
+            request = "INSERT INTO " + table + " (" + ", ".join(fields) + ") VALUES "
+            request += ", ".join(["(" + ", ".join(["%s"] * len(fields)) + ")"] * len(chunk_rows))
+            request += " ON DUPLICATE KEY UPDATE " + on_duplicate
+            values = []
+            for row in chunk_rows:
+                values += [row[field] for field in fields]
+            self.custom(request, values=values, log=log)
+
     def select(self, fields, tables, conditions, order, values, log=None):
         """ Calls the internal __select function. """
 
@@ -481,7 +539,7 @@ class Connector(object):
             self.values[conditions[0]] = value
             return 0
         if len(result) > 1:
-            logger.warning("Loading " + self.table + " '" + str(value) + "': Too many query results")
+            logger.warning("Loading %s '%s': Too many query results", self.table, value)
             return 0
         self.values = result[0]
         return self.values["id"]
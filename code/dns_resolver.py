@@ -0,0 +1,199 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+
+""" Cached DNS resolution of host names.
+
+The addresses are kept for the TTL of their DNS records (dnspython is needed
+to know it, otherwise config.DNS_TTL is used) and the names that do not exist
+are remembered for config.DNS_NEGATIVE_TTL seconds, keeping at most
+config.DNS_CACHE_SIZE names. Batches of names are
+resolved concurrently with asyncio, retrying the temporary failures with
+exponential backoff.
+"""
+
+# Basic modules
+import asyncio
+import socket
+import threading
+from collections import OrderedDict
+import time
+import logging.config
+
+import config
+
+try:
+    import dns.asyncresolver
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    RuntimeWarning('You will have to install dnspython to respect the TTL of the DNS records')
+    dns = None
+
+logging.config.fileConfig('logging.conf')
+
+logger = logging.getLogger("MODULE")
+
+
+class NameNotFound(Exception):
+    """ The name does not exist (or has no IPv4 address), there is no need to retry it. """
+
+
+class DnsResolver(object):
+    """ IPv4 resolver with positive and negative cache. Thread-safe. """
+
+    def __init__(self, ttl=None, negative_ttl=None, retries=None, backoff=None, concurrency=None, timeout=None,
+                 size=None):
+        self.ttl = ttl if ttl is not None else config.DNS_TTL
+        self.negative_ttl = negative_ttl if negative_ttl is not None else config.DNS_NEGATIVE_TTL
+        self.retries = retries if retries is not None else config.DNS_RETRIES
+        self.backoff = backoff if backoff is not None else config.DNS_BACKOFF
+        self.concurrency = concurrency or config.DNS_CONCURRENCY
+        self.timeout = timeout or config.DNS_TIMEOUT
+        self.size = size or config.DNS_CACHE_SIZE
+        # Host name -> (address or None if not found, expiration time), oldest stored first
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "negative_hits": 0, "resolved": 0, "not_found": 0, "failed": 0, "retries": 0}
+
+    def cached(self, host):
+        """ Returns (True, address) if the host is cached and not expired, (False, None) otherwise. """
+
+        with self.lock:
+            entry = self.cache.get(host)
+            if entry is None:
+                return False, None
+            if entry[1] < time.monotonic():
+                self.cache.pop(host)
+                return False, None
+            self.counters["hits" if entry[0] else "negative_hits"] += 1
+            return True, entry[0]
+
+    def store(self, host, address, ttl, counter):
+        """ Caches the result of the host for ttl seconds, counting it as the given outcome. """
+
+        with self.lock:
+            self.cache[host] = (address, time.monotonic() + ttl)
+            self.cache.move_to_end(host)
+            if len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+            self.counters[counter] += 1
+
+    async def query(self, host):
+        """ Resolves the host once. Returns its address and TTL. """
+
+        if dns:
+            resolver = dns.asyncresolver.Resolver()
+            resolver.lifetime = self.timeout
+            try:
+                answer = await resolver.resolve(host, "A")
+            except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+                raise NameNotFound(str(e))
+            except dns.exception.SyntaxError as e:
+                raise NameNotFound(str(e))
+            return answer[0].address, min(answer.rrset.ttl, self.ttl)
+        loop = asyncio.get_running_loop()
+        try:
+            info = await asyncio.wait_for(loop.getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM),
+                                          self.timeout)
+        except socket.gaierror as e:
+            if e.errno in (socket.EAI_NONAME, getattr(socket, "EAI_NODATA", socket.EAI_NONAME)):
+                raise NameNotFound(str(e))
+            raise
+        except UnicodeError as e:
+            raise NameNotFound(str(e))
+        return info[0][4][0], self.ttl
+
+    async def lookup(self, host, semaphore):
+        """ Resolves the host (retrying temporary failures) and caches the result. Returns the address or None. """
+
+        found, address = self.cached(host)
+        if found:
+            return address
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    with self.lock:
+                        self.counters["retries"] += 1
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    address, ttl = await self.query(host)
+                except NameNotFound:
+                    self.store(host, None, self.negative_ttl, "not_found")
+                    return None
+                except Exception as e:
+                    logger.debug("Lookup of %s failed (attempt %d): %s", host, attempt + 1, e)
+                else:
+                    self.store(host, address, ttl, "resolved")
+                    return address
+        # Remembered as negative for a while to avoid hammering a failing server
+        self.store(host, None, self.negative_ttl, "failed")
+        return None
+
+    async def lookup_all(self, hosts):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        addresses = await asyncio.gather(*[self.lookup(host, semaphore) for host in hosts])
+        return dict(zip(hosts, addresses))
+
+    def resolve_many(self, hosts):
+        """ Resolves the host names concurrently. Returns a dict host -> address (None if not resolved). """
+
+        hosts = list(set(host for host in hosts if host))
+        if not hosts:
+            return {}
+        return asyncio.run(self.lookup_all(hosts))
+
+    def resolve(self, host):
+        """ Returns the address of the host name or None if not resolved. """
+
+        if not host:
+            return None
+        found, address = self.cached(host)
+        if found:
+            return address
+        return self.resolve_many([host])[host]
+
+    def stats(self):
+        """ Returns the lookup counters and the names cached. """
+
+        with self.lock:
+            stats = dict(self.counters)
+            stats["cached"] = len(self.cache)
+        return stats
+
+    def purge(self):
+        """ Removes the expired entries. """
+
+        now = time.monotonic()
+        with self.lock:
+            for host in [host for host, entry in self.cache.items() if entry[1] < now]:
+                self.cache.pop(host)
+
+
+resolver = None
+
+
+def get_resolver():
+    """ Returns the DNS resolver of the process. """
+
+    global resolver
+    if resolver is None:
+        resolver = DnsResolver()
+    return resolver
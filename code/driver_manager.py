@@ -23,7 +23,6 @@ import os
 import re
 import time
 import logging.config
-import zlib
 
 # 3rd party modules
 from selenium import webdriver
@@ -34,9 +33,15 @@ from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
 
 # Own modules
-from utils import utc_now
-from data_manager import manage_requests
+from utils import utc_now, extract_domain, encode_image, image_hash, hash_distance
+from data_manager import ingest_visit
+from request_record import parse_requests
 from session_storage import SessionStorage
+from visit_archive import VisitArchive
+from tracing import span
+import metrics
+
+import config
 
 COMPLETED = REPEAT = True
 FAILED = NO_REPEAT = False
@@ -45,6 +50,16 @@ logging.config.fileConfig('logging.conf')
 
 logger = logging.getLogger("DRIVER_MANAGER")
 
+# Launch options shared by all the browsers of the process (modified by ORM.py before spawning workers)
+browser_options = {"headless": False, "width": 1920, "height": 1080, "proxy": None,
+                   "capture_bodies": False, "capture_mime_types": [], "capture_max_size": 5 * 2 ** 20}
+
+# Screenshot options (screenshots can be disabled by ORM.py)
+screenshot_options = {"enabled": True, "format": config.SCREENSHOT_FORMAT, "quality": config.SCREENSHOT_QUALITY,
+                      "scale": config.SCREENSHOT_SCALE, "threshold": config.SCREENSHOT_HASH_THRESHOLD}
+# Folder where the raw data of every visit is archived to be replayed later (None to disable it)
+record_options = {"folder": None}
+
 
 def get_extension_uuid(path, identifier):
     uuid = ""
@@ -79,13 +94,29 @@ def build_driver(plugin, cache, update_ublock, process):
             profile.set_preference("browser.cache.offline.enable", False)
             profile.set_preference("network.http.use-cache", False)
 
+        # HTTP proxy ("host:port") used for all the websites, e.g. the local stand-in of benchmark_crawl.py
+        if browser_options["proxy"]:
+            proxy_host, proxy_port = browser_options["proxy"].rsplit(":", 1)
+            profile.set_preference("network.proxy.type", 1)
+            profile.set_preference("network.proxy.http", proxy_host)
+            profile.set_preference("network.proxy.http_port", int(proxy_port))
+            profile.set_preference("network.proxy.ssl", proxy_host)
+            profile.set_preference("network.proxy.ssl_port", int(proxy_port))
+            profile.set_preference("network.proxy.no_proxies_on", "")
+
         opts = Options()
         opts.profile = profile
+        # Native headless mode does not need any X server (the window size must be set explicitly)
+        if browser_options["headless"]:
+            opts.headless = True
+            opts.add_argument("--window-size=%d,%d" % (browser_options["width"], browser_options["height"]))
         driver = webdriver.Firefox(options=opts, log_path="log/geckodriver.log")
+        if browser_options["headless"]:
+            driver.set_window_size(browser_options["width"], browser_options["height"])
         driver.set_page_load_timeout(60)
     except Exception as e:
         # logger.error(e)
-        logger.error("(proc. %d) Error creating driver: %s" % (process, str(e)))
+        logger.error("(proc. %d) Error creating driver: %s", process, e)
         return FAILED
     try:
         time.sleep(2)
@@ -107,16 +138,23 @@ def build_driver(plugin, cache, update_ublock, process):
                 time.sleep(20)
             if plugin.values["background"]:
                 driver.get(plugin.values["background"].replace("UUID", uuid))
+                # Ask the custom uBlock to keep the response bodies of the downloadable resources
+                if plugin.values['custom'] and browser_options["capture_bodies"]:
+                    driver.execute_script("window.orm_capture_bodies = true;"
+                                          "window.orm_capture_mime_types = arguments[0];"
+                                          "window.orm_capture_max_size = arguments[1];",
+                                          browser_options["capture_mime_types"], browser_options["capture_max_size"])
         return driver
     except Exception as e:
         driver.quit()
-        logger.error("(proc. %d) Error creating driver: %s" % (process, str(e)))
+        logger.error("(proc. %d) Error creating driver: %s", process, e)
         return FAILED
 
 
 def reset_browser(driver, process, plugin, cache, update_ublock):
     """ Reset the browser to the default state. """
 
+    metrics.inc("orm_browser_restarts_total")
     driver.quit()
     driver = build_driver(plugin, cache, update_ublock, process)
     while not driver:
@@ -125,13 +163,183 @@ def reset_browser(driver, process, plugin, cache, update_ublock):
     return driver
 
 
-def visit_site(db, process, driver, domain, plugin, temp_folder, cache, update_ublock, geo_db):
-    """ Loads the website and extract its information. """
+def take_screenshot(driver, domain):
+    """ Takes an in-memory screenshot of the current tab and returns the domain values to update.
+
+    The screenshot is downscaled and re-encoded following the screenshot options. Nothing is returned when the
+    screenshots are disabled or when the perceptual hash shows the page did not change since the last crawl. """
+
+    if not screenshot_options["enabled"]:
+        return {}
+    png = driver.get_screenshot_as_png()
+    if not png:
+        return {}
+    screenshot_hash = image_hash(png)
+    if screenshot_hash and domain.values.get("screenshot_hash") and \
+            hash_distance(screenshot_hash, domain.values["screenshot_hash"]) <= screenshot_options["threshold"]:
+        logger.debug("Screenshot of %s unchanged since last crawl", domain.values["name"])
+        return {}
+    image, image_format = encode_image(png, screenshot_options["format"], screenshot_options["quality"],
+                                       screenshot_options["scale"])
+    return {"screenshot": image, "screenshot_format": image_format, "screenshot_hash": screenshot_hash}
+
+
+def new_archive(domain, plugin, request_list, values):
+    """ Returns the archive recording the visit or None if the recording is disabled. """
+
+    if not record_options["folder"]:
+        return None
+    return VisitArchive(record_options["folder"], domain.values["name"], plugin.values["id"], request_list, values)
+
+
+def dismiss_alerts(driver, limit=100):
+    """ Closes all the alerts opened by the current tab (up to 'limit', pages may open them endlessly). """
+
+    for _ in range(limit):
+        try:
+            alert = Alert(driver)
+            alert.dismiss()
+        except:
+            break
 
+
+def split_by_tab(records, domains):
+    """ Splits the uBlock sessionStorage request records between the domains visited in parallel tabs.
+
+    Each tab is identified by the tab id of its 'main_frame' request pointing to the visited domain.
+    Requests from unidentified tabs (e.g. behind-the-scene requests) are discarded, and the domains whose tab
+    could not be identified are left out of the result. """
+
+    tab_domains = {}
+    for elem in records:
+        if elem.type != "main_frame" or elem.tab_id is None or elem.tab_id in tab_domains.keys():
+            continue
+        hostname = extract_domain(elem.url or "")
+        for domain in domains:
+            if hostname in (domain.values["name"], "www." + domain.values["name"]) and \
+                    domain not in tab_domains.values():
+                tab_domains[elem.tab_id] = domain
+                break
+    split_list = {domain.values["id"]: [] for domain in tab_domains.values()}
+    for elem in records:
+        if elem.tab_id in tab_domains.keys():
+            split_list[tab_domains[elem.tab_id].values["id"]].append(elem)
+    return split_list
+
+
+def visit_sites(db, process, driver, domains, plugin, temp_folder, cache, update_ublock, geo_db, ingest=None):
+    """ Loads several websites in parallel tabs of the same browser and extracts their information.
+
+    Returns the driver and the list of domains that could not be visited and should be repeated. """
+
+    if len(domains) == 1:
+        driver, completed, repeat = visit_site(db, process, driver, domains[0], plugin, temp_folder, cache,
+                                               update_ublock, geo_db, ingest)
+        return driver, [domains[0]] if not completed and repeat else []
     try:
         blocker_tab_handle = driver.current_window_handle
     except Exception as e:
-        logger.error("Error saving uBlock tab: %s (proc. %d)" % (str(e), process))
+        logger.error("Error saving uBlock tab: %s (proc. %d)", e, process)
+        metrics.inc("orm_failures_total", type="other")
+        driver = reset_browser(driver, process, plugin, cache, update_ublock)
+        return driver, domains
+
+    # Open one tab per domain. Pages opened with 'window.open' load concurrently
+    tabs = []
+    try:
+        for domain in domains:
+            driver.switch_to.window(blocker_tab_handle)
+            driver.execute_script("window.open(arguments[0]);", 'http://' + domain.values["name"])
+            tabs.append([driver.window_handles[-1], domain])
+    except WebDriverException as e:
+        logger.error("WebDriverException (1) opening tabs / Error: %s (proc. %d)", e, process)
+        metrics.inc("orm_failures_total", type="webdriver")
+        driver = reset_browser(driver, process, plugin, cache, update_ublock)
+        return driver, domains
+
+    # Wait some time inside the websites and until they finish loading (page load timeout of 60s)
+    with span("page_load", domains=len(tabs)):
+        time.sleep(10)
+        deadline = time.time() + 50
+        pending = list(tabs)
+        while pending and time.time() < deadline:
+            for tab in list(pending):
+                try:
+                    driver.switch_to.window(tab[0])
+                    if driver.execute_script("return document.readyState;") == "complete":
+                        pending.remove(tab)
+                except WebDriverException:
+                    pass
+            if pending:
+                time.sleep(1)
+    timed_out = [tab[1] for tab in pending]
+    for domain in timed_out:
+        logger.warning("Site %s timed out (proc. %d)", domain.values["name"], process)
+        metrics.inc("orm_failures_total", type="timeout")
+
+    # Take the screenshots and close the tabs
+    screenshots = {}
+    try:
+        for handle, domain in tabs:
+            driver.switch_to.window(handle)
+            if domain not in timed_out:
+                with span("screenshot"):
+                    screenshots[domain.values["id"]] = take_screenshot(driver, domain)
+                dismiss_alerts(driver)
+                if not cache:
+                    driver.delete_all_cookies()
+            driver.close()
+        driver.switch_to.window(blocker_tab_handle)
+    except WebDriverException as e:
+        logger.warning("WebDriverException (3) closing tabs / Error: %s (proc. %d)", e, process)
+        metrics.inc("orm_failures_total", type="webdriver")
+        driver = reset_browser(driver, process, plugin, cache, update_ublock)
+        return driver, domains
+
+    # Process traffic from uBlock Origin tab sessionStorage
+    try:
+        with span("session_storage"):
+            storage = SessionStorage(driver)
+            web_list = storage.items()
+            storage.clear()
+    except WebDriverException as e:
+        logger.error("(proc. %d) Error accessing the session storage: %s", process, e)
+        metrics.inc("orm_failures_total", type="webdriver")
+        driver = reset_browser(driver, process, plugin, cache, update_ublock)
+        return driver, domains
+    with span("parse_requests", requests=len(web_list)):
+        split_list = split_by_tab(parse_requests(process, web_list), domains)
+    unidentified = []
+    for domain in domains:
+        if domain in timed_out:
+            continue
+        if domain.values["id"] not in split_list.keys():
+            # Without its main frame request the traffic of the domain cannot be told apart: visit it again alone
+            logger.warning("Tab of site %s not identified in the requests (proc. %d)", domain.values["name"], process)
+            unidentified.append(domain)
+            continue
+        values = {"priority": 0}
+        values.update(screenshots[domain.values["id"]])
+        records = split_list[domain.values["id"]]
+        archive = new_archive(domain, plugin, {elem.key: web_list[elem.key] for elem in records}, values)
+        if ingest:
+            with span("ingest_wait"):
+                ingest.submit(domain, plugin, records, values, archive)
+        else:
+            ingest_visit(db, process, domain, records, plugin, temp_folder, geo_db, values, archive)
+    return driver, timed_out + unidentified
+
+
+def visit_site(db, process, driver, domain, plugin, temp_folder, cache, update_ublock, geo_db, ingest=None):
+    """ Loads the website and extract its information.
+
+    If an ingest pipeline is given the extracted information is stored by the pipeline in the background. """
+
+    try:
+        blocker_tab_handle = driver.current_window_handle
+    except Exception as e:
+        logger.error("Error saving uBlock tab: %s (proc. %d)", e, process)
+        metrics.inc("orm_failures_total", type="other")
         driver = reset_browser(driver, process, plugin, cache, update_ublock)
         return driver, FAILED, REPEAT
     try:
@@ -139,68 +347,61 @@ def visit_site(db, process, driver, domain, plugin, temp_folder, cache, update_u
         second_tab_handle = driver.window_handles[-1]
         driver.switch_to.window(second_tab_handle)
     except WebDriverException as e:
-        logger.error("WebDriverException (1) on %s / Error: %s (proc. %d)" % (domain.values["name"], str(e), process))
+        logger.error("WebDriverException (1) on %s / Error: %s (proc. %d)", domain.values["name"], e, process)
+        metrics.inc("orm_failures_total", type="webdriver")
         driver = reset_browser(driver, process, plugin, cache, update_ublock)
         return driver, FAILED, REPEAT
 
     # Load the website and wait some time inside it
     try:
-        driver.get('http://' + domain.values["name"])
+        with span("page_load", domain=domain.values["name"]):
+            driver.get('http://' + domain.values["name"])
     except TimeoutException:
-        logger.warning("Site %s timed out (proc. %d)" % (domain.values["name"], process))
+        logger.warning("Site %s timed out (proc. %d)", domain.values["name"], process)
+        metrics.inc("orm_failures_total", type="timeout")
         driver.close()
         driver.switch_to.window(blocker_tab_handle)
         try:
             storage = SessionStorage(driver)
             storage.clear()
         except NoSuchWindowException as e:
-            logger.error("(proc. %d) Error accessing the session storage: %s" % (process, str(e)))
+            logger.error("(proc. %d) Error accessing the session storage: %s", process, e)
             driver = reset_browser(driver, process, plugin, cache, update_ublock)
         except WebDriverException as e:
-            logger.error("(proc. %d) Error clearing session storage: %s" % (process, str(e)))
+            logger.error("(proc. %d) Error clearing session storage: %s", process, e)
             driver = reset_browser(driver, process, plugin, cache, update_ublock)
         return driver, FAILED, REPEAT
     except WebDriverException as e:
-        logger.warning("WebDriverException (2) on %s / Error: %s (proc. %d)" % (domain.values["name"], str(e), process))
+        logger.warning("WebDriverException (2) on %s / Error: %s (proc. %d)", domain.values["name"], e, process)
+        metrics.inc("orm_failures_total", type="webdriver")
         driver = reset_browser(driver, process, plugin, cache, update_ublock)
         domain.values["update_timestamp"] = utc_now()
         domain.values["priority"] = 0
         domain.save()
         return driver, FAILED, NO_REPEAT
     except Exception as e:
-        logger.error("%s (proc. %d)" % (str(e), process))
+        logger.error("%s (proc. %d)", e, process)
+        metrics.inc("orm_failures_total", type="other")
         driver = reset_browser(driver, process, plugin, cache, update_ublock)
         domain.values["update_timestamp"] = utc_now()
         domain.values["priority"] = 0
         domain.save()
         return driver, FAILED, NO_REPEAT
     # Wait some time inside the website
-    time.sleep(10)
-    os.makedirs(os.path.join(os.path.abspath("."), temp_folder), exist_ok=True)
-    filename = os.path.join(temp_folder, domain.values["name"] + 'ss.png')
-    driver.save_screenshot(filename)
-    size = os.stat(filename).st_size
-    compressed_code = None
-    if size > 0:
-        # Compress the screenshot to save it into the database when needed
-        with open(filename, 'rb') as f:
-            blob_value = f.read()
-            compressed_code = zlib.compress(blob_value)
-    os.remove(filename)
+    with span("dwell"):
+        time.sleep(10)
+    with span("screenshot"):
+        screenshot = take_screenshot(driver, domain)
     try:
         # Close possible alerts
-        finished = False
-        while not finished:
-            try:
-                alert = Alert(driver)
-                alert.dismiss()
-            except:
-                finished = True
-        if not cache:
-            driver.delete_all_cookies()
-        driver.close()
+        with span("close_tab"):
+            dismiss_alerts(driver)
+            if not cache:
+                driver.delete_all_cookies()
+            driver.close()
     except WebDriverException as e:
-        logger.warning("WebDriverException (3) on %s / Error: %s (proc. %d)" % (domain.values["name"], str(e), process))
+        logger.warning("WebDriverException (3) on %s / Error: %s (proc. %d)", domain.values["name"], e, process)
+        metrics.inc("orm_failures_total", type="webdriver")
         driver = reset_browser(driver, process, plugin, cache, update_ublock)
         return driver, FAILED, REPEAT
 
@@ -208,30 +409,37 @@ def visit_site(db, process, driver, domain, plugin, temp_folder, cache, update_u
     try:
         driver.switch_to.window(blocker_tab_handle)
     except Exception as e:
-        logger.error("Error accessing uBlock tab: %s (proc. %d)" % (str(e), process))
+        logger.error("Error accessing uBlock tab: %s (proc. %d)", e, process)
+        metrics.inc("orm_failures_total", type="other")
         driver = reset_browser(driver, process, plugin, cache, update_ublock)
         return driver, FAILED, REPEAT
     try:
-        storage = SessionStorage(driver)
-        web_list = {}
-        for key in storage.keys():
-            web_list[key] = storage[key]
+        with span("session_storage"):
+            storage = SessionStorage(driver)
+            web_list = storage.items()
     except NoSuchWindowException as e:
-        logger.error("(proc. %d) Error accessing the session storage: %s" % (process, str(e)))
+        logger.error("(proc. %d) Error accessing the session storage: %s", process, e)
+        metrics.inc("orm_failures_total", type="webdriver")
         driver = reset_browser(driver, process, plugin, cache, update_ublock)
         return driver, FAILED, REPEAT
     else:
-        # Insert data and clear storage before opening the next website
-        manage_requests(db, process, domain, web_list, plugin, temp_folder, geo_db)
+        # Insert data (or hand it to the ingest pipeline) and clear storage before opening the next website
+        values = {"priority": 0}
+        values.update(screenshot)
+        with span("parse_requests", requests=len(web_list)):
+            records = parse_requests(process, web_list)
+        archive = new_archive(domain, plugin, web_list, values)
+        if ingest:
+            # Waits here while the ingestion falls behind
+            with span("ingest_wait"):
+                ingest.submit(domain, plugin, records, values, archive)
+        else:
+            ingest_visit(db, process, domain, records, plugin, temp_folder, geo_db, values, archive)
         try:
             storage.clear()
         except WebDriverException as e:
-            logger.error("(proc. %d) Error clearing session storage: %s" % (process, str(e)))
+            logger.error("(proc. %d) Error clearing session storage: %s", process, e)
+            metrics.inc("orm_failures_total", type="webdriver")
             driver = reset_browser(driver, process, plugin, cache, update_ublock)
             return driver, FAILED, NO_REPEAT
-    domain.values["update_timestamp"] = utc_now()
-    domain.values["priority"] = 0
-    if compressed_code:
-        domain.values["screenshot"] = compressed_code;
-    domain.save()
     return driver, COMPLETED, NO_REPEAT
@@ -23,7 +23,6 @@ import argparse
 import os
 import logging.config
 import queue
-import zlib
 from multiprocessing import Pool, Queue, cpu_count, Lock
 from ast import literal_eval
 
@@ -34,7 +33,10 @@ from rabin import get_file_fingerprints, set_min_block_size, set_max_block_size,
 
 # Own modules
 from db_manager import Db, Connector
+from codec import read_resource
 from utils import utc_now
+import log_writer
+import metrics
 
 logging.config.fileConfig('logging.conf')
 
@@ -66,7 +68,7 @@ def beautify_code(process, code, headers):
     try:
         code = jsbeautifier.beautify(html_content_unicode)
     except Exception as e:
-        logger.info("(proc. %d) Encoding error: %s" % (process, str(e)))
+        logger.info("(proc. %d) Encoding error: %s", process, e)
         code = html_content_unicode
     return code
 
@@ -79,7 +81,7 @@ def extract_scripts(process, resource, folder):
     temp_filename = os.path.join(os.path.abspath("."), folder, resource.values["hash"] + ".tmp")
 
     # Extract the file content
-    page_source = zlib.decompress(resource.values["file"])
+    page_source = read_resource(resource.values)
 
     # Get headers to pass to beautify_code
     url_headers = None
@@ -96,7 +98,7 @@ def extract_scripts(process, resource, folder):
     # Extract HTML embedded scripts
     if not soup.find('script', {"src": False}):
         # No script present -> assuming JS code
-        logger.info('[Worker %d] Could not find <script> tags. Assuming JavaScript file' % process)
+        logger.info('[Worker %d] Could not find <script> tags. Assuming JavaScript file', process)
         code = beautify_code(process, page_source, url_headers)
         with open(temp_filename, 'wb') as f:
             f.write(code.encode('utf-8', 'replace'))
@@ -141,6 +143,8 @@ parser.add_argument('-v', dest='verbose', type=int, default=3,
                     help='Verbose: 0=CRITICAL; 1=ERROR; 2=WARNING; 3=INFO; 4=DEBUG (Default: WARNING)')
 parser.add_argument('-d', dest='folder', type=str, default='tmp',
                     help='Temporary folder (Default: "./tmp"')
+parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=0,
+                    help='Local port serving the live metrics of the fingerprinter at /metrics (Default: 0, disabled)')
 
 
 def main(process):
@@ -161,18 +165,19 @@ def main(process):
             queue_lock.release()
         except queue.Empty:
             queue_lock.release()
-            logger.info("Queue empty (proc. %d)" % process)
+            logger.info("Queue empty (proc. %d)", process)
             remaining = False
         except Exception as e:
-            logger.error("%s (proc. %d)" % (str(e), process))
+            logger.error("%s (proc. %d)", e, process)
         else:
             resource = Connector(db, "resource")
             resource.load(resource_id)
-            logger.info('Job [%d/%d] %s (proc: %d)' % (total - current + 1, total, resource.values["hash"], process))
+            logger.info('Job [%d/%d] %s (proc: %d)', total - current + 1, total, resource.values["hash"], process)
 
             if extract_scripts(process, resource, temp_folder):
                 resource.values["fingerprinted"] = 1
                 resource.save()
+                metrics.inc("orm_resources_processed_total", stage="fingerprints")
     db.close()
     return 1
 
@@ -187,6 +192,7 @@ if __name__ == '__main__':
     v = args.verbose
     if verbose[str(v)]:
         logger.setLevel(verbose[str(v)])
+    log_writer.start()
 
     # If thread parameter is auto get the (total-1) or the available CPU's, whichever is smaller
     logger.info("Calculating processes...")
@@ -201,12 +207,12 @@ if __name__ == '__main__':
             threads = cpu - 1
         else:
             threads = available_cpu
-    logger.info("Processes to run: %d " % threads)
+    logger.info("Processes to run: %d ", threads)
 
     # Get domains between the given range from the database.
     logger.info("Getting work")
     database = Db()
-    rq = 'SELECT id, type, file FROM resource WHERE fingerprinted = 0 AND size > 0 '
+    rq = 'SELECT id FROM resource WHERE fingerprinted = 0 AND size > 0 '
     rq += ' AND type IN ("frame", "script")'
     if args.start > 0:
         rq += " AND id > %d" % (args.start - 1)
@@ -215,7 +221,7 @@ if __name__ == '__main__':
     rq += ' ORDER BY id'
     results = database.custom(rq)
     total = len(results)
-    logger.info("Gotten %d jobs to enqueue" % total)
+    logger.info("Gotten %d jobs to enqueue", total)
 
     # Initialize job queue
     logger.info("Enqueuing work")
@@ -227,5 +233,9 @@ if __name__ == '__main__':
 
     # Create and call the workers
     logger.info("Opening workers")
-    with Pool(processes=threads) as pool:
+    if args.metrics_port:
+        metrics.setup(threads)
+    with Pool(processes=threads, initializer=metrics.claim_slot) as pool:
+        if args.metrics_port:
+            metrics.serve(args.metrics_port, [metrics.queue_depth(resources=work_queue), metrics.worker_memory])
         pool.map(main, [i for i in range(threads)])
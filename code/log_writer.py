@@ -0,0 +1,193 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+
+""" Single writer of the logs of all the processes.
+
+'start' (called by the main process once every module is imported and
+before forking the workers) spawns a writer process that keeps the console
+and file handlers of 'logging.conf', and replaces them in every logger by a
+handler that only writes the records into a pipe. The workers inherit the
+pipe handler, so they never wait for the console, the files or the locks
+of the other processes. Every record is written with a single write of at
+most PIPE_BUF bytes, which the pipe keeps whole, so the records of several
+processes never mix and a worker killed while logging cannot block the
+others or corrupt the pipe.
+
+The pipe handler also drops the warnings and errors repeated too often
+(the same message template of the same logger), counting them in the next
+one let through. Log with arguments instead of formatted messages:
+
+    logger.debug("(proc. %d) Found external resource %s", process, url)
+
+so the message is only built if the level is enabled and the repeated
+messages are recognized.
+"""
+
+# Basic modules
+import atexit
+import logging
+import os
+import pickle
+import select
+import signal
+import struct
+import threading
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler
+from multiprocessing import Process
+
+import config
+
+# Write end of the pipe of the records and writer process (created by 'start')
+log_pipe = None
+writer = None
+owner = None
+
+# Length written before every record (a length of 0 is the end mark)
+HEADER = struct.Struct("!I")
+
+# Message templates remembered by the rate limit of each process
+WINDOWS_SIZE = 1000
+
+
+class RateLimitFilter(logging.Filter):
+    """ Lets through at most 'burst' warnings/errors with the same message template of each logger every 'period'
+    seconds. The next record let through tells how many were suppressed. """
+
+    def __init__(self, period, burst):
+        super().__init__()
+        self.period = period
+        self.burst = burst
+        # (logger, level, template) -> [window start, records let through, records suppressed]
+        self.windows = OrderedDict()
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.period <= 0:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        t = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or t - window[0] >= self.period:
+                suppressed = window[2] if window is not None else 0
+                window = [t, 0, 0]
+                self.windows[key] = window
+                self.windows.move_to_end(key)
+                if len(self.windows) > WINDOWS_SIZE:
+                    self.windows.popitem(last=False)
+                if suppressed:
+                    record.msg = "%s (%d similar messages suppressed)" % (record.getMessage(), suppressed)
+                    record.args = None
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+
+class PipeHandler(QueueHandler):
+    """ Handler writing every record into the pipe of the writer with a single atomic write. """
+
+    def __init__(self, fd):
+        super().__init__(None)
+        self.fd = fd
+
+    def enqueue(self, record):
+        # The message is formatted again by the writer
+        values = {key: value for key, value in record.__dict__.items() if key != "message"}
+        data = pickle.dumps(values)
+        message = values["msg"]
+        while HEADER.size + len(data) > select.PIPE_BUF and message:
+            # Longer writes could be split: the message is cut to fit
+            message = message[:max(0, len(message) - (HEADER.size + len(data) - select.PIPE_BUF))]
+            values["msg"] = message + " [truncated]"
+            data = pickle.dumps(values)
+        os.write(self.fd, HEADER.pack(len(data)) + data)
+
+
+def read(fd, size):
+    """ Reads exactly 'size' bytes from the pipe. Returns less if the pipe is closed. """
+
+    data = b""
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def write(fd):
+    """ Writes the records of the pipe with the handlers of 'logging.conf' until the end mark is received. """
+
+    # Ctrl+C is handled by the main process, which logs until the end
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        header = read(fd, HEADER.size)
+        size = HEADER.unpack(header)[0] if len(header) == HEADER.size else 0
+        if not size:
+            break
+        record = logging.makeLogRecord(pickle.loads(read(fd, size)))
+        logger = logging.getLogger(record.name)
+        logger.handle(record)
+    logging.shutdown()
+
+
+def loggers():
+    """ Returns the loggers with handlers. """
+
+    candidates = [logging.getLogger()] + list(logging.Logger.manager.loggerDict.values())
+    return [logger for logger in candidates if isinstance(logger, logging.Logger) and logger.handlers]
+
+
+def start():
+    """ Spawns the log writer and makes every logger of this process (and its future children) send it its records. """
+
+    global log_pipe, writer, owner
+    if writer is not None:
+        return
+    read_fd, log_pipe = os.pipe()
+    writer = Process(target=write, args=(read_fd,), name="Log writer", daemon=True)
+    writer.start()
+    os.close(read_fd)
+    owner = os.getpid()
+    handler = PipeHandler(log_pipe)
+    handler.addFilter(RateLimitFilter(config.LOG_RATE_PERIOD, config.LOG_RATE_BURST))
+    for logger in loggers():
+        # The files are written by the writer: this process only closes its own copies
+        for previous in list(logger.handlers):
+            logger.removeHandler(previous)
+            previous.close()
+        logger.addHandler(handler)
+    atexit.register(stop)
+
+
+def stop():
+    """ Waits until the writer writes the pending records. Only the process that started it stops it. """
+
+    global writer
+    if writer is None or os.getpid() != owner:
+        return
+    os.write(log_pipe, HEADER.pack(0))
+    writer.join(10)
+    writer = None
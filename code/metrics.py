@@ -0,0 +1,250 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+
+""" Live metrics of the crawler and the parsers in the Prometheus text format.
+
+The counters are kept in shared memory created by 'setup' before forking the
+workers, so the workers only have to increment them:
+
+    inc("orm_failures_total", type="timeout")
+
+and the main process serves the totals of all of them at
+http://127.0.0.1:<port>/metrics ('serve'). Every process counts into its own
+slot without locks shared with other processes, so a worker killed at any
+time never blocks the rest: the supervised workers get a new slot each
+('new_slot' / 'use_slot', added to the totals by 'release_slot' once they
+finish) and the workers of a pool claim one of the slots created by 'setup'
+when they start ('claim_slot'). The gauges (queue depths, memory
+of the workers) are computed by collectors each time the endpoint is read.
+Nothing is counted while the metrics are disabled.
+"""
+
+# Basic modules
+import logging
+import logging.config
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Array, Value
+
+try:
+    import psutil
+except ImportError:
+    RuntimeWarning('You will have to install psutil to get the memory of the workers')
+    psutil = None
+
+logging.config.fileConfig('logging.conf')
+
+logger = logging.getLogger("MODULE")
+
+# Counters: name -> [help, label name, label values]
+COUNTERS = {
+    "orm_domains_processed_total": ["Domains visited by the crawler or checked by the tracking parser", "stage",
+                                    ["visit", "tracking"]],
+    "orm_domains_failed_total": ["Domain visits failed after all the tries", None, []],
+    "orm_resources_processed_total": ["Resources stored by the crawler or processed by the parsers", "stage",
+                                      ["store", "codesets", "fingerprints", "tracking"]],
+    "orm_failures_total": ["Failures by type", "type", ["timeout", "webdriver", "sql", "download", "parse", "other"]],
+    "orm_browser_restarts_total": ["Browsers restarted after a failure", None, []],
+    "orm_watchdog_kills_total": ["Workers killed by the watchdog while stuck in a visit", None, []],
+    "orm_hung_seconds_total": ["Seconds spent by the killed workers in their stuck visits", None, []],
+}
+
+# Position of every series inside the shared counters
+series = {}
+for counter_name, (_, label, label_values) in COUNTERS.items():
+    if label is None:
+        series[counter_name] = len(series)
+    for label_value in label_values:
+        series['%s{%s="%s"}' % (counter_name, label, label_value)] = len(series)
+
+# Shared counters of this process (created by the main process before forking the workers), None while disabled
+counters = None
+# Only the threads of this process update its counters
+lock = threading.Lock()
+
+# Main process: counters of the running workers, totals of the finished ones and slots claimed by the pool workers
+slots = []
+retired = None
+claimed = None
+
+
+def setup(workers=0):
+    """ Creates the shared counters of this process and 'workers' slots to be claimed by the workers of a pool.
+    Must be called before creating the workers. """
+
+    global counters, retired, claimed
+    counters = Array('d', len(series), lock=False)
+    retired = [0] * len(series)
+    claimed = Value('i', 0)
+    for _ in range(workers):
+        new_slot()
+
+
+def enabled():
+    return counters is not None
+
+
+def new_slot():
+    """ Creates (in the main process) the counters of a new worker. """
+
+    slot = Array('d', len(series), lock=False)
+    with lock:
+        slots.append(slot)
+    return slot
+
+
+def use_slot(slot):
+    """ Makes the worker count into its slot. Called once the worker starts. """
+
+    global counters, lock
+    counters = slot
+    lock = threading.Lock()
+
+
+def release_slot(slot):
+    """ Adds the counters of the finished worker to the totals and frees its slot. """
+
+    with lock:
+        for index, value in enumerate(slot):
+            retired[index] += value
+        slots.remove(slot)
+
+
+def claim_slot():
+    """ Initializer of the pool workers: takes one of the slots created by 'setup'. """
+
+    global counters, lock
+    lock = threading.Lock()
+    if counters is None:
+        return
+    # Taken when the pool worker starts, before it can be killed in the middle of any work
+    with claimed.get_lock():
+        index = claimed.value
+        claimed.value += 1
+    if index < len(slots):
+        counters = slots[index]
+    else:
+        logger.warning("No metrics slot left for pool worker %d: its work is not counted", os.getpid())
+        counters = None
+
+
+def inc(name, value=1, **labels):
+    """ Increments the counter (of the given label value). """
+
+    if counters is None:
+        return
+    for label, label_value in labels.items():
+        name = '%s{%s="%s"}' % (name, label, label_value)
+    with lock:
+        counters[series[name]] += value
+
+
+def totals():
+    """ Returns the counters added up over this process and all the workers. """
+
+    with lock:
+        values = list(retired)
+        for slot in [counters] + slots:
+            for index, value in enumerate(slot):
+                values[index] += value
+    return values
+
+
+def queue_depth(**queues):
+    """ Returns a collector of the number of items waiting in the given (name=queue) queues. """
+
+    def collect():
+        return [["orm_queue_depth", "gauge", "Items waiting in the queue",
+                 [['queue="%s"' % name, work_queue.qsize()] for name, work_queue in queues.items()]]]
+    return collect
+
+
+def worker_memory():
+    """ Collects the resident memory of every worker (with its browsers and other child processes). """
+
+    if psutil is None:
+        return []
+    samples = []
+    for worker in psutil.Process(os.getpid()).children():
+        try:
+            rss = worker.memory_info().rss
+            for child in worker.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+        except psutil.Error:
+            continue
+        samples.append(['pid="%d"' % worker.pid, rss])
+    return [["orm_worker_rss_bytes", "gauge", "Resident memory of the worker and its child processes", samples],
+            ["orm_workers", "gauge", "Running workers", [[None, len(samples)]]]]
+
+
+def render(collectors=()):
+    """ Returns the counters and the collected gauges in the Prometheus text format. """
+
+    lines = []
+    values = totals() if counters is not None else [0] * len(series)
+    for name, (description, label, label_values) in COUNTERS.items():
+        lines += ["# HELP %s %s" % (name, description), "# TYPE %s counter" % name]
+        keys = [name] if label is None else ['%s{%s="%s"}' % (name, label, value) for value in label_values]
+        lines += ["%s %s" % (key, repr(values[series[key]])) for key in keys]
+    for collector in collectors:
+        try:
+            families = collector()
+        except Exception as e:
+            logger.error("Metrics collector %s failed: %s", collector.__name__, e)
+            continue
+        for name, kind, description, samples in families:
+            lines += ["# HELP %s %s" % (name, description), "# TYPE %s %s" % (name, kind)]
+            lines += ["%s%s %s" % (name, "{%s}" % labels if labels else "", repr(float(value)))
+                      for labels, value in samples]
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serves the metrics at /metrics. """
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render(self.server.collectors).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request from %s: " + format, self.address_string(), *args)
+
+
+def serve(port, collectors=(), address="127.0.0.1"):
+    """ Serves the metrics from a background thread of this process. Returns the server. """
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    server.collectors = list(collectors)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics at http://%s:%d/metrics", address, server.server_address[1])
+    return server
@@ -0,0 +1,116 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+
+""" Typed records of the requests saved by the custom uBlock Origin.
+
+Every sessionStorage entry is a JSON string with the webRequest details of a
+request (plus the custom ones added by ORM). The entries are parsed only once
+with 'parse_requests', which returns a RequestRecord per well-formed entry to
+be used by the rest of the ingestion.
+
+The JSON backend can be changed with config.JSON_BACKEND ("json" or
+"orjson", if installed). Use 'json_loads' and 'json_dumps' to go through it.
+"""
+
+# Basic modules
+import json
+import logging.config
+
+import config
+
+try:
+    import orjson
+except ImportError:
+    RuntimeWarning('You will have to install orjson to use it as JSON backend')
+    orjson = None
+
+logging.config.fileConfig('logging.conf')
+
+logger = logging.getLogger("DATA_MANAGER")
+
+
+def json_loads(data):
+    """ Parses the JSON string with the configured backend. """
+
+    if orjson and config.JSON_BACKEND == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(value):
+    """ Serializes the value to a JSON string with the configured backend. """
+
+    if orjson and config.JSON_BACKEND == "orjson":
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+
+class RequestRecord(object):
+    """
+    Details of a request loaded by the browser. The fields not sent by the
+    extension for the request are None.
+    """
+
+    # sessionStorage entry key of each field
+    FIELDS = {"request_id": "requestId", "tab_id": "tabId", "timestamp": "timeStamp", "url": "url",
+              "method": "method", "type": "type", "origin_url": "originUrl", "third_party": "thirdParty",
+              "blocked": "blocked", "hash": "hash", "body": "body", "from_cache": "from_cache",
+              "server_ip": "server_ip", "request_headers": "request_headers", "response_headers": "response_headers",
+              "security_info": "security_info"}
+
+    __slots__ = list(FIELDS.keys()) + ["key", "certificate"]
+
+    def __init__(self, key, details):
+        self.key = key
+        self.certificate = None
+        for field, name in self.FIELDS.items():
+            setattr(self, field, details.get(name))
+
+    def sort_key(self):
+        """ Returns the key to sort the requests by request id and timestamp (parent requests first). """
+
+        return int(self.request_id), int(self.timestamp or 0)
+
+
+def parse_request(key, value):
+    """ Parses a sessionStorage entry. Returns its record or None if malformed. """
+
+    try:
+        details = json_loads(value)
+    except ValueError:
+        return None
+    if not isinstance(details, dict) or "requestId" not in details.keys():
+        return None
+    return RequestRecord(key, details)
+
+
+def parse_requests(process, request_list):
+    """ Parses the sessionStorage entries (key -> JSON string). Returns the records of the well-formed ones. """
+
+    records = []
+    for key, value in request_list.items():
+        record = parse_request(key, value)
+        if record is None:
+            # TODO: Check the reason for the malformed ones
+            logger.info("(proc. %s) : URL details not present - %s", process, key)
+        else:
+            records.append(record)
+    return records
@@ -0,0 +1,136 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+""" Checks if the resources pending of update changed since they were downloaded. The resources are requested
+with the cache validators (ETag / Last-Modified) of their URLs, so the unchanged ones answer with an empty
+304 response instead of being transferred again. """
+
+# Basic modules
+import argparse
+import os
+import logging.config
+
+# Own modules
+from db_manager import Db, Connector
+from data_manager import download_url, get_executor, new_digest, store_digest, save_resource
+from utils import utc_now, response_validators, conditional_headers
+
+logging.config.fileConfig('logging.conf')
+
+verbose = {"0": logging.CRITICAL, "1": logging.ERROR, "2": logging.WARNING, "3": logging.INFO, "4": logging.DEBUG}
+
+logger = logging.getLogger("MODULE")
+
+
+def load_batch(database, last_id, batch, end):
+    """ Returns the next resources pending of update with the URL (preferably with validators) to check them. """
+
+    rq = "SELECT id, hash, size FROM resource WHERE pending_update = 1 AND id > %d" % last_id
+    if end > 0:
+        rq += " AND id <= %d" % end
+    rq += " ORDER BY id LIMIT %d" % batch
+    resources = database.custom(rq)
+    for resource in resources:
+        rq = "SELECT id AS url_id, url, etag, last_modified FROM url WHERE resource_id = %s"
+        rq += " ORDER BY (etag IS NULL AND last_modified IS NULL), update_timestamp DESC LIMIT 1"
+        urls = database.custom(rq, values=[resource["id"]])
+        resource.update(urls[0] if urls else {"url_id": None})
+    return resources
+
+
+def check_resource(process, resource, temp_folder):
+    """ Requests the resource URL only if it changed since the last download. Returns the download result. """
+
+    digest = new_digest(temp_folder)
+    return digest, download_url(process, resource["url"], digest, headers=conditional_headers(resource))
+
+
+def refresh(database, process, resource, digest, result, stats):
+    """ Updates the resource (and its URL) depending on the response of the conditional request. """
+
+    t = utc_now()
+    if not result or result[0] not in (200, 304):
+        stats["failed"] += 1
+        return
+    status, headers = result
+    if status == 304:
+        stats["not_modified"] += 1
+        stats["saved_bytes"] += resource["size"] or 0
+    else:
+        stats["transferred_bytes"] += digest.size
+        new_hash = digest.hexdigest()
+        if new_hash == resource["hash"]:
+            stats["unchanged"] += 1
+        else:
+            # The URL serves new content: store it as a new resource and link it to the URL
+            stats["changed"] += 1
+            new_resource = Connector(database, "resource")
+            if not new_resource.load(new_hash):
+                new_resource.values["insert_date"] = t
+            new_resource.values["update_timestamp"] = t
+            store_digest(new_resource, digest)
+            save_resource(new_resource)
+            database.custom("UPDATE url SET resource_id = %s WHERE id = %s",
+                            values=[new_resource.values["id"], resource["url_id"]])
+        validators = response_validators(headers)
+        database.custom("UPDATE url SET etag = %s, last_modified = %s, update_timestamp = %s WHERE id = %s",
+                        values=[validators["etag"], validators["last_modified"], t, resource["url_id"]])
+    database.custom("UPDATE resource SET pending_update = 0, update_timestamp = %s WHERE id = %s",
+                    values=[t, resource["id"]])
+
+
+parser = argparse.ArgumentParser(description='Checks the resources pending of update with conditional requests')
+parser.add_argument('-b', dest='batch', type=int, default=500, help='Resources checked per batch (Default: 500)')
+parser.add_argument('-start', dest='start', type=int, default=0, help='Start id (Default: First)')
+parser.add_argument('-end', dest='end', type=int, default=-1, help='End id (Default: Last)')
+parser.add_argument('-v', dest='verbose', type=int, default=3,
+                    help='Verbose: 0=CRITICAL; 1=ERROR; 2=WARNING; 3=INFO; 4=DEBUG (Default: WARNING)')
+parser.add_argument('-d', dest='folder', type=str, default='tmp', help='Temporary folder (Default: "./tmp")')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if verbose[str(args.verbose)]:
+        logger.setLevel(verbose[str(args.verbose)])
+    temp_folder = os.path.join(os.path.abspath("."), args.folder)
+    os.makedirs(temp_folder, exist_ok=True)
+    process = "refresher"
+    counters = {"not_modified": 0, "unchanged": 0, "changed": 0, "failed": 0, "saved_bytes": 0,
+                "transferred_bytes": 0}
+    db = Db()
+    executor = get_executor()
+    last = args.start - 1
+    while True:
+        pending = load_batch(db, last, args.batch, args.end)
+        if not pending:
+            break
+        last = pending[-1]["id"]
+        # Network requests in parallel, database updates from this thread
+        futures = [(item, executor.submit(check_resource, process, item, temp_folder))
+                   for item in pending if item["url_id"]]
+        counters["failed"] += len(pending) - len(futures)
+        for item, future in futures:
+            item_digest, download = future.result()
+            refresh(db, process, item, item_digest, download, counters)
+            item_digest.close()
+        logger.info("Last id %d: %d not modified, %d unchanged, %d changed, %d failed. %.1f MB saved, %.1f MB "
+                    "transferred", last, counters["not_modified"], counters["unchanged"], counters["changed"],
+                    counters["failed"], counters["saved_bytes"] / 2 ** 20, counters["transferred_bytes"] / 2 ** 20)
+    db.close()
@@ -0,0 +1,168 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+
+""" Lightweight tracing of the stages of the visits.
+
+The stages are recorded as spans, with 'span' for blocks:
+
+    with span("screenshot", domain=name):
+        ...
+
+or with 'record' for longer ones (start = now()). Every process keeps its
+spans until 'flush' appends them to 'trace_<pid>.json' inside the trace
+folder, in the Chrome trace event format (open it with chrome://tracing or
+ui.perfetto.dev). The durations of each stage are also kept to compute
+their percentiles ('stats'). Nothing is recorded while tracing is disabled.
+
+Run this module with trace files to get the percentiles of every stage.
+"""
+
+# Basic modules
+import argparse
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Folder where the traces are written (set by ORM.py before spawning the workers), None to disable the tracing
+trace_options = {"folder": None}
+
+# Spans of this process not written yet and last durations of each stage
+events = []
+durations = {}
+lock = threading.Lock()
+
+# Durations kept per stage to compute the percentiles
+DURATIONS_SIZE = 10000
+
+
+def enabled():
+    return trace_options["folder"] is not None
+
+
+def now():
+    """ Returns the current time of the (system-wide monotonic) trace clock. """
+
+    return time.perf_counter()
+
+
+def record(name, start, category="visit", **args):
+    """ Records the span of the stage started at the given trace clock time until now. """
+
+    if trace_options["folder"] is None:
+        return
+    end = time.perf_counter()
+    event = {"name": name, "cat": category, "ph": "X", "ts": int(start * 1e6), "dur": int((end - start) * 1e6),
+             "pid": os.getpid(), "tid": threading.get_ident()}
+    if args:
+        event["args"] = args
+    with lock:
+        events.append(event)
+        if name not in durations.keys():
+            durations[name] = deque(maxlen=DURATIONS_SIZE)
+        durations[name].append(end - start)
+
+
+@contextmanager
+def span(name, category="visit", **args):
+    """ Records the span of the enclosed block. """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start, category, **args)
+
+
+def flush():
+    """ Appends the recorded spans to the trace file of the process. """
+
+    global events
+    if trace_options["folder"] is None:
+        return
+    with lock:
+        pending = events
+        events = []
+    if not pending:
+        return
+    os.makedirs(trace_options["folder"], exist_ok=True)
+    path = os.path.join(trace_options["folder"], "trace_%d.json" % os.getpid())
+    new = not os.path.isfile(path)
+    # JSON array format: the closing bracket is optional, so the file can keep growing
+    with open(path, "a") as f:
+        if new:
+            f.write("[\n")
+        f.write("".join(json.dumps(event) + ",\n" for event in pending))
+
+
+def percentiles(values):
+    """ Returns the count, 50th, 90th and 99th percentiles and maximum of the values. """
+
+    values = sorted(values)
+    if not values:
+        return {"count": 0, "p50": 0, "p90": 0, "p99": 0, "max": 0}
+    result = {"count": len(values), "max": values[-1]}
+    for p in (50, 90, 99):
+        result["p%d" % p] = values[min(len(values) - 1, len(values) * p // 100)]
+    return result
+
+
+def stats():
+    """ Returns the percentiles (seconds) of the last durations of each stage recorded by this process. """
+
+    with lock:
+        return {name: percentiles(values) for name, values in durations.items()}
+
+
+def format_stats(stage_stats):
+    """ Returns the stage percentiles as a text table. """
+
+    lines = ["%-20s %8s %10s %10s %10s %10s" % ("Stage", "Count", "p50 (s)", "p90 (s)", "p99 (s)", "max (s)")]
+    for name in sorted(stage_stats.keys()):
+        item = stage_stats[name]
+        lines.append("%-20s %8d %10.3f %10.3f %10.3f %10.3f" % (name, item["count"], item["p50"], item["p90"],
+                                                                item["p99"], item["max"]))
+    return "\n".join(lines)
+
+
+def load_trace(path):
+    """ Loads the spans of a trace file (with or without the closing bracket). """
+
+    with open(path, "r") as f:
+        content = f.read().rstrip().rstrip(",")
+    if not content.endswith("]"):
+        content += "]"
+    return json.loads(content)
+
+
+parser = argparse.ArgumentParser(description='Percentiles of the stages recorded in trace files')
+parser.add_argument('paths', type=str, nargs='+', help='Trace files written with "ORM.py --trace"')
+
+
+if __name__ == '__main__':
+    arguments = parser.parse_args()
+    stages = {}
+    for trace_path in arguments.paths:
+        for trace_event in load_trace(trace_path):
+            stages.setdefault(trace_event["name"], []).append(trace_event["dur"] / 1e6)
+    print(format_stats({name: percentiles(values) for name, values in stages.items()}))
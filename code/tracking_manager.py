@@ -5,7 +5,6 @@ import json
 import logging
 import logging.config
 import argparse
-import zlib
 import mmap
 import time
 from datetime import datetime, timezone, timedelta
@@ -18,7 +17,11 @@ from setproctitle import setproctitle
 
 # Own modules
 from db_manager import Db, Connector
+from blob_storage import has_blob
+from codec import read_resource
 from utils import hash_string, utc_now, extract_domain
+import log_writer
+import metrics
 
 logging.config.fileConfig('logging.conf')
 
@@ -194,7 +197,7 @@ def get_js_cookies(url):
     # Finish if we don't have the resource in the DB (we only save HTML and JS files)
     resource = Connector(db, "resource")
     resource.load(url.values["resource_id"])
-    if not resource.values["file"]:
+    if not has_blob("resource", resource.values):
         return 0
 
     # Get tracking info
@@ -209,7 +212,7 @@ def get_js_cookies(url):
             return db.custom(request)[0]["quantity"]
 
     # Otherwise extract file and compute
-    code = zlib.decompress(resource.values["file"])
+    code = read_resource(resource.values)
     try:
         formatted_code = str(code, 'utf-8')
     except Exception as e:
@@ -241,7 +244,7 @@ def get_font_fingerprinting(url):
     # Finish if we don't have the resource in the DB (we only save HTML and JS files)
     resource = Connector(db, "resource")
     resource.load(url.values["resource_id"])
-    if not resource.values["file"]:
+    if not has_blob("resource", resource.values):
         return 0
 
     # Get tracking info
@@ -256,7 +259,7 @@ def get_font_fingerprinting(url):
             return db.custom(request)[0]["quantity"]
 
     # Otherwise extract file and compute
-    code = zlib.decompress(resource.values["file"])
+    code = read_resource(resource.values)
     try:
         formatted_code = str(code, 'utf-8')
     except Exception as e:
@@ -350,7 +353,7 @@ def get_canvas_fingerprinting(url):
     # Finish if we don't have the resource in the DB (we only save HTML and JS files)
     resource = Connector(db, "resource")
     resource.load(url.values["resource_id"])
-    if not resource.values["file"]:
+    if not has_blob("resource", resource.values):
         return 0
 
     # Get tracking info
@@ -368,7 +371,7 @@ def get_canvas_fingerprinting(url):
             return 1
 
     # Otherwise extract file and compute
-    code = zlib.decompress(resource.values["file"])
+    code = read_resource(resource.values)
     try:
         formatted_code = str(code, 'utf-8')
     except Exception as e:
@@ -628,7 +631,7 @@ def get_mouse_fingerprinting(url):
     # Finish if we don't have the resource in the DB (we only save HTML and JS files)
     resource = Connector(db, "resource")
     resource.load(url.values["resource_id"])
-    if not resource.values["file"]:
+    if not has_blob("resource", resource.values):
         return url_tracking, 0
 
     # Finish if the file is not a JS script
@@ -647,7 +650,7 @@ def get_mouse_fingerprinting(url):
     # TODO: Replace above bad functioning code with new alternative
     # Otherwise extract file and compute
     resource_tracking = 0
-    code = zlib.decompress(resource.values["file"])
+    code = read_resource(resource.values)
     tmp_filename = os.path.join(os.path.abspath("."), "tmp", url.values["hash"] + ".js")
     with open(tmp_filename, "wb") as js_file:
         js_file.write(code)
@@ -657,7 +660,7 @@ def get_mouse_fingerprinting(url):
         # Probably not an UTF-8 file
         pass
     except Exception as e:
-        logger.info("Mouse tracking error %s" % str(e))
+        logger.info("Mouse tracking error %s", e)
     else:
         if tracker:
             #resource.add(tracking)
@@ -678,7 +681,7 @@ def get_webgl_fingerprint(url):
     # Finish if we don't have the resource in the DB (we only save HTML and JS files)
     resource = Connector(db, "resource")
     resource.load(url.values["resource_id"])
-    if not resource.values["file"]:
+    if not has_blob("resource", resource.values):
         return 0
 
     # Get tracking info
@@ -693,7 +696,7 @@ def get_webgl_fingerprint(url):
             return 1
     
     # Otherwise extract file and compute
-    code = zlib.decompress(resource.values["file"])
+    code = read_resource(resource.values)
     try:
         formatted_code = str(code, 'utf-8')
     except Exception as e:
@@ -746,17 +749,17 @@ def get_webgl_fingerprint(url):
 
 def check_tracking(url, domain):
     """ Checks all the possible tracking for the given url and domain. """
-    logger.info("Looking URL %s for HTTP cookies" % url.values["url"])
+    logger.info("Looking URL %s for HTTP cookies", url.values["url"])
     get_http_cookies(url, domain)
-    logger.info("Looking URL %s for JS cookies" % url.values["url"])
+    logger.info("Looking URL %s for JS cookies", url.values["url"])
     get_js_cookies(url)
-    logger.info("Looking URL %s for font fingerprinting" % url.values["url"])
+    logger.info("Looking URL %s for font fingerprinting", url.values["url"])
     get_font_fingerprinting(url)
-    logger.info("Looking URL %s for canvas fingerprinting" % url.values["url"])
+    logger.info("Looking URL %s for canvas fingerprinting", url.values["url"])
     get_canvas_fingerprinting(url)
-    logger.info("Looking URL %s for mouse fingerprinting" % url.values["url"])
+    logger.info("Looking URL %s for mouse fingerprinting", url.values["url"])
     get_mouse_fingerprinting(url)
-    logger.info("Looking URL %s for WebGL fingerprinting" % url.values["url"])
+    logger.info("Looking URL %s for WebGL fingerprinting", url.values["url"])
     get_webgl_fingerprint(url)
 
 
@@ -778,19 +781,21 @@ def main(process):
             queue_lock.release()
             #exit(0)
         except Exception as e:
-            logger.error("[Worker %d] %s" % (process, str(e)))
+            logger.error("[Worker %d] %s", process, e)
         else:
             domain = Connector(db, "domain")
             domain.load(site)
             setproctitle("ORM - Worker #%d - %s" % (process, domain.values["name"]))
-            logger.info('[Worker %d] Domain %s' % (process, domain.values["name"]))
+            logger.info('[Worker %d] Domain %s', process, domain.values["name"])
             url_list = domain.get("url", order="url_id")
             for url in url_list:
                 resource = Connector(db, "resource")
                 resource.load(url.values["resource_id"])
                 if int(resource.values["size"]) > 0:
-                    logger.info('[Worker %d] Domain %s URL %s' % (process, domain.values["name"], url.values["url"]))
+                    logger.info('[Worker %d] Domain %s URL %s', process, domain.values["name"], url.values["url"])
                     check_tracking(url, domain)
+                    metrics.inc("orm_resources_processed_total", stage="tracking")
+            metrics.inc("orm_domains_processed_total", stage="tracking")
 
 
 argument_parser = argparse.ArgumentParser(description='Tracking parser')
@@ -800,6 +805,8 @@ argument_parser.add_argument('-start', dest='current', type=int, default=0,
                     help='Id for the starting domain (Default: 0).')
 argument_parser.add_argument('-end', dest='end', type=int, default=0,
                     help='Id for the starting domain (Default: All).')
+argument_parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=0,
+                    help='Local port serving the live metrics of the tracking parser at /metrics (Default: 0, disabled)')
 
 if __name__ == '__main__':
     """ Main process """
@@ -807,6 +814,7 @@ if __name__ == '__main__':
     # Take arguments
     args = argument_parser.parse_args()
     threads = args.threads
+    log_writer.start()
     # If thread parameter is auto get the (total-1) or the available CPU's, whichever is smaller
     logger.info("Calculating processes...")
     if not threads:
@@ -821,15 +829,19 @@ if __name__ == '__main__':
             threads = cpu - 1
         else:
             threads = available_cpu
-    logger.info("Processes to run: %d " % threads)
+    logger.info("Processes to run: %d ", threads)
     # Initialize job queue
     work_queue = Queue()
     queue_lock = Lock()
+    if args.metrics_port:
+        metrics.setup(threads)
 
     # Create and call the workers
     logger.info("[Main process] Spawning new workers...")
-    with Pool(processes=threads) as pool:
+    with Pool(processes=threads, initializer=metrics.claim_slot) as pool:
         p = pool.map_async(main, [i for i in range(int(threads))])
+        if args.metrics_port:
+            metrics.serve(args.metrics_port, [metrics.queue_depth(domains=work_queue), metrics.worker_memory])
 
         pending = ["0"]
         current = int(args.current)
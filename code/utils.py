@@ -18,17 +18,29 @@
 
 # -*- coding: utf-8 -*-
 
-import socket
+import io
+import os
+import glob
+import math
+import tarfile
+import threading
 import ssl
+import tempfile
+from collections import OrderedDict
+from functools import lru_cache
 from datetime import datetime, timezone, timedelta
 from hashlib import sha256
-from urllib.parse import urlparse
+from multiprocessing import Array
+from urllib.parse import urlparse, scheme_chars
 
 import requests
 import tldextract
+from asn1crypto import x509
 from geoip2 import database
 from geoip2.errors import AddressNotFoundError
 
+from dns_resolver import get_resolver
+
 import config
 
 try:
@@ -39,6 +51,13 @@ except ImportError:
     RuntimeWarning('You will have to install tlsh python extension manually'
                    ' (https://github.com/trendmicro/tlsh) to get local space hashing functionality')
     tlsh_func = lambda x: ''
+    tlsh = None
+
+try:
+    from PIL import Image
+except ImportError:
+    RuntimeWarning('You will have to install Pillow to downscale, re-encode and hash the screenshots')
+    Image = None
 
 
 def utc_now():
@@ -51,15 +70,7 @@ def utc_now():
 def extract_address(url):
     """ Extract IP address from URL. """
 
-    url = extract_domain(url)
-    address = None
-    fails = 0
-    while not address and fails < 10:
-        try:
-            address = socket.gethostbyname(url)
-        except Exception as e:
-            fails += 1
-    return address
+    return get_resolver().resolve(extract_domain(url))
 
 
 def extract_domain(url):
@@ -68,16 +79,50 @@ def extract_domain(url):
     return urlparse(url).hostname
 
 
-def clean_subdomain(url):
-    """ Extracts the base domain (without subdomain) from the URL. """
+suffix_extractor = None
+
+
+def load_suffix_list():
+    """ Loads the bundled public suffix list once per process. tldextract never goes to the network for it. """
+
+    global suffix_extractor
+    if suffix_extractor is None:
+        # Without cache folder nor remote lists the suffixes only come from the file (or the tldextract snapshot)
+        suffix_extractor = tldextract.TLDExtract(cache_dir=None, fallback_to_snapshot=True,
+                                                 suffix_list_urls=["file://" + config.PUBLIC_SUFFIX_FILE_PATH])
+        suffix_extractor("example.com")
+    return suffix_extractor
+
+
+def url_host(url):
+    """ Returns the host name of the URL (or of a host name without scheme), as tldextract splits it. """
+
+    scheme = url.find("//")
+    if scheme == 0 or (scheme > 1 and url[scheme - 1] == ":" and set(url[:scheme - 1]) <= set(scheme_chars)):
+        url = url[scheme + 2:]
+    host = url.partition("/")[0].partition("?")[0].partition("#")[0].rpartition("@")[2]
+    if host.startswith("[") and "]" in host:
+        return host.partition("]")[0] + "]"
+    return host.partition(":")[0].strip().rstrip(".\u3002\uff0e\uff61")
 
-    extracted_domain = tldextract.extract(url)
+
+@lru_cache(maxsize=config.DOMAIN_CACHE_SIZE)
+def registered_domain(host):
+    """ Returns the base domain (domain and public suffix) of the host name. """
+
+    extracted_domain = load_suffix_list()(host)
     domain = extracted_domain[1]
     if extracted_domain[2]:
         domain = domain + "." + extracted_domain[2]
     return domain
 
 
+def clean_subdomain(url):
+    """ Extracts the base domain (without subdomain) from the URL. """
+
+    return registered_domain(url_host(url))
+
+
 def extract_components(url):
     """ Returns a dict with the URL components. """
 
@@ -88,43 +133,130 @@ def extract_components(url):
     return components
 
 
-def extract_location(address, reader=None):
-    """ Extract country from URL. """
+def extract_location(address, locator=None):
+    """ Extract country from URL. Uses the process geolocation databases unless other locator is given. """
 
-    location = {'continent_code': None, 'country_code': None, 'is_EU': 0, 'city': None,
-                'latitude': 0, 'longitude': 0, 'accuracy_radius': 0}
-    if address:
-        if not reader:
-            reader = database.Reader(config.CITY_FILE_PATH)
-        try:
-            response = reader.city(address)
-        except AddressNotFoundError:
-            pass
-        else:
-            location['continent_code'] = response.continent.code
-            location['country_code'] = response.country.iso_code
-            location['is_EU'] = response.country.is_in_european_union
-            location['city'] = response.city.name
-            location['latitude'] = response.location.latitude
-            location['longitude'] = response.location.longitude
-            location['accuracy_radius'] = response.location.accuracy_radius
-    return location
+    if not address:
+        return GeoLocator.empty_location()
+    if locator is None:
+        locator = get_geo_locator()
+    return locator.locate(address)
 
 
-def download_file(url, destination, headers=None, verify=True):
-    """ Downloads a file. """
+def download_file(url, destination, headers=None, verify=True, session=None):
+    """ Downloads a file (using the given requests session if any). Returns the destination, the response headers
+    and the status code. """
 
     h = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:45.0) Gecko/20100101 Firefox/45.0'}
     if headers is not None:
         h.update(headers)
 
-    resp = requests.get(url, stream=True, headers=h, timeout=(6, 27), verify=verify)
+    getter = session.get if session is not None else requests.get
+    resp = getter(url, stream=True, headers=h, timeout=(6, 27), verify=verify)
     for chunk in resp.iter_content(chunk_size=4096):
         if chunk:
             destination.write(chunk)
 
     destination.seek(0)
-    return destination, resp.headers
+    return destination, resp.headers, resp.status_code
+
+
+def response_validators(headers):
+    """ Returns the cache validators (etag and last_modified) found in the given response headers. """
+
+    validators = {"etag": None, "last_modified": None}
+    for name, value in headers.items():
+        if name.lower() == "etag":
+            validators["etag"] = value[:255]
+        elif name.lower() == "last-modified":
+            validators["last_modified"] = value[:64]
+    return validators
+
+
+def conditional_headers(validators):
+    """ Returns the request headers to download a resource only if it changed since the given validators. """
+
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+class StreamDigest(object):
+    """
+    Write-only file-like object that computes the sha256 and tlsh hashes of
+    the data written into it and compresses it in a single pass. The
+    compressed data is kept in memory up to 'spool_size' bytes and spilled
+    to a temporary file inside 'folder' beyond it.
+    """
+
+    def __init__(self, compressor_factory, codec=None, spool_size=2 ** 21, folder=None):
+        self.compressor_factory = compressor_factory
+        self.codec = codec
+        self.spool_size = spool_size
+        self.folder = folder
+        self.spool = None
+        self.truncate()
+
+    def truncate(self, size=0):
+        """ Discards all the data written (e.g. to restart a failed download). """
+
+        self.close()
+        self.sha256 = sha256()
+        self.tlsh = tlsh.Tlsh() if tlsh else None
+        self.compressor = self.compressor_factory()
+        self.spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size, dir=self.folder)
+        self.size = 0
+
+    def seek(self, offset, whence=0):
+        """ Nothing to do as the data can not be read back, kept for compatibility with files. """
+
+        return 0
+
+    def write(self, data):
+        """ Hashes and compresses the data. """
+
+        self.sha256.update(data)
+        if self.tlsh is not None:
+            self.tlsh.update(data)
+        self.spool.write(self.compressor.compress(data))
+        self.size += len(data)
+        return len(data)
+
+    def hexdigest(self):
+        """ Returns the SHA256 of the data written. """
+
+        return self.sha256.hexdigest()
+
+    def lsh(self):
+        """ Returns the tlsh (fuzzy matching hash) of the data written. """
+
+        if self.tlsh is None:
+            return tlsh_func(b"")
+        try:
+            self.tlsh.final()
+            return self.tlsh.hexdigest()
+        except ValueError:
+            # Not enough data (or variety) to compute the hash
+            return tlsh_func(b"")
+
+    def compressed(self):
+        """ Finishes the compression and returns the compressed data. """
+
+        self.spool.write(self.compressor.flush())
+        self.spool.seek(0)
+        data = self.spool.read()
+        self.close()
+        return data
+
+    def close(self):
+        """ Removes the compressed data. """
+
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
 
 
 def lsh_file(filename):
@@ -134,6 +266,12 @@ def lsh_file(filename):
         return tlsh_func(f.read())
 
 
+def lsh_bytes(data):
+    """ Calculates the tlsh (fuzzy matching hash) of the given bytes. """
+
+    return tlsh_func(data)
+
+
 def hash_file(filename, hash_func=sha256):
     """ Calculates SHA256 of a file. """
 
@@ -152,6 +290,12 @@ def hash_string(s, hash_func=sha256):
     return h.hexdigest()
 
 
+def hash_bytes(data, hash_func=sha256):
+    """ Calculates SHA256 of the given bytes. """
+
+    return hash_func(data).hexdigest()
+
+
 def certificate_to_json(filepath):
     certificate = dict(ssl._ssl._test_decode_cert(filepath))
     for key in certificate.keys():
@@ -169,3 +313,316 @@ def certificate_to_json(filepath):
                 names.append(elem[1])
             certificate[key] = names
     return certificate
+
+
+# OpenSSL long names of the certificate name attributes (as returned by the ssl module)
+NAME_ATTRIBUTES = {"2.5.4.3": "commonName", "2.5.4.4": "surname", "2.5.4.5": "serialNumber", "2.5.4.6": "countryName",
+                   "2.5.4.7": "localityName", "2.5.4.8": "stateOrProvinceName", "2.5.4.9": "streetAddress",
+                   "2.5.4.10": "organizationName", "2.5.4.11": "organizationalUnitName", "2.5.4.12": "title",
+                   "2.5.4.15": "businessCategory", "2.5.4.17": "postalCode", "2.5.4.41": "name",
+                   "2.5.4.42": "givenName", "2.5.4.43": "initials", "2.5.4.44": "generationQualifier",
+                   "2.5.4.45": "x500UniqueIdentifier", "2.5.4.46": "dnQualifier", "2.5.4.65": "pseudonym",
+                   "2.5.4.97": "organizationIdentifier", "1.2.840.113549.1.9.1": "emailAddress",
+                   "0.9.2342.19200300.100.1.1": "userId", "0.9.2342.19200300.100.1.25": "domainComponent",
+                   "1.3.6.1.4.1.311.60.2.1.1": "jurisdictionLocalityName",
+                   "1.3.6.1.4.1.311.60.2.1.2": "jurisdictionStateOrProvinceName",
+                   "1.3.6.1.4.1.311.60.2.1.3": "jurisdictionCountryName"}
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def decode_name(name):
+    """ Returns the certificate name as the ssl module does: a tuple of RDNs with (attribute, value) pairs. """
+
+    rdns = []
+    for rdn in name.chosen:
+        rdns.append(tuple((NAME_ATTRIBUTES.get(attribute["type"].dotted, attribute["type"].dotted),
+                           str(attribute["value"].native)) for attribute in rdn))
+    return tuple(rdns)
+
+
+def decode_time(time):
+    """ Returns the certificate time as the ssl module does (e.g. 'Jan  5 12:00:00 2021 GMT'). """
+
+    t = time.native
+    return "%s %2d %02d:%02d:%02d %d GMT" % (MONTHS[t.month - 1], t.day, t.hour, t.minute, t.second, t.year)
+
+
+def raw_string(general_name):
+    """ Returns the general name string as written in the certificate (asn1crypto decodes IDNA and IRIs). """
+
+    return general_name.chosen.contents.decode("utf-8", "replace")
+
+
+def decode_general_name(general_name):
+    """ Returns the (type, value) pair of a subject alternative name as the ssl module does. """
+
+    if general_name.name == "dns_name":
+        return "DNS", raw_string(general_name)
+    elif general_name.name == "rfc822_name":
+        return "email", raw_string(general_name)
+    elif general_name.name == "uniform_resource_identifier":
+        return "URI", raw_string(general_name)
+    elif general_name.name == "ip_address":
+        address = general_name.chosen.contents
+        if len(address) == 4:
+            return "IP Address", ".".join(str(byte) for byte in address)
+        elif len(address) == 16:
+            return "IP Address", ":".join("%X" % int.from_bytes(address[i:i + 2], "big") for i in range(0, 16, 2))
+        return "IP Address", "<invalid>"
+    elif general_name.name == "directory_name":
+        return "DirName", decode_name(general_name.chosen)
+    elif general_name.name == "registered_id":
+        return "Registered ID", general_name.chosen.dotted
+    elif general_name.name == "x400_address":
+        return "X400Name", "<unsupported>"
+    elif general_name.name == "edi_party_name":
+        return "EdiPartyName", "<unsupported>"
+    return "othername", "<unsupported>"
+
+
+def der_certificate_to_json(der):
+    """ Parses the DER certificate in memory returning the same information as 'certificate_to_json'. """
+
+    certificate = x509.Certificate.load(der)
+    tbs = certificate["tbs_certificate"]
+    serial = "%X" % tbs["serial_number"].native
+    result = {"subject": dict(pair for rdn in decode_name(tbs["subject"]) for pair in rdn),
+              "issuer": dict(pair for rdn in decode_name(tbs["issuer"]) for pair in rdn),
+              "version": int(tbs["version"].native[1:]),
+              "serialNumber": serial if len(serial) % 2 == 0 else "0" + serial,
+              "notBefore": decode_time(tbs["validity"]["not_before"]),
+              "notAfter": decode_time(tbs["validity"]["not_after"])}
+    if certificate.subject_alt_name_value is not None:
+        result["subjectAltName"] = [decode_general_name(name)[1] for name in certificate.subject_alt_name_value]
+    ocsp = []
+    ca_issuers = []
+    if certificate.authority_information_access_value is not None:
+        for access in certificate.authority_information_access_value:
+            location = access["access_location"]
+            if location.name != "uniform_resource_identifier":
+                continue
+            if access["access_method"].native == "ocsp":
+                ocsp.append(raw_string(location))
+            elif access["access_method"].native == "ca_issuers":
+                ca_issuers.append(raw_string(location))
+    if ocsp:
+        result["OCSP"] = ocsp[0]
+    if ca_issuers:
+        result["caIssuers"] = ca_issuers[0]
+    crl_points = []
+    if certificate.crl_distribution_points_value is not None:
+        for point in certificate.crl_distribution_points_value:
+            if point["distribution_point"].name != "full_name":
+                continue
+            for name in point["distribution_point"].chosen:
+                if name.name == "uniform_resource_identifier":
+                    crl_points.append(raw_string(name))
+    if crl_points:
+        result["crlDistributionPoints"] = crl_points[0]
+    return result
+
+
+class LRUCache(object):
+    """ Thread-safe dictionary keeping only the most recently used 'size' items. """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """ Returns the value of the key (marking it as recently used) or the default value. """
+
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        """ Saves the value of the key removing the least recently used item if full. """
+
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+def extract_geolite(path):
+    """ Extracts the database from the newest GeoLite2 archive of its folder if it does not exist yet. Returns
+    whether the database is available. """
+
+    if os.path.isfile(path):
+        return True
+    name = os.path.basename(path)
+    archives = sorted(glob.glob(os.path.join(os.path.dirname(path), os.path.splitext(name)[0] + "_*.tar.gz")))
+    if not archives:
+        return False
+    with tarfile.open(archives[-1]) as archive:
+        for member in archive.getmembers():
+            if os.path.basename(member.name) == name:
+                with archive.extractfile(member) as source, open(path + ".tmp", "wb") as f:
+                    f.write(source.read())
+                os.replace(path + ".tmp", path)
+                return True
+    return False
+
+
+class GeoLocator(object):
+    """
+    GeoLite2 City and ASN databases, memory-mapped so the processes forked
+    after opening them share the same pages, with a cache of the located
+    addresses. Without ASN database only the location is returned.
+    """
+
+    def __init__(self, city_path=None, asn_path=None, cache_size=None):
+        self.city = database.Reader(city_path or config.GEOCITY_FILE_PATH, mode=database.MODE_MMAP)
+        asn_path = asn_path or config.GEOASN_FILE_PATH
+        self.asn = database.Reader(asn_path, mode=database.MODE_MMAP) if extract_geolite(asn_path) else None
+        self.cache = LRUCache(cache_size or config.GEOLOCATION_CACHE_SIZE)
+        self.not_found = 0
+
+    @staticmethod
+    def empty_location():
+        """ Returns the location of the unknown addresses. """
+
+        return {'continent_code': None, 'country_code': None, 'is_EU': 0, 'city': None, 'latitude': 0,
+                'longitude': 0, 'accuracy_radius': 0, 'asn': None, 'as_organization': None}
+
+    def lookup(self, address):
+        """ Searches the address inside the databases. """
+
+        location = self.empty_location()
+        try:
+            response = self.city.city(address)
+        except (AddressNotFoundError, ValueError):
+            self.not_found += 1
+        else:
+            location['continent_code'] = response.continent.code
+            location['country_code'] = response.country.iso_code
+            location['is_EU'] = response.country.is_in_european_union
+            location['city'] = response.city.name
+            location['latitude'] = response.location.latitude
+            location['longitude'] = response.location.longitude
+            location['accuracy_radius'] = response.location.accuracy_radius
+        if self.asn:
+            try:
+                response = self.asn.asn(address)
+            except (AddressNotFoundError, ValueError):
+                pass
+            else:
+                location['asn'] = response.autonomous_system_number
+                location['as_organization'] = response.autonomous_system_organization
+        return location
+
+    def locate(self, address):
+        """ Returns the location (and autonomous system) of the IP address. """
+
+        location = self.cache.get(address)
+        if location is None:
+            location = self.lookup(address)
+            self.cache.put(address, location)
+        return dict(location)
+
+    def stats(self):
+        """ Returns the cache statistics of this process. """
+
+        lookups = self.cache.hits + self.cache.misses
+        return {"lookups": lookups, "hits": self.cache.hits, "hit_rate": self.cache.hits / lookups if lookups else 0,
+                "not_found": self.not_found, "cached": len(self.cache.items)}
+
+    def close(self):
+        self.city.close()
+        if self.asn:
+            self.asn.close()
+
+
+geo_locator = None
+
+
+def get_geo_locator():
+    """ Returns the geolocation databases of the process, opening them the first time. """
+
+    global geo_locator
+    if geo_locator is None:
+        geo_locator = GeoLocator()
+    return geo_locator
+
+
+def encode_image(png, image_format="png", quality=80, scale=1.0):
+    """ Downscales and re-encodes a PNG image. Returns the image and its final format.
+
+    Without Pillow the original PNG is returned untouched. """
+
+    if not Image or (image_format == "png" and scale == 1.0):
+        return png, "png"
+    image = Image.open(io.BytesIO(png))
+    if scale != 1.0:
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.BILINEAR)
+    if image_format == "jpeg":
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    if image_format == "png":
+        image.save(output, format="PNG", optimize=True)
+    else:
+        image.save(output, format=image_format.upper(), quality=quality)
+    return output.getvalue(), image_format
+
+
+def image_hash(png, size=8):
+    """ Calculates the difference hash (perceptual hash) of an image as a hex string. """
+
+    if not Image:
+        return None
+    image = Image.open(io.BytesIO(png)).convert("L").resize((size + 1, size), Image.BILINEAR)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            value = (value << 1) | (pixels[row * (size + 1) + col] > pixels[row * (size + 1) + col + 1])
+    return "%0*x" % (size * size // 4, value)
+
+
+def hash_distance(hash_1, hash_2):
+    """ Returns the hamming distance between two hex hashes. """
+
+    return bin(int(hash_1, 16) ^ int(hash_2, 16)).count("1")
+
+
+class BloomFilter(object):
+    """
+    Probabilistic set of hex hashes kept in shared memory, so the processes
+    forked after its creation see the hashes added by any of them.
+
+    A hash not found in the filter was never added (unless two processes
+    set bits of the same byte at once, as the bits are written without lock
+    so a killed worker can never block the rest). A hash found in the
+    filter was added with a probability of (1 - error_rate).
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.functions = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = Array('B', (self.size + 7) // 8, lock=False)
+
+    def __positions(self, hex_hash):
+        """ Returns the bit positions of the hash using double hashing over its own (uniform) digits. """
+
+        h1 = int(hex_hash[0:16], 16)
+        h2 = int(hex_hash[16:32], 16) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.functions)]
+
+    def add(self, hex_hash):
+        """ Adds the hash to the filter. """
+
+        for position in self.__positions(hex_hash):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, hex_hash):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(hex_hash))
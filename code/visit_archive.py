@@ -0,0 +1,138 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+
+""" Archives with the raw data of the visits, to ingest them again offline.
+
+Every archive is a zip file with:
+
+- 'visit.json': domain name, plugin id, date of the visit, domain values
+  (without the screenshot) and codec of each recorded body.
+- 'requests.json': the sessionStorage entries saved by uBlock for the visit.
+- 'screenshot': the screenshot image, if any.
+- 'bodies/<hash>': the resource files of the visit, compressed with their codec.
+
+While crawling, the archive collects the downloads done by the ingestion
+and the stored files of the resources already known, so the visit can be
+replayed into an empty database, and is saved once the visit is stored. Loaded archives are replayed: the
+ingestion takes the resources from them instead of downloading them.
+"""
+
+# Basic modules
+import os
+import re
+import threading
+import zipfile
+
+from codec import decompress
+from request_record import parse_requests, json_dumps, json_loads
+from utils import utc_now
+
+
+class VisitArchive(object):
+    """ Raw data of a visit being recorded or replayed. """
+
+    def __init__(self, folder, domain_name, plugin_id, request_list, values, date=None):
+        self.folder = folder
+        self.domain_name = domain_name
+        self.plugin_id = plugin_id
+        # sessionStorage entries (key -> JSON string)
+        self.request_list = request_list
+        self.values = values
+        self.date = date or utc_now()
+        # Resource hash -> [compressed file, codec]
+        self.bodies = {}
+        self.lock = threading.Lock()
+        self.replaying = False
+
+    def requests(self, process):
+        """ Returns the request records of the visit. """
+
+        return parse_requests(process, self.request_list)
+
+    def add_body(self, resource_hash, data, codec):
+        """ Records the compressed file (downloaded or already stored) of the resource. """
+
+        with self.lock:
+            self.bodies[resource_hash] = [data, codec]
+
+    def replay_body(self, resource_hash, destination):
+        """ Writes the recorded file of the resource into the destination. Returns False if not recorded. """
+
+        if resource_hash not in self.bodies.keys():
+            return False
+        data, codec = self.bodies[resource_hash]
+        destination.write(decompress(data, codec))
+        return True
+
+    def filename(self):
+        """ Returns the archive path inside its folder. """
+
+        name = re.sub(r"[^A-Za-z0-9.-]", "_", self.domain_name)
+        date = re.sub(r"[^0-9]", "", self.date)
+        return os.path.join(self.folder, "%s_%s_%s.zip" % (name, self.plugin_id, date))
+
+    def save(self):
+        """ Writes the archive (replacing it atomically). Returns its path. """
+
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.filename()
+        values = {key: value for key, value in self.values.items() if key != "screenshot"}
+        with self.lock:
+            codecs = {resource_hash: body[1] for resource_hash, body in self.bodies.items()}
+            with zipfile.ZipFile(path + ".tmp", "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                archive.writestr("visit.json", json_dumps({"domain": self.domain_name, "plugin_id": self.plugin_id,
+                                                           "date": self.date, "values": values, "bodies": codecs}))
+                archive.writestr("requests.json", json_dumps(self.request_list))
+                # Images and bodies are already compressed
+                if self.values.get("screenshot"):
+                    archive.writestr("screenshot", self.values["screenshot"], compress_type=zipfile.ZIP_STORED)
+                for resource_hash, body in self.bodies.items():
+                    archive.writestr("bodies/" + resource_hash, body[0], compress_type=zipfile.ZIP_STORED)
+        os.replace(path + ".tmp", path)
+        return path
+
+    @staticmethod
+    def load(path):
+        """ Loads an archive to replay it. """
+
+        with zipfile.ZipFile(path) as archive:
+            visit = json_loads(archive.read("visit.json"))
+            values = visit["values"]
+            if "screenshot" in archive.namelist():
+                values["screenshot"] = archive.read("screenshot")
+            loaded = VisitArchive(os.path.dirname(path), visit["domain"], visit["plugin_id"],
+                                  json_loads(archive.read("requests.json")), values, visit["date"])
+            for resource_hash, codec in visit["bodies"].items():
+                loaded.bodies[resource_hash] = [archive.read("bodies/" + resource_hash), codec]
+        loaded.replaying = True
+        return loaded
+
+
+def list_archives(paths):
+    """ Returns the archives given or contained in the given folders, sorted by name. """
+
+    archives = []
+    for path in paths:
+        if os.path.isdir(path):
+            archives += [os.path.join(path, name) for name in os.listdir(path) if name.endswith(".zip")]
+        else:
+            archives.append(path)
+    return sorted(archives)
@@ -0,0 +1,112 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+""" Ingests again the visits recorded with "ORM.py --record" without browser nor network: the recorded requests,
+screenshots and resource files go through the same ingestion as the crawl. Reports the ingestion throughput, so it
+is also a reproducible benchmark of the storage of the visits. """
+
+# Basic modules
+import argparse
+import os
+import time
+import logging.config
+from multiprocessing import Pool
+
+# Own modules
+from db_manager import Db, Connector
+from data_manager import ingest_visit, ingest_options
+from utils import utc_now, hash_string, load_suffix_list, get_geo_locator
+from visit_archive import VisitArchive, list_archives
+import log_writer
+
+logging.config.fileConfig('logging.conf')
+
+verbose = {"0": logging.CRITICAL, "1": logging.ERROR, "2": logging.WARNING, "3": logging.INFO, "4": logging.DEBUG}
+
+logger = logging.getLogger("MODULE")
+
+
+def replay(db, process, path, temp_folder, geo_db):
+    """ Stores the visit of the archive, replacing the URLs linked to its domain. Returns the requests stored. """
+
+    archive = VisitArchive.load(path)
+    plugin = Connector(db, "plugin")
+    if not plugin.load(archive.plugin_id):
+        raise ValueError("plugin %s of %s does not exist" % (archive.plugin_id, path))
+    domain = Connector(db, "domain")
+    if not domain.load(hash_string(archive.domain_name)):
+        domain.values["name"] = archive.domain_name
+        domain.values["insert_date"] = utc_now()
+        domain.save()
+    db.custom("DELETE FROM domain_url WHERE domain_id = %s AND plugin_id = %s",
+              values=[domain.values["id"], plugin.values["id"]])
+    records = archive.requests(process)
+    ingest_visit(db, process, domain, records, plugin, temp_folder, geo_db, dict(archive.values), archive)
+    return len(records)
+
+
+def worker(arguments):
+    """ Replays the given archives with its own database connection. Returns its counters. """
+
+    process, paths, temp_folder = arguments
+    db = Db()
+    geo_db = get_geo_locator()
+    stats = {"visits": 0, "requests": 0, "failed": 0}
+    for path in paths:
+        try:
+            stats["requests"] += replay(db, process, path, temp_folder, geo_db)
+            stats["visits"] += 1
+        except Exception as e:
+            logger.error("(proc. %d) Could not replay %s: %s", process, path, e)
+            stats["failed"] += 1
+    db.close()
+    return stats
+
+
+parser = argparse.ArgumentParser(description='Replays the visits archived while crawling')
+parser.add_argument('paths', type=str, nargs='+', help='Archives or folders with archives')
+parser.add_argument('-t', dest='threads', type=int, default=1, help='Number of processes (Default: 1)')
+parser.add_argument('-v', dest='verbose', type=int, default=3,
+                    help='Verbose: 0=CRITICAL; 1=ERROR; 2=WARNING; 3=INFO; 4=DEBUG (Default: WARNING)')
+parser.add_argument('-d', dest='folder', type=str, default='tmp', help='Temporary folder (Default: "./tmp")')
+parser.add_argument('--batch-ingest', dest='batch_ingest', action="store_true",
+                    help='Stores the URLs of each visit with a few requests per table (Default: one URL at a time)')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if verbose[str(args.verbose)]:
+        logger.setLevel(verbose[str(args.verbose)])
+    log_writer.start()
+    temp_folder = os.path.join(os.path.abspath("."), args.folder)
+    ingest_options["batch"] = args.batch_ingest
+    load_suffix_list()
+    get_geo_locator()
+    archives = list_archives(args.paths)
+    threads = max(1, min(args.threads, len(archives)))
+    logger.info("Replaying %d visits with %d processes", len(archives), threads)
+    start = time.perf_counter()
+    with Pool(processes=threads) as pool:
+        results = pool.map(worker, [(i, archives[i::threads], temp_folder) for i in range(threads)])
+    elapsed = time.perf_counter() - start
+    totals = {key: sum(result[key] for result in results) for key in ["visits", "requests", "failed"]}
+    logger.info("%d visits (%d requests) replayed in %.1f s, %d failed: %.2f visits/s, %.1f requests/s",
+                totals["visits"], totals["requests"], elapsed, totals["failed"], totals["visits"] / elapsed,
+                totals["requests"] / elapsed)
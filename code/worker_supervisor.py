@@ -0,0 +1,352 @@
+"""
+ *
+ * Copyright (C) 2020 Universitat Politècnica de Catalunya.
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at:
+ *
+ *     http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ *
+"""
+
+# -*- coding: utf-8 -*-
+
+
+""" Supervisor of the crawler worker processes.
+
+Every worker runs 'target(number, stop_event, visit)' and must return soon
+after its stop event is set (e.g. once its current domain is visited). The
+supervisor replaces the workers that die and, with autoscaling, adapts their number
+within the given bounds to the pressure of the system, checked every
+AUTOSCALE_INTERVAL seconds:
+
+- Used memory over AUTOSCALE_MEMORY_HIGH: the intake is paused ('paused'),
+  so the workers only finish the enqueued domains.
+- Used memory over AUTOSCALE_MEMORY_CRITICAL: the worker using more memory
+  (with its browsers) is retired.
+- CPU usage over AUTOSCALE_CPU_HIGH: the newest worker is retired.
+- CPU usage under AUTOSCALE_CPU_LOW, without memory pressure and with work
+  waiting: a new worker is started.
+
+The number of workers changes at most once every AUTOSCALE_COOLDOWN seconds.
+A worker whose memory exceeds AUTOSCALE_WORKER_RSS_LIMIT is always replaced
+by a fresh one, releasing the memory of its browsers.
+
+The supervisor is also a watchdog: the workers tell which domains they are
+visiting with 'watched(visit, domain_ids)' and the workers still visiting
+them after 'budget' seconds are killed (with their browsers) and replaced.
+The time lost in these hung visits is reported as lost capacity. A worker is
+only killed while holding the lock the workers take between their visits
+(e.g. to take domains from the queue), so it never dies holding it.
+"""
+
+# Basic modules
+import logging
+import logging.config
+import time
+from contextlib import contextmanager
+from multiprocessing import Process, Event, Array
+
+try:
+    import psutil
+except ImportError:
+    RuntimeWarning('You will have to install psutil to scale the workers with the system load')
+    psutil = None
+
+import config
+import metrics
+
+logging.config.fileConfig('logging.conf')
+
+logger = logging.getLogger("ORM")
+
+
+@contextmanager
+def watched(visit, domain_ids):
+    """ Tells the watchdog that the worker is visiting the given domains during the enclosed block. """
+
+    # Lock-free shared memory: the start time is written last and cleared first
+    for i in range(1, len(visit)):
+        visit[i] = domain_ids[i - 1] if i - 1 < len(domain_ids) else 0
+    visit[0] = time.time()
+    try:
+        yield
+    finally:
+        visit[0] = 0
+
+
+def run(target, number, stop_event, visit, counters):
+    """ Runs the worker target counting its metrics into its own slot. """
+
+    if counters is not None:
+        metrics.use_slot(counters)
+    target(number, stop_event, visit)
+
+
+class Worker(object):
+    """ Worker process with its stop event, its metrics and the start time and domain ids of its current visit. """
+
+    def __init__(self, target, number, slots=1):
+        self.number = number
+        self.stop_event = Event()
+        # Without lock: a killed worker must not leave it acquired
+        self.visit = Array('d', 1 + slots, lock=False)
+        self.counters = metrics.new_slot() if metrics.enabled() else None
+        self.process = Process(target=run, args=(target, number, self.stop_event, self.visit, self.counters),
+                               name="Worker %d" % number, daemon=True)
+        self.started = time.time()
+        self.retiring = False
+
+    def rss(self):
+        """ Returns the resident memory of the worker and its child processes (browsers). """
+
+        try:
+            process = psutil.Process(self.process.pid)
+            rss = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            return rss
+        except psutil.Error:
+            return 0
+
+    def retire(self):
+        """ Asks the worker to finish once its current work is done. """
+
+        self.retiring = True
+        self.stop_event.set()
+
+    def kill(self):
+        """ Kills the worker and its browsers. """
+
+        self.retiring = True
+        children = []
+        if psutil is not None:
+            try:
+                children = psutil.Process(self.process.pid).children(recursive=True)
+            except psutil.Error:
+                pass
+        self.process.kill()
+        for child in children:
+            try:
+                child.kill()
+            except psutil.Error:
+                pass
+
+
+class Supervisor(object):
+    """ Keeps 'workers' processes running 'target', between 'minimum' and 'maximum' if autoscaling. Workers
+    visiting up to 'slots' domains at once for longer than 'budget' seconds (0 to never) are killed holding
+    'lock' (the lock the workers take outside their visits, if any), and 'on_hang(domain_ids)' is called with
+    the domains they were visiting. """
+
+    def __init__(self, target, workers, minimum=None, maximum=None, autoscale=False, slots=1, budget=0,
+                 on_hang=None, lock=None):
+        self.target = target
+        self.slots = slots
+        self.budget = budget
+        self.on_hang = on_hang
+        self.lock = lock
+        # Hung visits, seconds lost in them and seconds run by all the workers
+        self.hangs = 0
+        self.hung_seconds = 0
+        self.worker_seconds = 0
+        self.last_tick = time.time()
+        self.autoscale = autoscale
+        if autoscale and psutil is None:
+            logger.warning("[Supervisor] psutil is not installed: the number of workers will not change")
+            self.autoscale = False
+        if not self.autoscale:
+            minimum = maximum = workers
+        self.minimum = max(1, minimum or 1)
+        self.maximum = max(self.minimum, maximum or workers)
+        self.size = min(max(workers, self.minimum), self.maximum)
+        self.workers = {}
+        self.paused = False
+        self.last_change = time.time()
+        self.last_check = 0
+        if self.autoscale:
+            # First call of the CPU usage sampling
+            psutil.cpu_percent(interval=None)
+
+    def active(self):
+        """ Returns the workers not retiring. """
+
+        return [worker for worker in self.workers.values() if not worker.retiring]
+
+    def spawn(self):
+        """ Starts a new worker with the lowest free number. """
+
+        number = 0
+        while number in self.workers.keys():
+            number += 1
+        worker = Worker(self.target, number, self.slots)
+        worker.process.start()
+        self.workers[number] = worker
+        logger.info("[Supervisor] Worker %d started (pid %d)", number, worker.process.pid)
+        return worker
+
+    def start(self):
+        for _ in range(self.size):
+            self.spawn()
+
+    def reap(self):
+        """ Removes the finished workers. Returns the workers that died without being asked to. """
+
+        died = []
+        for number, worker in list(self.workers.items()):
+            if not worker.process.is_alive():
+                worker.process.join()
+                del self.workers[number]
+                if worker.counters is not None:
+                    metrics.release_slot(worker.counters)
+                if not worker.retiring:
+                    logger.warning("[Supervisor] Worker %d died (exit code %s)", number, worker.process.exitcode)
+                    died.append(worker)
+        return died
+
+    def check(self, backlog=0):
+        """ Replaces the dead workers and, with autoscaling, adapts the workers and the intake to the system load.
+        'backlog' is the number of domains waiting in the queue. """
+
+        now = time.time()
+        self.worker_seconds += (now - self.last_tick) * len(self.workers)
+        self.last_tick = now
+        self.watch()
+        self.reap()
+        if self.autoscale and time.time() - self.last_check >= config.AUTOSCALE_INTERVAL:
+            self.last_check = time.time()
+            self.scale(backlog)
+        while len(self.active()) < self.size:
+            self.spawn()
+
+    def watch(self):
+        """ Kills the workers visiting the same domains for longer than the budget. """
+
+        if not self.budget:
+            return
+        for worker in list(self.workers.values()):
+            start = worker.visit[0]
+            elapsed = time.time() - start
+            if not start or elapsed <= self.budget or not worker.process.is_alive():
+                continue
+            domain_ids = [int(domain_id) for domain_id in worker.visit[1:] if domain_id]
+            if not self.kill_visiting(worker, start):
+                continue
+            logger.error("[Supervisor] Worker %d stuck for %d s visiting domains %s: killed", worker.number,
+                         elapsed, domain_ids)
+            self.hangs += 1
+            self.hung_seconds += elapsed
+            metrics.inc("orm_watchdog_kills_total")
+            metrics.inc("orm_hung_seconds_total", elapsed)
+            metrics.inc("orm_failures_total", len(domain_ids), type="timeout")
+            logger.warning("[Supervisor] %d hung visits: %d worker-seconds lost (%.1f%% of the capacity)",
+                           self.hangs, self.hung_seconds, self.lost_capacity() * 100)
+            if self.on_hang:
+                try:
+                    self.on_hang(domain_ids)
+                except Exception as e:
+                    logger.error("[Supervisor] Could not record the hung visit of %s: %s", domain_ids, e)
+
+    def kill_visiting(self, worker, start):
+        """ Kills the worker if it is still in the visit started at 'start'. Returns whether it was killed. """
+
+        # With the lock held the worker can not be taking it, even if it finishes the visit right now
+        if self.lock is not None and not self.lock.acquire(timeout=config.WATCHDOG_LOCK_TIMEOUT):
+            logger.warning("[Supervisor] Lock busy: worker %d not killed yet", worker.number)
+            return False
+        try:
+            if worker.visit[0] != start:
+                return False
+            worker.kill()
+            return True
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+    def lost_capacity(self):
+        """ Returns the fraction of the worker time lost in hung visits. """
+
+        return self.hung_seconds / self.worker_seconds if self.worker_seconds else 0
+
+    def scale(self, backlog):
+        memory = psutil.virtual_memory().percent
+        cpu = psutil.cpu_percent(interval=None)
+        active = self.active()
+
+        # Intake paused while the memory is scarce
+        paused = memory >= config.AUTOSCALE_MEMORY_HIGH
+        if paused != self.paused:
+            logger.warning("[Supervisor] Memory usage %.1f%%: intake %s", memory, "paused" if paused else "resumed")
+            self.paused = paused
+
+        # Workers (and their browsers) using too much memory are replaced by fresh ones
+        usage = {worker.number: worker.rss() for worker in active}
+        for worker in active:
+            if usage[worker.number] > config.AUTOSCALE_WORKER_RSS_LIMIT:
+                logger.warning("[Supervisor] Worker %d uses %d MB: replacing it", worker.number,
+                               usage[worker.number] // 2 ** 20)
+                worker.retire()
+
+        candidates = self.active()
+        if time.time() - self.last_change < config.AUTOSCALE_COOLDOWN or not candidates:
+            return
+        if memory >= config.AUTOSCALE_MEMORY_CRITICAL and self.size > self.minimum:
+            worker = max(candidates, key=lambda item: usage[item.number])
+            self.resize(self.size - 1, "Memory usage %.1f%%" % memory, worker)
+        elif cpu >= config.AUTOSCALE_CPU_HIGH and self.size > self.minimum:
+            worker = max(candidates, key=lambda item: item.started)
+            self.resize(self.size - 1, "CPU usage %.1f%%" % cpu, worker)
+        elif not paused and cpu < config.AUTOSCALE_CPU_LOW and backlog > 0 and self.size < self.maximum:
+            self.resize(self.size + 1, "CPU usage %.1f%%" % cpu)
+
+    def resize(self, size, reason, retired=None):
+        logger.info("[Supervisor] %s: %d -> %d workers", reason, self.size, size)
+        self.size = size
+        self.last_change = time.time()
+        if retired is not None:
+            retired.retire()
+
+    def visiting(self):
+        """ Returns the ids of the domains being visited by the workers. """
+
+        return [int(domain_id) for worker in self.workers.values() if worker.visit[0]
+                for domain_id in worker.visit[1:] if domain_id]
+
+    def stop(self, timeout=None):
+        """ Asks every worker to finish and waits for them (up to 'timeout' seconds). Returns whether all finished. """
+
+        for worker in self.workers.values():
+            worker.retire()
+        deadline = time.time() + timeout if timeout is not None else None
+        for worker in list(self.workers.values()):
+            worker.process.join(None if deadline is None else max(0, deadline - time.time()))
+        self.reap()
+        return not self.workers
+
+    def kill(self):
+        """ Kills the remaining workers and their browsers. """
+
+        for worker in self.workers.values():
+            logger.warning("[Supervisor] Killing worker %d", worker.number)
+            worker.kill()
+        for worker in self.workers.values():
+            worker.process.join()
+        self.reap()
+
+    def collect(self):
+        """ Metrics collector of the supervisor. """
+
+        return [["orm_workers_target", "gauge", "Workers wanted by the supervisor", [[None, self.size]]],
+                ["orm_intake_paused", "gauge", "Whether the intake of new domains is paused", [[None, int(self.paused)]]],
+                ["orm_lost_capacity_ratio", "gauge", "Fraction of the worker time lost in hung visits",
+                 [[None, self.lost_capacity()]]]]